@@ -1,34 +1,147 @@
+import argparse
 import os
+from contextlib import ExitStack
 
 from src.logging.logger import info_logger, debug_logger
+from src.profiling import profiler, phase, PROFILE_ENV
+from src.tracing import tracer, JsonFileExporter
 
 from src._auth.auth_flows import AuthorizationCodeFlow
-from src.spotify_interaction import SpotifyInteraction
-from src.db_connection import MongoConnection
+from src._auth.token_vault import TokenVault
+from src.spotify_interaction import SpotifyInteraction, required_scope
+from src.db_connection import MongoClientManager, MongoConnection
+from src.coordination import Coordinator, IngestionWorker
+from src.rollups import ListeningRollups
+from src.archive.raw_archive import RawResponseArchive
+from src.similarity.audio_index import AudioFeatureIndex, AudioFeatureEnricher
+from src.events.publisher import EventPublisher
+from src.play_index import PlayIndex
+from src.search_index import SearchIndex
+from src.sketches import SketchStore
+from src.events.sinks import configured_sinks
 
-def main():
-    flow = AuthorizationCodeFlow(scope = 'user-read-recently-played')
-    interaction = SpotifyInteraction(connection=flow)
-
-    
-    with MongoConnection(
-            db='spotify_user_history', 
-            tbl='song_history', 
-            host=os.environ['WSL_HOST']) as database_conn:
-
-        play_history = interaction.get_new_play_history(database_conn=database_conn)
-        if play_history:
-            database_conn.save_many(play_history)
-        else:
+DB = 'spotify_user_history'
+
+
+def ingest(user_id, vault=None, fence_token=None):
+    # Ingestion only reads the play history, asking for more would force
+    # tokens without those scopes through an interactive re-authorization
+    with phase('auth'):
+        flow = AuthorizationCodeFlow(
+            scope = required_scope(['play_history']),
+            user_id = user_id,
+            vault = vault)
+
+    time_series = os.environ.get('SPOTIFY_TIME_SERIES') == '1'
+    with RawResponseArchive(
+            directory=os.environ.get('SPOTIFY_ARCHIVE_DIR', 'var/archive')
+            ) as archive, MongoConnection(
+            db=DB, 
+            tbl='song_history_ts' if time_series else 'song_history', 
+            host=os.environ['WSL_HOST'],
+            user_id=user_id,
+            time_series=time_series,
+            fence_token=fence_token,
+            raw_bson=os.environ.get('SPOTIFY_RAW_BSON') == '1'
+            ) as database_conn, ExitStack() as stack:
+        interaction = SpotifyInteraction(
+            connection=flow, archive=archive, user_id=user_id)
+        # The run and a rebuild of the user's rollups exclude each other,
+        # whichever starts second fails
+        rollups = ListeningRollups(database_conn)
+        stack.enter_context(rollups.locked('ingestion'))
+        database_conn.add_save_hook(rollups.update)
+        if os.environ.get('SPOTIFY_AUDIO_INDEX') == '1':
+            database_conn.add_save_hook(AudioFeatureEnricher(
+                interaction, AudioFeatureIndex()).update)
+        # The local play and search indexes hold one user's plays, workers
+        # ingesting several users leave them out
+        if fence_token is None:
+            if os.environ.get('SPOTIFY_PLAY_INDEX') == '1':
+                database_conn.add_save_hook(PlayIndex().update)
+            if os.environ.get('SPOTIFY_SEARCH_INDEX') == '1':
+                database_conn.add_save_hook(SearchIndex().update)
+        if os.environ.get('SPOTIFY_SKETCHES') == '1':
+            database_conn.add_save_hook(SketchStore(database_conn).update)
+        event_sinks = configured_sinks(
+            os.environ.get('SPOTIFY_EVENT_HTTP', '').split(','),
+            os.environ.get('SPOTIFY_EVENT_SOCKET', '').split(','))
+        publisher = None
+        if event_sinks:
+            publisher = stack.enter_context(
+                EventPublisher(event_sinks, user_id=user_id))
+            database_conn.add_save_hook(publisher.publish)
+
+        saved = interaction.ingest_new_play_history(database_conn)
+        if publisher is not None:
+            # Drop the events every sink acknowledged, the outbox only
+            # keeps what is still pending
+            publisher.compact()
+        if not saved:
             info_logger.info('Nothing to do, no new tracks added')
+        return saved
+
+
+def main():
+    vault_path = os.environ.get('SPOTIFY_TOKEN_VAULT')
+    ingest(
+        os.environ.get('SPOTIFY_USER_ID', 'default'),
+        TokenVault(vault_path) if vault_path else None)
+
+
+def run_worker(interval_seconds):
+    # Every node runs the same command, users are spread over the live
+    # workers through leases in MongoDB
+    vault = TokenVault(os.environ['SPOTIFY_TOKEN_VAULT'])
+    database = MongoClientManager.get_client(os.environ['WSL_HOST'], 27017)[DB]
+    coordinator = Coordinator(database)
+    coordinator.register_users(
+        user_id for user_id in os.environ.get('SPOTIFY_USERS', '').split(',')
+        if user_id)
+    IngestionWorker(
+        coordinator,
+        lambda user_id, token: ingest(user_id, vault, token),
+        interval_seconds).run_forever()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--profile',
+        default=os.environ.get(PROFILE_ENV),
+        help='Comma separated profiling modes: cpu, sample, memory, timers, all')
+    parser.add_argument(
+        '--trace',
+        nargs='?',
+        const='var/logs/traces.jsonl',
+        help='Write trace spans as OTLP JSON lines to this file')
+    parser.add_argument(
+        '--worker',
+        action='store_true',
+        help='Keep running and ingest the users leased to this node')
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=300,
+        help='Seconds between two ingestions of a user in worker mode')
+    args = parser.parse_args()
+    # Only the time series collection keeps the plays of several users
+    # apart, through the user id in its meta field
+    if args.worker and os.environ.get('SPOTIFY_TIME_SERIES') != '1':
+        parser.error('--worker needs SPOTIFY_TIME_SERIES=1')
+    profiler.configure(args.profile)
+    if args.trace:
+        tracer.configure(JsonFileExporter(args.trace))
+
     info_logger.info('--------------------')
     info_logger.info('Starting application')
     info_logger.info('--------------------')
 
-    main()
+    if args.worker:
+        run_worker(args.interval)
+    else:
+        with profiler.run('main'), tracer.start_span('main'):
+            main()
 
     info_logger.info('--------------------')
     info_logger.info('Closing application')
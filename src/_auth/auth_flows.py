@@ -1,15 +1,18 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import FrozenSet, Iterable, List, Optional
 
 from ..errors.token_errors import InvalidAccessTokenError, LostRefreshTokenError, MissingScopeError
 from ..request_utils import ApiLogger
 from ..config.parse_config_files import AuthConfig
 from ..client import Client
 from .._auth.token_requests import RefreshingToken, AuthCodeRequest
+from .._auth.token_vault import (
+    TokenVault, VaultAuthConfig, VaultTokenStore, normalize_scope)
 from ..logging.logger import info_logger, debug_logger
-from ..config.configure_requests import configure_request
+from ..config.configure_requests import get_session_manager
+from ..tracing import tracer, SPAN_KIND_CLIENT
 
-conf_requests = configure_request()
+conf_requests = get_session_manager().session
 
 class AuthFlow(ABC):
     client = Client()
@@ -22,50 +25,82 @@ class AuthFlow(ABC):
     def get_request():
         pass
 
+    @property
     @abstractmethod
-    def check_scope(scope: str):
-        pass
-
-    @abstractmethod
-    def reset_refreshing_token(scope: str):
+    def scopes(self) -> FrozenSet[str]:
         pass
 
 class AuthorizationCodeFlow(AuthFlow):
     auth_config = AuthConfig()
-    def __init__(self, scope: str = 'user-read-private') -> None:
+    def __init__(
+            self,
+            scope: str = 'user-read-private',
+            user_id: str = 'default',
+            vault: Optional[TokenVault] = None) -> None:
+        self.user_id = user_id
+        self.vault = vault
+        if vault is not None:
+            scope = normalize_scope(scope)
+            self.auth_config = VaultAuthConfig(vault, user_id)
         self.scope = scope
+        self._scoped_token = None
+        self._scopes: FrozenSet[str] = frozenset()
         info_logger.info(f'Instantiate AuthCodeFlow for scope {scope}')
         self.refreshing_token = self.authenticate(scope)
+        missing = set(scope.split()) - self.scopes
+        if missing:
+            # A cached token from a narrower authorization, all scopes are
+            # requested once here instead of when an endpoint needs them
+            info_logger.warning(
+                'Cached token lacks scopes %s, authorizing %s',
+                ' '.join(sorted(missing)), scope)
+            self.refreshing_token.access_token.delete_tokens()
+            self.refreshing_token = self.authenticate(scope)
         info_logger.info(f'AuthCodeFlow for scope {scope} successfull')
 
+    @property
+    def scopes(self) -> FrozenSet[str]:
+        # Parsed once per access token, refreshes replace the token
+        access_token = self.refreshing_token.access_token
+        if access_token is not self._scoped_token:
+            try:
+                self._scopes = frozenset(access_token.scopes)
+            except MissingScopeError:
+                self._scopes = frozenset()
+            self._scoped_token = access_token
+        return self._scopes
+
     @property
     def get_req_header(self):
         return {
             "Authorization": "Bearer " + self.refreshing_token.get_access_token()
         }
 
-    def reset_refreshing_token(self, scope: str) -> None:
-        self.refreshing_token.access_token.delete_tokens()
-        self.scope += f' {scope}'
-        self.refreshing_token = self.authenticate(self.scope)
-
     def get_auth_code(self, scope: str) -> AuthCodeRequest:
         return AuthCodeRequest(
             client = self.client, 
             auth_config = self.auth_config,
             scope = scope)
 
+    def _token_store(self, scope: str) -> Optional[VaultTokenStore]:
+        if self.vault is None:
+            return None
+        return VaultTokenStore(self.vault, self.user_id, scope)
+
     def get_refreshing_token(
             self, auth_code_request: AuthCodeRequest) -> RefreshingToken:
+        store = self._token_store(auth_code_request.scope)
         try:
             return RefreshingToken(
-                auth_code_request= auth_code_request
+                auth_code_request= auth_code_request,
+                store = store
             )
         except LostRefreshTokenError as e:
             info_logger.warning(e)
             try:
                 return RefreshingToken(
-                    auth_code_request= auth_code_request
+                    auth_code_request= auth_code_request,
+                    store = store
                 )
             except:
                 info_logger.exception()
@@ -79,14 +114,15 @@ class AuthorizationCodeFlow(AuthFlow):
 
     def get_request(self, endpoint:str, params: dict = None) -> dict:
         url = f'{endpoint}'
-        return conf_requests.get(url=url, headers=self.get_req_header, params=params)
+        headers = self.get_req_header
+        with tracer.start_span(
+                'HTTP GET', SPAN_KIND_CLIENT, **{'http.url': url}) as span:
+            if params and 'after' in params:
+                span.set_attribute('page.cursor', params['after'])
+            response = conf_requests.get(url=url, headers=headers, params=params)
+            span.set_attribute('http.status_code', response.status_code)
+            return response
 
-    def check_scope(self, scope: str):
-        authorized_scopes = self.refreshing_token._retrieve_access_token().scopes
-        if scope not in authorized_scopes:
-            raise MissingScopeError(
-                msg='Not authorized for required scope', scope=scope)
-        
 
 class ClientCredentialsFlow(AuthFlow):
     token_url = 'https://accounts.spotify.com/api/token'
@@ -115,5 +151,24 @@ class ClientCredentialsFlow(AuthFlow):
         url = f'{endpoint}'
         return conf_requests.get(url=url, headers=self.get_req_header, params=params)
 
-    def check_scope(scope: str):
-        pass
\ No newline at end of file
+    @property
+    def scopes(self) -> FrozenSet[str]:
+        # Client credentials only reach endpoints without user scopes
+        return frozenset()
+
+
+class ScopeRouter:
+    # Picks the first flow whose token was granted the scope an endpoint
+    # declares, from the in memory scope sets. Endpoints without a scope
+    # go to the first flow.
+    def __init__(self, flows: Iterable[AuthFlow]) -> None:
+        self.flows = list(flows)
+
+    def flow_for(self, scope: Optional[str]) -> AuthFlow:
+        if scope is None:
+            return self.flows[0]
+        for flow in self.flows:
+            if scope in flow.scopes:
+                return flow
+        raise MissingScopeError(
+            msg='No authorized flow for required scope', scope=scope)
\ No newline at end of file
@@ -1,5 +1,5 @@
 from urllib.parse import urlencode, urlparse, parse_qs
-import json
+from typing import Optional
 
 import requests
 
@@ -7,11 +7,15 @@ from ..errors.token_errors import InvalidAccessTokenError
 from ..config.parse_config_files import AuthConfig
 from ..client import Client
 from .tokens import AccessToken
+from .token_vault import FileTokenStore, TokenStore
 from ..logging.logger import info_logger, debug_logger
 from ..request_utils import ApiLogger
-from ..config.configure_requests import configure_request
+from ..retry_policy import no_retry_policy
+from ..config.configure_requests import get_session_manager
+from ..profiling import phase
+from ..tracing import tracer
 
-conf_requests = configure_request()
+conf_requests = get_session_manager().session
 
 class AuthCodeRequest:
     auth_url = 'https://accounts.spotify.com/authorize'
@@ -74,36 +78,54 @@ class RefreshingToken:
 
     def __init__(
             self, 
-            auth_code_request: AuthCodeRequest) -> None:
+            auth_code_request: AuthCodeRequest,
+            store: Optional[TokenStore] = None) -> None:
         info_logger.info(
             f'Instantiate RefreshingToken for scope {auth_code_request.scope}')
         self.auth_code_request = auth_code_request
+        self.store = store or FileTokenStore()
         self.access_token = self._retrieve_access_token()
 
     def get_access_token(self) -> str:
         info_logger.info('Request access token')
-        if self.access_token.is_expired():
-            info_logger.info(
-                'Access token expired, retrieve new access token')
-            self.access_token = self._retrieve_access_token(refresh = True)
-        return self.access_token.access_token
+        with phase('auth'), tracer.start_span(
+                'RefreshingToken.get_access_token') as span:
+            expired = self.access_token.is_expired()
+            span.set_attribute('token.refreshed', expired)
+            if expired:
+                info_logger.info(
+                    'Access token expired, retrieve new access token')
+                self.access_token = self._retrieve_access_token(refresh = True)
+            return self.access_token.access_token
 
-    @ApiLogger(msg='Acquire access token')
     def _request_access_token(self, refresh: bool = False) -> requests.Response:
         if refresh:
-            data = {
-                'grant_type': 'refresh_token',
-                'refresh_token': self.access_token.refresh_token,
-            }
-        else:
-            data = {
-                'grant_type': 'authorization_code',
-                'code': self.auth_code_request.auth_code,
-                'redirect_uri': self.auth_code_request.client.client_config.redirect_url,
-            }
+            return self._request_refreshed_token()
+        return self._exchange_auth_code()
+
+    @ApiLogger(msg='Acquire access token')
+    def _request_refreshed_token(self) -> requests.Response:
+        return self._post_token_request({
+            'grant_type': 'refresh_token',
+            'refresh_token': self.access_token.refresh_token,
+        })
+
+    # An authorization code can only be used once, so the exchange is never
+    # retried and the code is dropped once it was sent
+    @ApiLogger(msg='Exchange authorization code', policy=no_retry_policy)
+    def _exchange_auth_code(self) -> requests.Response:
+        data = {
+            'grant_type': 'authorization_code',
+            'code': self.auth_code_request.auth_code,
+            'redirect_uri': self.auth_code_request.client.client_config.redirect_url,
+        }
+        try:
+            return self._post_token_request(data)
+        finally:
             self.auth_code_request.auth_config.remove_auth_code(
                 self.auth_code_request.scope)
 
+    def _post_token_request(self, data: dict) -> requests.Response:
         headers = {
             'Authorization': f'Basic {self.auth_code_request.client.get_auth_string()}'
         }
@@ -119,14 +141,16 @@ class RefreshingToken:
         
         if access_token_response.status_code != 200:
             raise InvalidAccessTokenError('Acces token could not be retrieved')
-        return AccessToken(access_token_response.json())
+        return AccessToken(access_token_response.json(), store=self.store)
 
     def _load_existing_access_token(self) -> AccessToken:
-        with open('./src/config/tokens.json', 'r') as file:
-            access_token_content = json.load(file)
-            return AccessToken(
-                access_token_content=access_token_content,
-                load_from_cache=True)
+        access_token_content = self.store.load_tokens()
+        if access_token_content is None:
+            raise FileNotFoundError('No cached access token')
+        return AccessToken(
+            access_token_content=access_token_content,
+            load_from_cache=True,
+            store=self.store)
 
     def _retrieve_access_token(self, refresh: bool = False) -> AccessToken:
         if refresh:
@@ -141,3 +165,19 @@ class RefreshingToken:
             info_logger.info(
                 'Aquire new access token without existing refreshing token')
             return self._load_new_access_token(refresh)
+
+
+@ApiLogger(msg='Refresh access token')
+def _refresh_token_request(refresh_token: str) -> requests.Response:
+    client = Client()
+    return conf_requests.post(
+        RefreshingToken.token_url,
+        data={'grant_type': 'refresh_token', 'refresh_token': refresh_token},
+        headers={'Authorization': f'Basic {client.get_auth_string()}'})
+
+
+def request_refreshed_token(refresh_token: str) -> dict:
+    response = _refresh_token_request(refresh_token)
+    if response.status_code != 200:
+        raise InvalidAccessTokenError('Acces token could not be refreshed')
+    return response.json()
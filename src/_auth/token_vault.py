@@ -0,0 +1,326 @@
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from ..errors.errors import InvalidDirectoryError
+from ..logging.logger import info_logger, debug_logger
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tokens (
+    user_id TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    content TEXT NOT NULL,
+    refresh_token TEXT,
+    expires_at REAL NOT NULL,
+    lease_until REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, scope)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at);
+CREATE TABLE IF NOT EXISTS auth_codes (
+    user_id TEXT NOT NULL,
+    scope TEXT NOT NULL,
+    code TEXT NOT NULL,
+    PRIMARY KEY (user_id, scope)
+) WITHOUT ROWID;
+'''
+
+
+def normalize_scope(scope: str) -> str:
+    return ' '.join(sorted(set(scope.split())))
+
+
+def _expires_at(content: dict) -> float:
+    return datetime.datetime.fromisoformat(content['expires_at']).timestamp()
+
+
+class TokenVault:
+    # One SQLite database in WAL mode: readers never block the writer and
+    # every worker thread keeps its own connection. Tokens are looked up on
+    # the (user_id, scope) primary key, the expires_at index drives bulk
+    # refreshes and a short lease keeps two workers from refreshing the
+    # same token.
+    def __init__(
+            self,
+            path: str = 'var/tokens/vault.sqlite3',
+            busy_timeout_ms: int = 10000) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        with self._connection() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(
+                self.path, timeout=self.busy_timeout_ms / 1000,
+                isolation_level=None)
+            db.execute(f'PRAGMA busy_timeout={self.busy_timeout_ms}')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def get(self, user_id: str, scope: str) -> Optional[dict]:
+        row = self._connection().execute(
+            'SELECT content, refresh_token FROM tokens '
+            'WHERE user_id = ? AND scope = ?',
+            (user_id, normalize_scope(scope))).fetchone()
+        if row is None:
+            return None
+        content = json.loads(row[0])
+        if row[1]:
+            content['refresh_token'] = row[1]
+        return content
+
+    def get_refresh_token(self, user_id: str, scope: str) -> Optional[str]:
+        row = self._connection().execute(
+            'SELECT refresh_token FROM tokens WHERE user_id = ? AND scope = ?',
+            (user_id, normalize_scope(scope))).fetchone()
+        return row[0] if row else None
+
+    def put(self, user_id: str, scope: str, content: dict) -> None:
+        # Token responses without a refresh token keep the stored one
+        content = dict(content)
+        refresh_token = content.pop('refresh_token', None)
+        self._connection().execute(
+            'INSERT INTO tokens (user_id, scope, content, refresh_token, '
+            'expires_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (user_id, scope) DO UPDATE SET '
+            'content = excluded.content, '
+            'refresh_token = COALESCE(excluded.refresh_token, refresh_token), '
+            'expires_at = excluded.expires_at, lease_until = 0, '
+            'updated_at = excluded.updated_at',
+            (user_id, normalize_scope(scope), json.dumps(content),
+             refresh_token, _expires_at(content), time.time()))
+
+    def put_refresh_token(
+            self, user_id: str, scope: str, refresh_token: str) -> None:
+        self._connection().execute(
+            'INSERT INTO tokens (user_id, scope, content, refresh_token, '
+            'expires_at, updated_at) VALUES (?, ?, ?, ?, 0, ?) '
+            'ON CONFLICT (user_id, scope) DO UPDATE SET '
+            'refresh_token = excluded.refresh_token',
+            (user_id, normalize_scope(scope), '{}', refresh_token, time.time()))
+
+    def delete(self, user_id: str, scope: str) -> None:
+        self._connection().execute(
+            'DELETE FROM tokens WHERE user_id = ? AND scope = ?',
+            (user_id, normalize_scope(scope)))
+
+    def expiring(
+            self,
+            within_seconds: float = 300,
+            limit: int = 1000) -> List[Tuple[str, str]]:
+        now = time.time()
+        return self._connection().execute(
+            'SELECT user_id, scope FROM tokens '
+            'WHERE expires_at < ? AND lease_until < ? '
+            'AND refresh_token IS NOT NULL ORDER BY expires_at LIMIT ?',
+            (now + within_seconds, now, limit)).fetchall()
+
+    def claim(
+            self,
+            user_id: str,
+            scope: str,
+            lease_seconds: float = 60) -> Optional[str]:
+        # Returns the refresh token if this worker won the lease
+        now = time.time()
+        cursor = self._connection().execute(
+            'UPDATE tokens SET lease_until = ? '
+            'WHERE user_id = ? AND scope = ? AND lease_until < ? '
+            'RETURNING refresh_token',
+            (now + lease_seconds, user_id, normalize_scope(scope), now))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def refresh_expiring(
+            self,
+            refresh: Callable[[str], dict],
+            within_seconds: float = 300,
+            workers: int = 8,
+            limit: int = 1000) -> Dict[str, int]:
+        stats = {'refreshed': 0, 'skipped': 0, 'failed': 0}
+        lock = threading.Lock()
+
+        def refresh_one(key: Tuple[str, str]) -> None:
+            user_id, scope = key
+            refresh_token = self.claim(user_id, scope)
+            if refresh_token is None:
+                result = 'skipped'
+            else:
+                try:
+                    content = refresh(refresh_token)
+                    expires_at = datetime.datetime.now(
+                        datetime.timezone.utc) + datetime.timedelta(
+                        seconds=content['expires_in'])
+                    content['expires_at'] = expires_at.isoformat()
+                    self.put(user_id, scope, content)
+                    result = 'refreshed'
+                except Exception:
+                    info_logger.exception(
+                        'Refreshing token of %s for %s failed', user_id, scope)
+                    result = 'failed'
+            with lock:
+                stats[result] += 1
+
+        expiring = self.expiring(within_seconds, limit)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(refresh_one, expiring))
+        info_logger.info(
+            'Token refresh: %d refreshed, %d skipped, %d failed',
+            stats['refreshed'], stats['skipped'], stats['failed'])
+        return stats
+
+    def get_auth_code(self, user_id: str, scope: str) -> Optional[str]:
+        row = self._connection().execute(
+            'SELECT code FROM auth_codes WHERE user_id = ? AND scope = ?',
+            (user_id, normalize_scope(scope))).fetchone()
+        return row[0] if row else None
+
+    def auth_code_scopes(self, user_id: str) -> List[str]:
+        return [row[0] for row in self._connection().execute(
+            'SELECT scope FROM auth_codes WHERE user_id = ?', (user_id,))]
+
+    def put_auth_code(self, user_id: str, scope: str, code: str) -> None:
+        self._connection().execute(
+            'INSERT OR REPLACE INTO auth_codes VALUES (?, ?, ?)',
+            (user_id, normalize_scope(scope), code))
+
+    def delete_auth_code(self, user_id: str, scope: str) -> None:
+        self._connection().execute(
+            'DELETE FROM auth_codes WHERE user_id = ? AND scope = ?',
+            (user_id, normalize_scope(scope)))
+
+    def close(self) -> None:
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+
+class FileTokenStore:
+    # The single user cache files used when no vault is configured
+    def __init__(
+            self,
+            tokens_path: str = './src/config/tokens.json',
+            refresh_token_path: str = './src/config/refresh_token.json') -> None:
+        self.tokens_path = tokens_path
+        self.refresh_token_path = refresh_token_path
+
+    def load_tokens(self) -> Optional[dict]:
+        try:
+            with open(self.tokens_path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def save_tokens(self, content: dict) -> None:
+        try:
+            with open(self.tokens_path, 'w') as file:
+                json.dump(content, file, indent=2)
+        except FileNotFoundError:
+            raise InvalidDirectoryError(
+                'Directory for saving the access token does not exist')
+
+    def load_refresh_token(self) -> Optional[str]:
+        try:
+            with open(self.refresh_token_path, 'r') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def save_refresh_token(self, refresh_token: str) -> None:
+        try:
+            with open(self.refresh_token_path, 'w') as file:
+                file.write(refresh_token)
+        except FileNotFoundError:
+            raise InvalidDirectoryError(
+                'Directory for saving the refresh token does not exist')
+
+    def delete_tokens(self) -> None:
+        os.remove(self.tokens_path)
+        os.remove(self.refresh_token_path)
+
+
+class VaultTokenStore:
+    def __init__(self, vault: TokenVault, user_id: str, scope: str) -> None:
+        self.vault = vault
+        self.user_id = user_id
+        self.scope = scope
+
+    def load_tokens(self) -> Optional[dict]:
+        content = self.vault.get(self.user_id, self.scope)
+        if not content or 'access_token' not in content:
+            return None
+        return content
+
+    def save_tokens(self, content: dict) -> None:
+        self.vault.put(self.user_id, self.scope, content)
+
+    def load_refresh_token(self) -> Optional[str]:
+        return self.vault.get_refresh_token(self.user_id, self.scope)
+
+    def save_refresh_token(self, refresh_token: str) -> None:
+        self.vault.put_refresh_token(self.user_id, self.scope, refresh_token)
+
+    def delete_tokens(self) -> None:
+        self.vault.delete(self.user_id, self.scope)
+
+
+TokenStore = Union[FileTokenStore, VaultTokenStore]
+
+
+class VaultAuthConfig:
+    # Same interface as AuthConfig, with the codes of one user in the vault
+    def __init__(self, vault: TokenVault, user_id: str) -> None:
+        self.vault = vault
+        self.user_id = user_id
+
+    @property
+    def scopes(self) -> List[str]:
+        return self.vault.auth_code_scopes(self.user_id)
+
+    @property
+    def config(self) -> Dict[str, str]:
+        return {scope: self.vault.get_auth_code(self.user_id, scope)
+                for scope in self.scopes}
+
+    def add_auth_code(self, scope: str, auth_code: str) -> None:
+        self.vault.put_auth_code(self.user_id, scope, auth_code)
+
+    def remove_auth_code(self, scope: str) -> None:
+        self.vault.delete_auth_code(self.user_id, scope)
+
+
+if __name__ == '__main__':
+    from .token_requests import request_refreshed_token
+
+    parser = argparse.ArgumentParser(
+        description='Proactively refresh expiring tokens in the vault')
+    parser.add_argument('--vault', default='var/tokens/vault.sqlite3')
+    parser.add_argument('--within', type=float, default=600,
+                        help='Refresh tokens expiring within this many seconds')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--interval', type=float, default=0,
+                        help='Keep running and refresh every N seconds')
+    args = parser.parse_args()
+
+    vault = TokenVault(args.vault)
+    while True:
+        vault.refresh_expiring(
+            request_refreshed_token, args.within, args.workers)
+        if not args.interval:
+            break
+        debug_logger.debug('Next token refresh in %ss', args.interval)
+        time.sleep(args.interval)
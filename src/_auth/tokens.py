@@ -1,13 +1,11 @@
-import json
 from abc import ABC, abstractmethod
 import datetime
-import os
-from typing import Set
+from typing import Optional, Set
 
 from ..logging.logger import info_logger, debug_logger
 from ..errors.token_errors import (
     InvalidAccessTokenError, LostRefreshTokenError, MissingScopeError)
-from ..errors.errors import InvalidDirectoryError
+from .token_vault import FileTokenStore, TokenStore
 
 
 class Token(ABC):
@@ -26,9 +24,11 @@ class AccessToken(Token):
     def __init__(
             self, 
             access_token_content: dict, 
-            load_from_cache: bool = False) -> None:
+            load_from_cache: bool = False,
+            store: Optional[TokenStore] = None) -> None:
 
         self.access_token_content = access_token_content
+        self.store = store or FileTokenStore()
         if not load_from_cache:
             info_logger.info('Instantiate fresh Access token')
             self.expires_at = self._set_access_token_expiry(
@@ -63,36 +63,24 @@ class AccessToken(Token):
         return set(scopes.split(sep=' '))
 
     def save_refresh_token(self, refresh_token: str) -> None:
-        try:
-            with open('./src/config/refresh_token.json', 'w') as file:
-                file.write(refresh_token)
-        except FileNotFoundError:
-            raise InvalidDirectoryError(
-                'Directory for saving the refresh token does not exist')
+        self.store.save_refresh_token(refresh_token)
 
     def load_refresh_token(self) -> str:
-        try:
-            with open('./src/config/refresh_token.json', 'r') as file:
-                return file.read()
-        except FileNotFoundError:
+        refresh_token = self.store.load_refresh_token()
+        if not refresh_token:
             self.delete_tokens()
             info = '''
                 Refresh token could not be recovered. 
                 Deleted saved access token.
                 '''
             raise LostRefreshTokenError(info)
+        return refresh_token
 
     def save_tokens(self) -> None:
         debug_logger.debug('Saving token to cache')
         token_information = self.access_token_content
         token_information['expires_at'] = self.expires_at.isoformat()
-        try:
-            with open('./src/config/tokens.json', 'w') as file:
-                json.dump(token_information, file, indent=2)
-        except FileNotFoundError:
-            raise InvalidDirectoryError(
-                'Directory for saving the access token does not exist')
+        self.store.save_tokens(token_information)
 
     def delete_tokens(self) -> None:
-        os.remove('./src/config/tokens.json')
-        os.remove('./src/config/refresh_token.json')
\ No newline at end of file
+        self.store.delete_tokens()
\ No newline at end of file
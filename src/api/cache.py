@@ -0,0 +1,62 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+
+
+class CachedResponse:
+    def __init__(self, body: bytes, generation: Hashable) -> None:
+        self.body = body
+        self.generation = generation
+        self.etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+class ResponseCache:
+    # Entries expire after ttl seconds or as soon as the data generation
+    # changes, i.e. new plays were ingested
+    def __init__(
+            self,
+            ttl: float = 30,
+            max_entries: int = 256,
+            clock: Callable[[], float] = time.monotonic) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.generation = 0
+        self._entries: 'OrderedDict[Hashable, Tuple[float, CachedResponse]]' = (
+            OrderedDict())
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, response = entry
+            if expires_at < self.clock() or response.generation != self.generation:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return response
+
+    def set(self, key: Hashable, body: bytes) -> CachedResponse:
+        with self._lock:
+            response = CachedResponse(body, self.generation)
+            self._entries[key] = (self.clock() + self.ttl, response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return response
+
+    def set_generation(self, generation: Hashable) -> None:
+        with self._lock:
+            if generation != self.generation:
+                self.generation = generation
+                self._entries.clear()
+
+    def invalidate(self, *args) -> None:
+        # Usable as a DatabaseConnection save hook
+        with self._lock:
+            self.generation = (self.generation, self.clock())
+            self._entries.clear()
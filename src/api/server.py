@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+from bson import ObjectId
+
+from ..db_connection import MongoConnection
+from ..history_queries import HistoryQueryRepository
+from ..rollups import ListeningRollups
+from ..logging.logger import info_logger, api_logger
+from .cache import CachedResponse, ResponseCache
+
+STATUS_TEXT = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    500: 'Internal Server Error',
+}
+
+
+class ApiError(Exception):
+    def __init__(self, status: int, msg: str):
+        self.status = status
+        self.msg = msg
+        super().__init__(self.msg)
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f'{type(value)} is not JSON serializable')
+
+
+def _date_param(params: dict, name: str, default: date) -> date:
+    try:
+        return date.fromisoformat(params[name]) if name in params else default
+    except ValueError:
+        raise ApiError(400, f'Invalid date for {name}')
+
+
+def _int_param(params: dict, name: str, default: int, maximum: int) -> int:
+    try:
+        value = int(params.get(name, default))
+    except ValueError:
+        raise ApiError(400, f'Invalid integer for {name}')
+    return max(1, min(value, maximum))
+
+
+class HistoryApi:
+    def __init__(
+            self,
+            database_conn: MongoConnection,
+            max_db_concurrency: int = 4,
+            cache_ttl: float = 30,
+            generation_interval: float = 5) -> None:
+        self.database_conn = database_conn
+        self.history = HistoryQueryRepository(database_conn)
+        self.rollups = ListeningRollups(database_conn)
+        self.cache = ResponseCache(ttl=cache_ttl)
+        self.generation_interval = generation_interval
+        self._generation_checked = 0.0
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_db_concurrency, thread_name_prefix='history-api')
+        self._db_slots = asyncio.Semaphore(max_db_concurrency)
+        # Invalidate immediately when plays are ingested in this process
+        database_conn.add_save_hook(self.cache.invalidate)
+        self.routes: Dict[str, Tuple[Callable[[dict], object], bool]] = {
+            '/plays/recent': (self.recent_plays, False),
+            '/top/artists': (lambda params: self.top('artists', params), True),
+            '/top/tracks': (lambda params: self.top('tracks', params), True),
+            '/stats/daily': (lambda params: self.stats('day', params), True),
+            '/stats/weekly': (lambda params: self.stats('week', params), True),
+        }
+
+    def recent_plays(self, params: dict) -> dict:
+        page = self.history.find(
+            limit=_int_param(params, 'limit', 50, 500),
+            cursor=params.get('cursor'),
+            track_id=params.get('track_id'),
+            artist_id=params.get('artist_id'),
+            album_id=params.get('album_id'),
+            fields=params['fields'].split(',') if 'fields' in params else None)
+        return {'items': page.items, 'next_cursor': page.next_cursor}
+
+    def top(self, kind: str, params: dict) -> dict:
+        end = _date_param(params, 'end', date.today())
+        start = _date_param(params, 'start', end - timedelta(days=27))
+        limit = _int_param(params, 'limit', 10, 100)
+        items = self.rollups.top(kind, start, end, limit)
+        return {'start': start, 'end': end, 'items': [
+            {'id': item_id, 'plays': plays} for item_id, plays in items]}
+
+    def stats(self, period: str, params: dict) -> dict:
+        end = _date_param(params, 'end', date.today())
+        start = _date_param(params, 'start', end - timedelta(days=6))
+        if period == 'day':
+            items = self.rollups.daily(start, end)
+        else:
+            items = self.rollups.weekly(start, end)
+        return {'start': start, 'end': end, 'items': items}
+
+    async def _run_db(self, func: Callable, *args):
+        async with self._db_slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _refresh_generation(self) -> None:
+        # Plays ingested by another process change the newest played_at,
+        # a single indexed lookup every few seconds keeps the cache honest
+        now = time.monotonic()
+        if now - self._generation_checked < self.generation_interval:
+            return
+        self._generation_checked = now
+        newest = await self._run_db(self.history.newest_played_at)
+        self.cache.set_generation(newest)
+
+    async def respond(
+            self, path: str, params: dict, if_none_match: Optional[str]
+            ) -> Tuple[int, bytes, Optional[str]]:
+        if path not in self.routes:
+            raise ApiError(404, f'No route for {path}')
+        handler, cacheable = self.routes[path]
+        await self._refresh_generation()
+        key = (path, tuple(sorted(params.items())))
+        cached = self.cache.get(key) if cacheable else None
+        if cached is None:
+            result = await self._run_db(handler, params)
+            body = json.dumps(result, default=_json_default).encode('utf-8')
+            # Uncached routes still get an ETag, without taking a cache slot
+            cached = self.cache.set(key, body) if cacheable else CachedResponse(
+                body, self.cache.generation)
+        if if_none_match == cached.etag:
+            return 304, b'', cached.etag
+        return 200, cached.body, cached.etag
+
+    async def handle_connection(
+            self,
+            reader: asyncio.StreamReader,
+            writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    content_length = int(headers.get('content-length', 0))
+                    if content_length < 0:
+                        raise ValueError(content_length)
+                except ValueError:
+                    # The rest of the stream cannot be framed, answer and close
+                    await self._write_response(
+                        writer, 400, b'{"error": "Invalid Content-Length"}',
+                        None, False, True)
+                    break
+                if content_length:
+                    await reader.readexactly(content_length)
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._serve_request(
+                    request_line.decode('latin-1'), headers, writer, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_request(
+            self,
+            request_line: str,
+            headers: dict,
+            writer: asyncio.StreamWriter,
+            keep_alive: bool) -> None:
+        etag = None
+        try:
+            method, target, _ = request_line.split(' ', 2)
+            if method not in ('GET', 'HEAD'):
+                raise ApiError(405, f'Method {method} not allowed')
+            url = urlsplit(target)
+            status, body, etag = await self.respond(
+                url.path.rstrip('/') or '/',
+                dict(parse_qsl(url.query)),
+                headers.get('if-none-match'))
+        except ApiError as e:
+            status, body = e.status, json.dumps({'error': e.msg}).encode()
+        except ValueError:
+            status, body = 400, b'{"error": "Malformed request"}'
+        except Exception:
+            api_logger.exception('History API request failed')
+            status, body = 500, b'{"error": "Internal error"}'
+        await self._write_response(
+            writer, status, body, etag, keep_alive,
+            not request_line.startswith('HEAD'))
+
+    async def _write_response(
+            self,
+            writer: asyncio.StreamWriter,
+            status: int,
+            body: bytes,
+            etag: Optional[str],
+            keep_alive: bool,
+            send_body: bool) -> None:
+        head = [
+            f'HTTP/1.1 {status} {STATUS_TEXT[status]}',
+            'Content-Type: application/json',
+            f'Content-Length: {len(body)}',
+            'Cache-Control: no-cache',
+            f'Connection: {"keep-alive" if keep_alive else "close"}',
+        ]
+        if etag:
+            head.append(f'ETag: {etag}')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if send_body:
+            writer.write(body)
+        await writer.drain()
+
+    async def serve(self, host: str = '127.0.0.1', port: int = 8080) -> None:
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        info_logger.info('History API listening on %s:%s', host, port)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Read only HTTP API for the stored play history')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--tbl', default='song_history')
+    parser.add_argument('--user-id', default='default')
+    parser.add_argument('--max-db-concurrency', type=int, default=4)
+    parser.add_argument('--cache-ttl', type=float, default=30)
+    args = parser.parse_args()
+
+    with MongoConnection(
+            db=args.db,
+            tbl=args.tbl,
+            host=os.environ.get('WSL_HOST', 'localhost'),
+            user_id=args.user_id) as database_conn:
+        async def main():
+            api = HistoryApi(
+                database_conn,
+                max_db_concurrency=args.max_db_concurrency,
+                cache_ttl=args.cache_ttl)
+            await api.serve(args.host, args.port)
+        asyncio.run(main())
@@ -0,0 +1,56 @@
+import zlib
+from typing import Dict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class Codec:
+    name = 'none'
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+
+    def __init__(self, level: int = 6) -> None:
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+
+    def __init__(self, level: int = 10) -> None:
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(data)
+
+
+def get_codec(name: str = 'auto') -> Codec:
+    if name == 'auto':
+        name = 'zstd' if zstandard is not None else 'zlib'
+    codecs: Dict[str, type] = {
+        'none': Codec, 'zlib': ZlibCodec, 'zstd': ZstdCodec}
+    if name not in codecs:
+        raise ValueError(f'Unknown codec {name}')
+    if name == 'zstd' and zstandard is None:
+        raise ImportError('The zstd codec requires the zstandard package')
+    return codecs[name]()
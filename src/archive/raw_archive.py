@@ -0,0 +1,205 @@
+import hashlib
+import os
+import sqlite3
+import struct
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from ..logging.logger import info_logger, debug_logger
+from .codecs import Codec, get_codec
+
+RECORD_HEADER = struct.Struct('<I')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    codec TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS responses (
+    id INTEGER PRIMARY KEY,
+    digest TEXT NOT NULL REFERENCES blobs(digest),
+    endpoint TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    fetched_at TEXT NOT NULL,
+    url TEXT
+);
+CREATE INDEX IF NOT EXISTS responses_endpoint
+    ON responses (endpoint, user_id, fetched_at);
+'''
+
+
+class RawResponseArchive:
+    # Response bodies are stored once per sha256 digest in append-only
+    # segment files, every fetch gets a small row in the SQLite index.
+    # Writes are buffered and flushed as one segment append per batch.
+    def __init__(
+            self,
+            directory: str = 'var/archive',
+            codec: str = 'auto',
+            batch_size: int = 50,
+            max_batch_bytes: int = 4 * 1024 * 1024,
+            segment_max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.segment_dir = os.path.join(directory, 'segments')
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.codec = get_codec(codec)
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.segment_max_bytes = segment_max_bytes
+        self._db = sqlite3.connect(
+            os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._pending_blobs: Dict[str, Tuple[bytes, int]] = {}
+        self._pending_responses: List[Tuple] = []
+        self._pending_bytes = 0
+        self._segment: Optional[str] = None
+        self._codecs: Dict[str, Codec] = {self.codec.name: self.codec}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _known(self, digest: str) -> bool:
+        if digest in self._pending_blobs:
+            return True
+        return self._db.execute(
+            'SELECT 1 FROM blobs WHERE digest = ?', (digest,)
+            ).fetchone() is not None
+
+    def store(
+            self,
+            endpoint: str,
+            body: bytes,
+            user_id: str = 'default',
+            url: Optional[str] = None,
+            fetched_at: Optional[datetime] = None) -> str:
+        digest = hashlib.sha256(body).hexdigest()
+        fetched_at = fetched_at or datetime.now(timezone.utc)
+        with self._lock:
+            if not self._known(digest):
+                compressed = self.codec.compress(body)
+                self._pending_blobs[digest] = (compressed, len(body))
+                self._pending_bytes += len(compressed)
+            self._pending_responses.append(
+                (digest, endpoint, user_id, fetched_at.isoformat(), url))
+            if (len(self._pending_responses) >= self.batch_size
+                    or self._pending_bytes >= self.max_batch_bytes):
+                self._flush()
+        return digest
+
+    def _current_segment(self) -> str:
+        if self._segment is not None:
+            path = os.path.join(self.segment_dir, self._segment)
+            if os.path.getsize(path) < self.segment_max_bytes:
+                return self._segment
+        now = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+        self._segment = f'{now}.seg'
+        open(os.path.join(self.segment_dir, self._segment), 'ab').close()
+        return self._segment
+
+    def _flush(self) -> None:
+        if not self._pending_responses:
+            return
+        blob_rows = []
+        if self._pending_blobs:
+            segment = self._current_segment()
+            path = os.path.join(self.segment_dir, segment)
+            chunks = []
+            with open(path, 'ab') as file:
+                offset = file.tell()
+                for digest, (compressed, size) in self._pending_blobs.items():
+                    chunks.append(RECORD_HEADER.pack(len(compressed)))
+                    chunks.append(compressed)
+                    offset += RECORD_HEADER.size
+                    blob_rows.append((
+                        digest, segment, offset, len(compressed), size,
+                        self.codec.name))
+                    offset += len(compressed)
+                file.write(b''.join(chunks))
+                file.flush()
+                os.fsync(file.fileno())
+        with self._db:
+            self._db.executemany(
+                'INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?, ?, ?)',
+                blob_rows)
+            self._db.executemany(
+                'INSERT INTO responses (digest, endpoint, user_id, fetched_at, url) '
+                'VALUES (?, ?, ?, ?, ?)',
+                self._pending_responses)
+        debug_logger.debug(
+            'Archived %d responses, %d new blobs',
+            len(self._pending_responses), len(blob_rows))
+        self._pending_blobs = {}
+        self._pending_responses = []
+        self._pending_bytes = 0
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def load(self, digest: str) -> bytes:
+        with self._lock:
+            pending = self._pending_blobs.get(digest)
+            if pending is not None:
+                return self.codec.decompress(pending[0])
+            row = self._db.execute(
+                'SELECT segment, offset, length, codec FROM blobs '
+                'WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            raise KeyError(digest)
+        segment, offset, length, codec_name = row
+        with open(os.path.join(self.segment_dir, segment), 'rb') as file:
+            file.seek(offset)
+            compressed = file.read(length)
+        if codec_name not in self._codecs:
+            self._codecs[codec_name] = get_codec(codec_name)
+        return self._codecs[codec_name].decompress(compressed)
+
+    def iter_responses(
+            self,
+            endpoint: Optional[str] = None,
+            user_id: Optional[str] = None,
+            start: Optional[datetime] = None,
+            end: Optional[datetime] = None,
+            after_id: int = 0) -> Iterator[Tuple[dict, bytes]]:
+        self.flush()
+        query = ('SELECT id, digest, endpoint, user_id, fetched_at, url '
+                 'FROM responses WHERE id > ?')
+        params = [after_id]
+        for column, operator, value in (
+                ('endpoint', '=', endpoint),
+                ('user_id', '=', user_id),
+                ('fetched_at', '>=', start and start.isoformat()),
+                ('fetched_at', '<', end and end.isoformat())):
+            if value is not None:
+                query += f' AND {column} {operator} ?'
+                params.append(value)
+        cursor = self._db.execute(query + ' ORDER BY id', params)
+        while True:
+            rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            for row_id, digest, row_endpoint, row_user, fetched_at, url in rows:
+                meta = {
+                    'id': row_id,
+                    'digest': digest,
+                    'endpoint': row_endpoint,
+                    'user_id': row_user,
+                    'fetched_at': fetched_at,
+                    'url': url,
+                }
+                yield meta, self.load(digest)
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            self._db.close()
+        info_logger.info('Closed raw response archive %s', self.directory)
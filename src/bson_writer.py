@@ -0,0 +1,255 @@
+import argparse
+import struct
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import bson
+import pydantic
+from bson import ObjectId
+from bson.raw_bson import RawBSONDocument
+
+from .logging.logger import debug_logger
+
+_INT32 = struct.Struct('<i')
+_INT64 = struct.Struct('<q')
+_DOUBLE = struct.Struct('<d')
+_INT32_MIN, _INT32_MAX = -2 ** 31, 2 ** 31 - 1
+# Array keys are the decimal positions, encoded once
+_ARRAY_KEYS = [str(position).encode() + b'\x00' for position in range(1024)]
+# Leaves room for the OP_MSG header and the insert command itself
+MESSAGE_OVERHEAD = 16 * 1024
+
+
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _datetime_ms(value: datetime) -> int:
+    # Same conversion as bson: aware values are shifted to UTC, naive
+    # ones are taken as UTC
+    delta = value - (_EPOCH if value.tzinfo is None else _EPOCH_UTC)
+    return (delta.days * 86400000 + delta.seconds * 1000
+            + delta.microseconds // 1000)
+
+
+class BsonEncoder:
+    # Writes pydantic models straight into one reusable bytearray in the
+    # byte layout bson.encode(model.dict()) produces, without building the
+    # dict. Field names are encoded once per model class. Types that are
+    # not handled here fall back to bson for that value.
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self._keys: Dict[type, List[Tuple[str, bytes]]] = {}
+        self._writers: Dict[type, Callable] = {
+            str: self._write_str,
+            bool: self._write_bool,
+            int: self._write_int,
+            float: self._write_float,
+            datetime: self._write_datetime,
+            type(None): self._write_none,
+            list: self._write_list,
+            tuple: self._write_list,
+            dict: self._write_dict,
+            ObjectId: self._write_object_id,
+        }
+
+    def _model_keys(self, model_class: type) -> List[Tuple[str, bytes]]:
+        keys = self._keys.get(model_class)
+        if keys is None:
+            keys = self._keys[model_class] = [
+                (name, name.encode() + b'\x00')
+                for name in model_class.__fields__]
+        return keys
+
+    def _write_value(self, key: bytes, value) -> None:
+        writer = self._writers.get(type(value))
+        if writer is None:
+            writer = self._write_embedded if isinstance(
+                value, pydantic.BaseModel) else self._write_fallback
+            self._writers[type(value)] = writer
+        writer(key, value)
+
+    def _write_embedded(self, key: bytes, value: pydantic.BaseModel) -> None:
+        self.buffer += b'\x03' + key
+        self._write_model(value)
+
+    def _write_str(self, key: bytes, value: str) -> None:
+        encoded = value.encode()
+        self.buffer += b'\x02' + key + _INT32.pack(len(encoded) + 1) \
+            + encoded + b'\x00'
+
+    def _write_bool(self, key: bytes, value: bool) -> None:
+        self.buffer += b'\x08' + key + (b'\x01' if value else b'\x00')
+
+    def _write_int(self, key: bytes, value: int) -> None:
+        if _INT32_MIN <= value <= _INT32_MAX:
+            self.buffer += b'\x10' + key + _INT32.pack(value)
+        else:
+            self.buffer += b'\x12' + key + _INT64.pack(value)
+
+    def _write_float(self, key: bytes, value: float) -> None:
+        self.buffer += b'\x01' + key + _DOUBLE.pack(value)
+
+    def _write_datetime(self, key: bytes, value: datetime) -> None:
+        self.buffer += b'\x09' + key + _INT64.pack(_datetime_ms(value))
+
+    def _write_none(self, key: bytes, value: None) -> None:
+        self.buffer += b'\x0a' + key
+
+    def _write_object_id(self, key: bytes, value: ObjectId) -> None:
+        self.buffer += b'\x07' + key + value.binary
+
+    def _write_list(self, key: bytes, values: list) -> None:
+        self.buffer += b'\x04' + key
+        start = len(self.buffer)
+        self.buffer += b'\x00\x00\x00\x00'
+        for position, value in enumerate(values):
+            self._write_value(
+                _ARRAY_KEYS[position] if position < len(_ARRAY_KEYS)
+                else str(position).encode() + b'\x00', value)
+        self._close(start)
+
+    def _write_dict(self, key: bytes, value: dict) -> None:
+        self.buffer += b'\x03' + key
+        self._write_mapping(value.items())
+
+    def _write_fallback(self, key: bytes, value) -> None:
+        # Let bson encode a one field document and copy the element
+        encoded = bson.encode({'v': value})
+        self.buffer += encoded[4:5] + key + encoded[7:-1]
+
+    def _close(self, start: int) -> None:
+        self.buffer += b'\x00'
+        _INT32.pack_into(self.buffer, start, len(self.buffer) - start)
+
+    def _write_mapping(self, items: Iterable[Tuple[str, object]]) -> None:
+        start = len(self.buffer)
+        self.buffer += b'\x00\x00\x00\x00'
+        for name, value in items:
+            self._write_value(name.encode() + b'\x00', value)
+        self._close(start)
+
+    def _write_model(
+            self,
+            model: pydantic.BaseModel,
+            first: Optional[Tuple[bytes, object]] = None,
+            extra: Optional[dict] = None) -> None:
+        start = len(self.buffer)
+        self.buffer += b'\x00\x00\x00\x00'
+        if first is not None:
+            self._write_value(*first)
+        buffer = self.buffer
+        values = model.__dict__
+        for name, key in self._model_keys(type(model)):
+            value = values[name]
+            # Strings are most of a play, written inline
+            if type(value) is str:
+                encoded = value.encode()
+                buffer += b'\x02' + key + _INT32.pack(len(encoded) + 1) \
+                    + encoded + b'\x00'
+            else:
+                self._write_value(key, value)
+        if extra:
+            for name, value in extra.items():
+                self._write_value(name.encode() + b'\x00', value)
+        self._close(start)
+
+    def encode(
+            self,
+            model: pydantic.BaseModel,
+            _id: Optional[ObjectId] = None,
+            extra: Optional[dict] = None) -> bytes:
+        # _id first, as pymongo writes it, then the model fields and extra
+        self.buffer.clear()
+        self._write_model(
+            model, None if _id is None else (b'_id\x00', _id), extra)
+        return bytes(self.buffer)
+
+    def encode_many(
+            self,
+            models: Iterable[pydantic.BaseModel],
+            extra: Optional[dict] = None) -> List[RawBSONDocument]:
+        # The buffer keeps its allocation between documents and calls
+        documents = []
+        for model in models:
+            documents.append(RawBSONDocument(
+                self.encode(model, ObjectId(), extra)))
+        return documents
+
+
+def batches(
+        documents: List[RawBSONDocument],
+        max_message_size: int = 48000000,
+        max_batch_size: int = 100000) -> Iterator[List[RawBSONDocument]]:
+    # Splits raw documents so every insert fits into one server message
+    limit = max_message_size - MESSAGE_OVERHEAD
+    batch: List[RawBSONDocument] = []
+    size = 0
+    for document in documents:
+        length = len(document.raw)
+        if batch and (size + length > limit or len(batch) == max_batch_size):
+            yield batch
+            batch, size = [], 0
+        batch.append(document)
+        size += length
+    if batch:
+        yield batch
+
+
+def _benchmark(plays: int, runs: int) -> None:
+    from .spotify_data.dataclasses import SpotifyHistoryObject
+    models = [SpotifyHistoryObject(**{
+        'played_at': f'2021-07-{1 + index % 28:02d}T10:{index % 60:02d}:00.000Z',
+        'track': {
+            'artists': [{'id': f'artist{index % 50}', 'name': 'Artist'},
+                        {'id': 'featured', 'name': 'Featured Artist'}],
+            'album': {
+                'album_type': 'album',
+                'artists': [{'id': f'artist{index % 50}', 'name': 'Artist'}],
+                'id': f'album{index % 200}', 'name': 'Album name',
+                'release_date': '2020-01-01'},
+            'duration_ms': 180000 + index, 'explicit': False,
+            'href': f'https://api.spotify.com/v1/tracks/track{index}',
+            'id': f'track{index}', 'name': f'Track {index}', 'popularity': 50},
+        'context': {'type': 'playlist', 'uri': 'spotify:playlist:x'},
+    }) for index in range(plays)]
+    encoder = BsonEncoder()
+    extra = {'schema_version': 1}
+
+    def dict_path():
+        # What MongoConnection.save_many did before, up to the wire format
+        documents = [{**model.dict(), **extra} for model in models]
+        for document in documents:
+            document['_id'] = ObjectId()
+        return [bson.encode(document) for document in documents]
+
+    def raw_path():
+        return [document.raw for document in encoder.encode_many(models, extra)]
+
+    for name, path in (('dict', dict_path), ('raw', raw_path)):
+        cpu = min(_measure_cpu(path) for _ in range(runs))
+        tracemalloc.start()
+        path()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        scale = 10000 / plays
+        print(f'{name:5s} {cpu * scale * 1000:8.1f} ms CPU '
+              f'{peak * scale / 2 ** 20:8.2f} MiB peak per 10k plays')
+
+
+def _measure_cpu(path: Callable) -> float:
+    started = time.process_time()
+    path()
+    return time.process_time() - started
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare the dict and raw BSON write paths')
+    parser.add_argument('--plays', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    debug_logger.disabled = True
+    _benchmark(args.plays, args.runs)
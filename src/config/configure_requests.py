@@ -1,25 +1,147 @@
+import threading
+from typing import Dict, Optional
+
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.connectionpool import (
+    HTTPConnectionPool, HTTPSConnectionPool)
 import http
 
-def configure_request(debug_level: int = 0, retries: int = 3) -> requests.Session:
-    http.client.HTTPConnection.debuglevel = debug_level
+DEFAULT_HOST_POOL_SIZES = {
+    'api.spotify.com': 32,
+    'accounts.spotify.com': 4,
+}
+
+
+class _CountingPoolMixin:
+    waited = 0
+
+    def _get_conn(self, timeout=None):
+        if self.pool is not None and self.pool.empty():
+            self.waited += 1
+        return super()._get_conn(timeout=timeout)
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class _CountingAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+    def pool_stats(self) -> Dict[str, dict]:
+        stats = {}
+        pools = self.poolmanager.pools
+        with pools.lock:
+            connection_pools = list(pools._container.values())
+        for pool in connection_pools:
+            idle = sum(
+                1 for conn in list(pool.pool.queue) if conn is not None
+                ) if pool.pool is not None else 0
+            stats[f'{pool.scheme}://{pool.host}:{pool.port}'] = {
+                'maxsize': pool.pool.maxsize if pool.pool is not None else 0,
+                'opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'reused': max(0, pool.num_requests - pool.num_connections),
+                'idle': idle,
+                'waited': pool.waited,
+            }
+        return stats
+
+
+def _assert_status_hook(response, *args, **kwargs):
+    response.raise_for_status()
+
+
+class SessionManager:
+    def __init__(
+            self,
+            host_pool_sizes: Optional[Dict[str, int]] = None,
+            default_pool_size: int = 10,
+            pool_block: bool = False,
+            retries: int = 0,
+            debug_level: int = 0) -> None:
+        http.client.HTTPConnection.debuglevel = debug_level
+        self.debug_level = debug_level
+        self.host_pool_sizes = (
+            DEFAULT_HOST_POOL_SIZES if host_pool_sizes is None
+            else host_pool_sizes)
+        self.default_pool_size = default_pool_size
+        self.pool_block = pool_block
+        self.retries = retries
+        self.adapters: Dict[str, _CountingAdapter] = {}
+        self.session = self._create_session()
+
+    # Retries are handled by src.retry_policy, the adapter only retries
+    # connection setup when explicitly configured
+    def _create_adapter(self, pool_size: int) -> _CountingAdapter:
+        return _CountingAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            pool_block=self.pool_block,
+            max_retries=Retry(total=self.retries))
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        session.hooks['response'] = [_assert_status_hook]
+        session.headers.update({
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+        })
+        default_adapter = self._create_adapter(self.default_pool_size)
+        self.adapters['default'] = default_adapter
+        session.mount('https://', default_adapter)
+        session.mount('http://', default_adapter)
+        for host, pool_size in self.host_pool_sizes.items():
+            adapter = self._create_adapter(pool_size)
+            self.adapters[host] = adapter
+            session.mount(f'https://{host}', adapter)
+        return session
+
+    def pool_stats(self) -> Dict[str, dict]:
+        stats = {}
+        for adapter in self.adapters.values():
+            stats.update(adapter.pool_stats())
+        return stats
 
-    request_session = requests.Session()
+    def close(self) -> None:
+        self.session.close()
 
-    assert_status_hook = (lambda response, *args, **kwargs: 
-                            response.raise_for_status())
-    request_session.hooks['response'] = [assert_status_hook]
 
-    retry_strategy = Retry(
-        total=retries
-    )
+_session_manager: Optional[SessionManager] = None
+_session_lock = threading.Lock()
 
-    adapter = HTTPAdapter(max_retries=retry_strategy)
-    request_session.mount("https://", adapter)
-    request_session.mount("http://", adapter)
 
-    return request_session
+def get_session_manager(**kwargs) -> SessionManager:
+    # The manager is shared by the whole process, settings can only be
+    # chosen by the first caller
+    global _session_manager
+    with _session_lock:
+        if _session_manager is None:
+            _session_manager = SessionManager(**kwargs)
+        else:
+            if kwargs.get('host_pool_sizes', 0) is None:
+                kwargs['host_pool_sizes'] = DEFAULT_HOST_POOL_SIZES
+            differing = {
+                name: value for name, value in kwargs.items()
+                if getattr(_session_manager, name) != value}
+            if differing:
+                raise ValueError(
+                    f'Session manager already created with other settings, '
+                    f'cannot apply {differing}')
+        return _session_manager
 
 
+def configure_request(debug_level: int = 0, retries: int = 0) -> requests.Session:
+    return get_session_manager(
+        debug_level=debug_level, retries=retries).session
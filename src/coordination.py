@@ -0,0 +1,246 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterable, List, Optional
+
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.database import Database
+
+from .db_connection import MongoClientManager
+from .errors.database_errors import LeaseLost
+from .logging.logger import info_logger, debug_logger
+
+
+def _rank(user_id: str, worker_id: str) -> bytes:
+    return hashlib.sha1(f'{user_id}:{worker_id}'.encode()).digest()
+
+
+def assign(user_ids: Iterable[str], worker_ids: Iterable[str]) -> Dict[str, str]:
+    # Rendezvous hashing with bounded load: every user takes its highest
+    # ranked worker that is not full yet. Every worker computes the same
+    # result from the same inputs, no worker gets more than
+    # ceil(users / workers) and a joining or leaving worker moves few users.
+    worker_ids = sorted(set(worker_ids))
+    user_ids = sorted(set(user_ids))
+    if not worker_ids:
+        return {}
+    capacity = -(-len(user_ids) // len(worker_ids))
+    load = dict.fromkeys(worker_ids, 0)
+    assignment = {}
+    for user_id in user_ids:
+        for worker_id in sorted(
+                worker_ids,
+                key=lambda worker_id: _rank(user_id, worker_id),
+                reverse=True):
+            if load[worker_id] < capacity:
+                assignment[user_id] = worker_id
+                load[worker_id] += 1
+                break
+    return assignment
+
+
+class Coordinator:
+    # Workers announce themselves with a heartbeat in `workers` and own
+    # users through leases in `user_leases`. Both expire after
+    # lease_seconds without a heartbeat, so a crashed worker's users are
+    # claimed by the live workers on their next rebalance. The lease token
+    # is incremented on every claim and fences the ingestion checkpoint.
+    def __init__(
+            self,
+            database: Database,
+            worker_id: Optional[str] = None,
+            lease_seconds: float = 90,
+            workers_tbl: str = 'workers',
+            leases_tbl: str = 'user_leases') -> None:
+        self.worker_id = worker_id or (
+            f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}')
+        self.lease_seconds = lease_seconds
+        self.workers = database[workers_tbl]
+        self.leases = database[leases_tbl]
+        MongoClientManager.ensure_indexes(
+            self.leases, [IndexModel([('owner', ASCENDING)], name='owner')])
+        self.owned: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._heartbeat_thread: Optional[threading.Thread] = None
+
+    def _expires_at(self, now: datetime) -> datetime:
+        return now + timedelta(seconds=self.lease_seconds)
+
+    def register_users(self, user_ids: Iterable[str]) -> None:
+        for user_id in user_ids:
+            self.leases.update_one(
+                {'_id': user_id},
+                {'$setOnInsert': {
+                    'owner': None, 'token': 0, 'expires_at': datetime.min,
+                    'cycle': -1}},
+                upsert=True)
+
+    def heartbeat(self, now: Optional[datetime] = None) -> None:
+        now = now or datetime.utcnow()
+        expires_at = self._expires_at(now)
+        self.workers.update_one(
+            {'_id': self.worker_id},
+            {'$set': {'expires_at': expires_at, 'heartbeat_at': now},
+             '$setOnInsert': {'started_at': now}},
+            upsert=True)
+        self.leases.update_many(
+            {'owner': self.worker_id}, {'$set': {'expires_at': expires_at}})
+        debug_logger.debug('Heartbeat of worker %s', self.worker_id)
+
+    def live_workers(self, now: Optional[datetime] = None) -> List[str]:
+        now = now or datetime.utcnow()
+        return sorted(
+            worker['_id'] for worker in self.workers.find(
+                {'expires_at': {'$gt': now}}, projection={'_id': 1}))
+
+    def rebalance(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        # Releases users assigned to other workers and claims free, expired
+        # or orphaned leases assigned to this one. Returns user -> token.
+        now = now or datetime.utcnow()
+        live = self.live_workers(now)
+        leases = list(self.leases.find({}))
+        assignment = assign((lease['_id'] for lease in leases), live)
+        owned = {}
+        for lease in leases:
+            user_id = lease['_id']
+            target = assignment.get(user_id)
+            if lease['owner'] == self.worker_id:
+                if target == self.worker_id:
+                    owned[user_id] = lease['token']
+                    continue
+                self.leases.update_one(
+                    {'_id': user_id, 'owner': self.worker_id,
+                     'token': lease['token']},
+                    {'$set': {'owner': None, 'expires_at': now}})
+                info_logger.info('Released user %s to %s', user_id, target)
+            elif target == self.worker_id and (
+                    lease['owner'] is None
+                    or lease['owner'] not in live
+                    or lease['expires_at'] <= now):
+                # Compare and swap on the token, only one worker can win
+                claimed = self.leases.find_one_and_update(
+                    {'_id': user_id, 'token': lease['token']},
+                    {'$set': {'owner': self.worker_id,
+                              'expires_at': self._expires_at(now)},
+                     '$inc': {'token': 1}},
+                    return_document=ReturnDocument.AFTER)
+                if claimed is not None:
+                    owned[user_id] = claimed['token']
+                    info_logger.info(
+                        'Claimed user %s from %s with token %d',
+                        user_id, lease['owner'], claimed['token'])
+        self.owned = owned
+        return owned
+
+    def begin(self, user_id: str, cycle: int) -> Optional[int]:
+        # Renews the lease and returns its token if this worker still owns
+        # the user and the cycle was not completed yet
+        now = datetime.utcnow()
+        lease = self.leases.find_one_and_update(
+            {'_id': user_id, 'owner': self.worker_id,
+             'token': self.owned.get(user_id), 'cycle': {'$lt': cycle}},
+            {'$set': {'expires_at': self._expires_at(now)}},
+            return_document=ReturnDocument.AFTER)
+        return None if lease is None else lease['token']
+
+    def complete(
+            self,
+            user_id: str,
+            token: int,
+            cycle: int,
+            failed: bool = False) -> None:
+        # A failed attempt also uses up the cycle, the user is tried again
+        # in the next one instead of on every poll
+        result = self.leases.update_one(
+            {'_id': user_id, 'owner': self.worker_id, 'token': token},
+            {'$set': {'cycle': cycle, 'completed_at': datetime.utcnow(),
+                      'failed': failed}})
+        if not result.matched_count:
+            raise LeaseLost(f'Lease of user {user_id} was taken over')
+
+    def start_heartbeat(self) -> None:
+        self.heartbeat()
+
+        def beat() -> None:
+            while not self._stop.wait(self.lease_seconds / 3):
+                try:
+                    self.heartbeat()
+                except Exception:
+                    info_logger.exception(
+                        'Heartbeat of worker %s failed', self.worker_id)
+
+        self._heartbeat_thread = threading.Thread(
+            target=beat, name='heartbeat', daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop(self) -> None:
+        # Hands the users over right away instead of after lease expiry
+        self._stop.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+        now = datetime.utcnow()
+        self.leases.update_many(
+            {'owner': self.worker_id},
+            {'$set': {'owner': None, 'expires_at': now}})
+        self.workers.delete_one({'_id': self.worker_id})
+        info_logger.info('Worker %s stopped', self.worker_id)
+
+
+class IngestionWorker:
+    # Runs ingest(user_id, token) once per user and cycle for the users
+    # this worker owns; cycles are interval_seconds wide and numbered from
+    # the epoch, so all workers agree on them.
+    def __init__(
+            self,
+            coordinator: Coordinator,
+            ingest: Callable[[str, int], int],
+            interval_seconds: float = 300) -> None:
+        self.coordinator = coordinator
+        self.ingest = ingest
+        self.interval_seconds = interval_seconds
+
+    def current_cycle(self) -> int:
+        return int(time.time() // self.interval_seconds)
+
+    def run_cycle(self) -> Dict[str, str]:
+        cycle = self.current_cycle()
+        results = {}
+        for user_id in sorted(self.coordinator.rebalance()):
+            token = self.coordinator.begin(user_id, cycle)
+            if token is None:
+                results[user_id] = 'skipped'
+                continue
+            try:
+                saved = self.ingest(user_id, token)
+                self.coordinator.complete(user_id, token, cycle)
+                results[user_id] = f'{saved} plays'
+            except LeaseLost:
+                results[user_id] = 'lost'
+            except Exception:
+                info_logger.exception('Ingestion for user %s failed', user_id)
+                results[user_id] = 'failed'
+                try:
+                    self.coordinator.complete(
+                        user_id, token, cycle, failed=True)
+                except LeaseLost:
+                    results[user_id] = 'lost'
+        info_logger.info('Cycle %d: %s', cycle, results)
+        return results
+
+    def run_forever(self, poll_seconds: Optional[float] = None) -> None:
+        # Rebalances more often than it ingests, so crashed workers' users
+        # are picked up within the cycle
+        poll_seconds = poll_seconds or self.coordinator.lease_seconds / 3
+        self.coordinator.start_heartbeat()
+        try:
+            while True:
+                self.run_cycle()
+                time.sleep(poll_seconds)
+        except KeyboardInterrupt:
+            info_logger.info('Interrupted')
+        finally:
+            self.coordinator.stop()
@@ -1,18 +1,42 @@
+import atexit
+import logging
+import threading
 import pydantic
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import MongoClient, IndexModel, ReplaceOne, ASCENDING, DESCENDING
+from pymongo.collection import Collection
 from abc import ABC, abstractmethod
 import pymongo
 import pytz
-from typing import List
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 from datetime import datetime
 
 from .logging.logger import info_logger, debug_logger
-from .errors.database_errors import DbConnectionTimeout, DbInvalidName
+from .errors.database_errors import DbConnectionTimeout, DbInvalidName, LeaseLost
+from .profiling import phase
+from .migrations.schema import SCHEMA_VERSION, VERSION_FIELD, upgrade
+from .tracing import tracer
+from .bson_writer import BsonEncoder, batches
 
 class DatabaseConnection(ABC):
 
     def __init__(self) -> None:
         self.conn = self._create_connection()
+        self.save_hooks: List[Callable[[List[pydantic.BaseModel]], None]] = []
+
+    def add_save_hook(
+            self, hook: Callable[[List[pydantic.BaseModel]], None]) -> None:
+        self.save_hooks.append(hook)
+
+    def _run_save_hooks(self, data: List[pydantic.BaseModel]) -> None:
+        # Hooks run after the batch is committed, a failing hook must not
+        # fail the ingestion run
+        for hook in self.save_hooks:
+            try:
+                hook(data)
+            except Exception:
+                info_logger.exception(
+                    'Save hook %s failed', getattr(hook, '__qualname__', hook))
 
     def __enter__(self):
         return self
@@ -40,6 +64,133 @@ class DatabaseConnection(ABC):
     def find_newest(self):
         pass
 
+    @abstractmethod
+    def find_many(self):
+        pass
+
+    @abstractmethod
+    def replace_many(self):
+        pass
+
+    @abstractmethod
+    def load_checkpoint(self):
+        pass
+
+    @abstractmethod
+    def save_checkpoint(self):
+        pass
+
+# _id follows played_at in every index, it breaks ties of the history
+# keyset cursor
+DEFAULT_INDEXES = [
+    IndexModel(
+        [('played_at', DESCENDING), ('_id', DESCENDING)],
+        name='played_at_id_desc'),
+    IndexModel(
+        [('track.id', ASCENDING), ('played_at', DESCENDING),
+         ('_id', DESCENDING)],
+        name='track_played_at_id'),
+    IndexModel(
+        [('track.artists.id', ASCENDING), ('played_at', DESCENDING),
+         ('_id', DESCENDING)],
+        name='artist_played_at_id'),
+    IndexModel(
+        [('track.album.id', ASCENDING), ('played_at', DESCENDING),
+         ('_id', DESCENDING)],
+        name='album_played_at_id'),
+    # Migration runners walk the documents below a version in _id order
+    IndexModel(
+        [(VERSION_FIELD, ASCENDING), ('_id', ASCENDING)],
+        name='schema_version_id'),
+]
+TIME_SERIES_INDEXES = [
+    IndexModel(
+        [('meta.user_id', ASCENDING), ('played_at', DESCENDING),
+         ('_id', DESCENDING)],
+        name='user_played_at_id'),
+]
+
+class MongoClientManager:
+    # One pooled client per server and pool configuration for the whole
+    # process, the server version is read once during the handshake
+    _clients: Dict[Tuple, MongoClient] = {}
+    _versions: Dict[int, str] = {}
+    _indexed: Set[Tuple[int, str, str]] = set()
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_client(
+            cls,
+            host: str,
+            port: int,
+            max_pool_size: int = 100,
+            server_selection_timeout_ms: int = 5000,
+            connect_timeout_ms: int = 5000) -> MongoClient:
+        key = (host, port, max_pool_size,
+               server_selection_timeout_ms, connect_timeout_ms)
+        with cls._lock:
+            client = cls._clients.get(key)
+            if client is not None:
+                return client
+            client = MongoClient(
+                host, port,
+                maxPoolSize=max_pool_size,
+                serverSelectionTimeoutMS=server_selection_timeout_ms,
+                connectTimeoutMS=connect_timeout_ms)
+            try:
+                version = client.server_info()['version']
+            except pymongo.errors.ServerSelectionTimeoutError:
+                client.close()
+                raise
+            debug_logger.debug('Connecting to MongoDb Version: %s', version)
+            cls._versions[id(client)] = version
+            cls._clients[key] = client
+            return client
+
+    @classmethod
+    def server_version(cls, client: MongoClient) -> Optional[str]:
+        return cls._versions.get(id(client))
+
+    @classmethod
+    def limits(cls, client: MongoClient) -> Dict[str, int]:
+        # Taken from the handshake of a known server, otherwise the defaults
+        # every server version since 3.6 reports
+        limits = {'max_message_size': 48000000, 'max_batch_size': 100000}
+        for server in client.topology_description.server_descriptions(
+                ).values():
+            if server.is_writable:
+                limits = {'max_message_size': server.max_message_size,
+                          'max_batch_size': server.max_write_batch_size}
+        return limits
+
+    @classmethod
+    def ensure_indexes(
+            cls, collection: Collection, indexes: List[IndexModel]) -> None:
+        key = (id(collection.database.client),
+               collection.database.name, collection.name)
+        if key in cls._indexed:
+            return
+        if indexes:
+            # createIndexes is a no-op for indexes that already exist
+            collection.create_indexes(indexes)
+            debug_logger.debug(
+                'Ensured %d indexes on %s', len(indexes), collection.full_name)
+        with cls._lock:
+            cls._indexed.add(key)
+
+    @classmethod
+    def close_all(cls) -> None:
+        with cls._lock:
+            for client in cls._clients.values():
+                debug_logger.debug(
+                    'Disconnecting MongoDb Version: %s',
+                    cls._versions.pop(id(client), None))
+                client.close()
+            cls._clients.clear()
+            cls._indexed.clear()
+
+atexit.register(MongoClientManager.close_all)
+
 class MongoConnection(DatabaseConnection):
 
     def __init__(
@@ -47,63 +198,278 @@ class MongoConnection(DatabaseConnection):
             db: str, 
             tbl: str, 
             host: str = 'localhost', 
-            port: int = 27017) -> None:
+            port: int = 27017,
+            max_pool_size: int = 100,
+            server_selection_timeout_ms: int = 5000,
+            connect_timeout_ms: int = 5000,
+            indexes: Optional[List[IndexModel]] = None,
+            user_id: str = 'default',
+            time_series: bool = False,
+            granularity: str = 'minutes',
+            checkpoint_tbl: str = 'ingestion_checkpoints',
+            pending_replacements_tbl: str = 'pending_replacements',
+            fence_token: Optional[int] = None,
+            raw_bson: bool = False) -> None:
 
         self.db = db
         self.tbl = tbl
         self.host = host
         self.port = port
+        self.max_pool_size = max_pool_size
+        self.server_selection_timeout_ms = server_selection_timeout_ms
+        self.connect_timeout_ms = connect_timeout_ms
+        self.indexes = DEFAULT_INDEXES if indexes is None else indexes
+        if time_series:
+            self.indexes = self.indexes + TIME_SERIES_INDEXES
+        if fence_token is not None and not time_series:
+            # Plays are only stamped with and scoped to their user in the
+            # time series collection
+            raise ValueError(
+                'Fenced ingestion of several users needs time_series=True')
+        self.user_id = user_id
+        self.time_series = time_series
+        self.granularity = granularity
+        self.fence_token = fence_token
+        # Encode models straight to BSON instead of through .dict()
+        self.encoder = BsonEncoder() if raw_bson else None
         super().__init__()
         self.collection = self._define_collection(db, tbl)
+        self.checkpoints = self.conn[db][checkpoint_tbl]
+        self.checkpoint_id = f'{tbl}:{user_id}'
+        self.pending_replacements = self.conn[db][pending_replacements_tbl]
 
 
     def _create_connection(self) -> MongoClient:
         try:
-            client = MongoClient(self.host, self.port)
-            debug_logger.debug(
-                f'Connecting to MongoDb Version: ' + 
-                f'{client.server_info()["version"]}')
-            return client
+            return MongoClientManager.get_client(
+                self.host, self.port,
+                max_pool_size=self.max_pool_size,
+                server_selection_timeout_ms=self.server_selection_timeout_ms,
+                connect_timeout_ms=self.connect_timeout_ms)
         except pymongo.errors.ServerSelectionTimeoutError as e:
             info = f'Timeout for {self.host}:{self.port}, server not reachable'
             raise DbConnectionTimeout(info)
         except:
             raise
 
-    def _define_collection(self, db: str, tbl: str) -> MongoClient:
-        if db not in {database['name'] for database in self.conn.list_databases()}:
-            info_logger.warn(
-                f'Database {db} does not exist and will be created')
-        if tbl not in {coll for coll in self.conn[db].list_collection_names()}:
-            info_logger.warn(
-                f'Collection {tbl} does not exist and will be created')
+    def _define_collection(self, db: str, tbl: str) -> Collection:
         try:
-            return self.conn[db][tbl]
+            collection = self.conn[db][tbl]
         except pymongo.errors.InvalidName as e:
             raise DbInvalidName(str(e))
+        if self.time_series:
+            self._create_time_series_collection(db, tbl)
+        MongoClientManager.ensure_indexes(collection, self.indexes)
+        return collection
+
+    def _create_time_series_collection(self, db: str, tbl: str) -> None:
+        try:
+            self.conn[db].create_collection(
+                tbl,
+                timeseries={
+                    'timeField': 'played_at',
+                    'metaField': 'meta',
+                    'granularity': self.granularity,
+                })
+            info_logger.info(
+                'Created time series collection %s:%s', db, tbl)
+        except pymongo.errors.CollectionInvalid:
+            debug_logger.debug('Collection %s:%s already exists', db, tbl)
+
+    def _extra_fields(self) -> dict:
+        extra = {VERSION_FIELD: SCHEMA_VERSION}
+        if self.time_series:
+            extra['meta'] = {'user_id': self.user_id}
+        return extra
+
+    def _to_document(self, data: pydantic.BaseModel) -> dict:
+        document = data.dict()
+        document.update(self._extra_fields())
+        return document
+
+    @property
+    def server_version(self) -> Optional[str]:
+        return MongoClientManager.server_version(self.conn)
 
     def close_connection(self) -> None:
+        # The pooled client is shared and closed once at interpreter exit
         debug_logger.debug(
-                f'Disconnecting MongoDb Version: ' + 
-                f'{self.conn.server_info()["version"]}')
-        self.conn.close()
+            'Releasing connection to %s:%s', self.db, self.tbl)
+
+    def _scoped(self, query: dict) -> dict:
+        if self.time_series:
+            return {**query, 'meta.user_id': self.user_id}
+        return query
+
+    def find_newest(self) -> Optional[datetime]:
+        newest = self.collection.find_one(
+            self._scoped({}),
+            projection={'played_at': 1, '_id': 0},
+            sort=[('played_at', -1)])
+        if newest is None:
+            return None
+        return pytz.utc.localize(newest['played_at'])
 
-    def find_newest(self) -> datetime:
-        newest_unaware = self.collection.find_one(
-            sort=[('played_at', -1)])['played_at']
-        return pytz.utc.localize(newest_unaware)
+    def load_checkpoint(self) -> Optional[dict]:
+        return self.checkpoints.find_one(
+            {'_id': self.checkpoint_id}, projection={'_id': 0})
+
+    def save_checkpoint(self, checkpoint: dict) -> None:
+        # A single document upsert, so the checkpoint moves atomically
+        query = {'_id': self.checkpoint_id}
+        update = {**checkpoint, 'updated_at': datetime.utcnow()}
+        if self.fence_token is not None:
+            # A worker whose user lease was taken over holds an older token
+            # and can no longer move the checkpoint
+            query['$or'] = [
+                {'fence': {'$exists': False}},
+                {'fence': {'$lte': self.fence_token}}]
+            update['fence'] = self.fence_token
+        try:
+            self.checkpoints.update_one(query, {'$set': update}, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            raise LeaseLost(
+                f'Checkpoint {self.checkpoint_id} is fenced by a newer lease '
+                f'than {self.fence_token}')
+        debug_logger.debug('Saved ingestion checkpoint %s', checkpoint)
+
+    def iterate(
+            self,
+            query: dict,
+            projection: Optional[dict] = None,
+            sort: Optional[List[Tuple[str, int]]] = None,
+            limit: int = 0,
+            batch_size: int = 0) -> Iterator[dict]:
+        # Every read of stored plays goes through here, so readers see the
+        # current schema version while a collection is partly migrated.
+        # Inclusion projections also fetch the version, migrations only
+        # transform the fields that are present.
+        added_version = False
+        if projection and any(
+                value for name, value in projection.items() if name != '_id'):
+            added_version = VERSION_FIELD not in projection
+            projection = {**projection, VERSION_FIELD: 1}
+        cursor = self.collection.find(
+            self._scoped(query), projection=projection, limit=limit,
+            batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        for document in cursor:
+            document = upgrade(document)
+            if added_version:
+                del document[VERSION_FIELD]
+            yield document
+
+    def find_many(
+            self,
+            query: dict,
+            projection: Optional[dict] = None,
+            sort: Optional[List[Tuple[str, int]]] = None,
+            limit: int = 0) -> List[dict]:
+        return list(self.iterate(query, projection, sort, limit))
+
+    def _span(self, operation: str, batch_size: int):
+        return tracer.start_span(
+            f'mongo.{operation}',
+            **{'db.system': 'mongodb',
+               'db.name': self.db,
+               'db.collection': self.tbl,
+               'db.batch_size': batch_size})
 
     def save_one(self, data: pydantic.BaseModel) -> None:
-        inserted = self.collection.insert_one(data.dict())
-        info_logger.info(f'Inserted {inserted.inserted_id}')
+        with phase('store'), self._span('insert_one', 1):
+            inserted = self.collection.insert_one(self._to_document(data))
+        info_logger.info('Inserted %s', inserted.inserted_id)
+        self._run_save_hooks([data])
 
 
     def save_many(self, data: List[pydantic.BaseModel]) -> None:
-        data_parsed = [item.dict() for item in data]
-        inserted = self.collection.insert_many(data_parsed)
-        info_logger.info(f'Inserted {inserted.inserted_ids}')
+        with phase('store'), self._span('insert_many', len(data)):
+            if self.encoder is not None:
+                inserted_ids = self._insert_raw(data)
+            else:
+                data_parsed = [self._to_document(item) for item in data]
+                inserted_ids = self.collection.insert_many(
+                    data_parsed).inserted_ids
+        info_logger.info('Inserted %d documents', len(inserted_ids))
+        if debug_logger.isEnabledFor(logging.DEBUG):
+            debug_logger.debug('Inserted ids %s', inserted_ids)
+        self._run_save_hooks(data)
+
+    def _insert_raw(self, data: List[pydantic.BaseModel]) -> list:
+        # The encoder writes the _id, pymongo sends the raw bytes as they are
+        documents = self.encoder.encode_many(data, self._extra_fields())
+        for batch in batches(
+                documents, **MongoClientManager.limits(self.conn)):
+            self.collection.insert_many(batch)
+        return [document['_id'] for document in documents]
         
 
+    def replace_many(self, documents: List[dict]) -> int:
+        # Documents are matched on _id when present, otherwise on the
+        # played_at / track id pair that identifies a play
+        def key(document: dict) -> dict:
+            if '_id' in document:
+                return {'_id': document['_id']}
+            return {'played_at': document['played_at'],
+                    'track.id': document['track']['id']}
+
+        if not documents:
+            return 0
+        for document in documents:
+            document.setdefault(VERSION_FIELD, SCHEMA_VERSION)
+        with self._span('replace_many', len(documents)):
+            if self.time_series:
+                for document in documents:
+                    document['meta'] = {'user_id': self.user_id}
+                self._replace_time_series(documents, key)
+                return len(documents)
+            result = self.collection.bulk_write(
+                [ReplaceOne(key(document), document, upsert=True)
+                 for document in documents],
+                ordered=False)
+        return result.matched_count + result.upserted_count
+
+    def _replace_time_series(
+            self,
+            documents: List[dict],
+            key: Callable[[dict], dict]) -> None:
+        # Time series collections do not support replacements, so old
+        # documents are deleted and the new ones inserted. The batch is
+        # recorded first, a run that dies in between loses nothing and
+        # recover_replacements applies it again. Deletes filtering on
+        # fields other than meta need MongoDB 7.0.
+        batch = ObjectId()
+        self.pending_replacements.insert_many([
+            {'batch': batch, 'tbl': self.tbl, 'key': key(document),
+             'document': document}
+            for document in documents])
+        self._apply_replacements(
+            [key(document) for document in documents], documents)
+        self.pending_replacements.delete_many({'batch': batch})
+
+    def _apply_replacements(
+            self, keys: List[dict], documents: List[dict]) -> None:
+        # Deleting by key first makes applying a batch twice harmless
+        self.collection.delete_many({'$or': keys})
+        self.collection.insert_many(documents, ordered=False)
+
+    def recover_replacements(self) -> int:
+        pending = list(self.pending_replacements.find(
+            {'tbl': self.tbl}, sort=[('batch', 1), ('_id', 1)]))
+        batches: Dict[ObjectId, List[dict]] = {}
+        for record in pending:
+            batches.setdefault(record['batch'], []).append(record)
+        for batch, records in batches.items():
+            self._apply_replacements(
+                [record['key'] for record in records],
+                [record['document'] for record in records])
+            self.pending_replacements.delete_many({'batch': batch})
+            info_logger.warning(
+                'Recovered %d interrupted replacements in %s:%s',
+                len(records), self.db, self.tbl)
+        return len(pending)
+
     def reset_collection(self) -> None:
         self.collection.delete_many({})
         info_logger.warning(f'Deleted all documents from {self.db}:{self.tbl}')
\ No newline at end of file
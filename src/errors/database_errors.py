@@ -11,3 +11,15 @@ class DbInvalidName(Exception):
         self.msg = msg
         info_logger.exception(msg)
         super().__init__(self.msg)
+
+class LeaseLost(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+        info_logger.warning(msg)
+        super().__init__(self.msg)
+
+class RollupsLocked(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+        info_logger.warning(msg)
+        super().__init__(self.msg)
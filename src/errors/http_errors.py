@@ -13,4 +13,10 @@ class SpotifyHttpError(Exception):
                 'Unable to parse spotify error response body' , exc_info=True)
             spotify_error = e.response.text
         self.msg = f'{original_error} --- {spotify_error} --- {msg}'
-        super().__init__(self.msg)
\ No newline at end of file
+        super().__init__(self.msg)
+
+class CircuitOpenError(Exception):
+    def __init__(self, msg: str):
+        self.msg = msg
+        info_logger.warning(msg)
+        super().__init__(self.msg)
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import pydantic
+
+from ..db_connection import MongoConnection
+from ..logging.logger import info_logger, debug_logger
+from .sinks import EventSink, configured_sinks
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    offset INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sink_offsets (
+    sink TEXT PRIMARY KEY,
+    acked INTEGER NOT NULL
+);
+'''
+
+
+def play_event(play, user_id: str) -> dict:
+    if isinstance(play, pydantic.BaseModel):
+        play = play.dict()
+    track = play['track']
+    return {
+        'type': 'play',
+        'user_id': user_id,
+        'played_at': play['played_at'].isoformat(),
+        'track_id': track['id'],
+        'track_name': track['name'],
+        'artist_ids': [artist['id'] for artist in track['artists']],
+        'album_id': track['album']['id'],
+        'duration_ms': track['duration_ms'],
+    }
+
+
+class EventPublisher:
+    # New plays go to a SQLite outbox first, every sink keeps the offset of
+    # the last batch it acknowledged. Sinks are served by a bounded thread
+    # pool, each sink receives its batches in order and a failed batch is
+    # sent again on the next dispatch, so delivery is at least once.
+    def __init__(
+            self,
+            sinks: List[EventSink],
+            path: str = 'var/events/outbox.sqlite3',
+            user_id: str = 'default',
+            batch_size: int = 100,
+            max_concurrency: int = 4,
+            max_batches_per_sink: int = 50) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.sinks = sinks
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_batches_per_sink = max_batches_per_sink
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def append(self, events: List[dict]) -> int:
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT INTO events (payload) VALUES (?)',
+                [(json.dumps(event),) for event in events])
+            return self._db.execute('SELECT MAX(offset) FROM events').fetchone()[0]
+
+    def publish(self, plays: list) -> Dict[str, int]:
+        # Save hook: record the plays, then push them to every sink
+        if plays:
+            self.append([play_event(play, self.user_id) for play in plays])
+        return self.dispatch()
+
+    def acked(self, sink: str) -> int:
+        with self._lock:
+            row = self._db.execute(
+                'SELECT acked FROM sink_offsets WHERE sink = ?',
+                (sink,)).fetchone()
+        return row[0] if row else 0
+
+    def _ack(self, sink: str, offset: int) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO sink_offsets VALUES (?, ?) '
+                'ON CONFLICT (sink) DO UPDATE SET acked = excluded.acked',
+                (sink, offset))
+
+    def _batch(self, after: int) -> Tuple[List[dict], int]:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT offset, payload FROM events WHERE offset > ? '
+                'ORDER BY offset LIMIT ?', (after, self.batch_size)).fetchall()
+        events = []
+        for offset, payload in rows:
+            event = json.loads(payload)
+            event['offset'] = offset
+            events.append(event)
+        return events, rows[-1][0] if rows else after
+
+    def _drain(self, sink: EventSink) -> int:
+        # At most max_batches_per_sink batches per dispatch, so one sink
+        # that is far behind does not hold the pool
+        acked = self.acked(sink.name)
+        delivered = 0
+        for _ in range(self.max_batches_per_sink):
+            events, last_offset = self._batch(acked)
+            if not events:
+                break
+            try:
+                sink.deliver(events, last_offset)
+            except Exception:
+                info_logger.warning(
+                    'Delivering events %d-%d to %s failed, retrying later',
+                    acked + 1, last_offset, sink.name, exc_info=True)
+                break
+            self._ack(sink.name, last_offset)
+            acked = last_offset
+            delivered += len(events)
+        debug_logger.debug(
+            'Sink %s acknowledged up to offset %d', sink.name, acked)
+        return delivered
+
+    def dispatch(self) -> Dict[str, int]:
+        if not self.sinks:
+            return {}
+        with ThreadPoolExecutor(
+                max_workers=min(self.max_concurrency, len(self.sinks))
+                ) as executor:
+            delivered = dict(zip(
+                [sink.name for sink in self.sinks],
+                executor.map(self._drain, self.sinks)))
+        info_logger.info('Delivered events: %s', delivered)
+        return delivered
+
+    def lag(self) -> Dict[str, int]:
+        with self._lock:
+            newest = self._db.execute(
+                'SELECT COALESCE(MAX(offset), 0) FROM events').fetchone()[0]
+        return {sink.name: newest - self.acked(sink.name) for sink in self.sinks}
+
+    def compact(self) -> int:
+        # Events every sink acknowledged are no longer needed
+        if not self.sinks:
+            return 0
+        floor = min(self.acked(sink.name) for sink in self.sinks)
+        with self._lock, self._db:
+            deleted = self._db.execute(
+                'DELETE FROM events WHERE offset <= ?', (floor,)).rowcount
+        debug_logger.debug('Compacted %d events up to %d', deleted, floor)
+        return deleted
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close()
+        self._db.close()
+
+
+class ChangeStreamConsumer:
+    # Consumers that read MongoDB directly follow inserts on the history
+    # collection, the resume token is stored after every handled event.
+    # Change streams need a replica set.
+    def __init__(
+            self,
+            database_conn: MongoConnection,
+            resume_path: str = 'var/events/change_stream.json') -> None:
+        self.database_conn = database_conn
+        self.resume_path = resume_path
+        directory = os.path.dirname(resume_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _resume_token(self) -> Optional[dict]:
+        try:
+            with open(self.resume_path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def ack(self, resume_token: dict) -> None:
+        tmp_path = self.resume_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(resume_token, file)
+        os.replace(tmp_path, self.resume_path)
+
+    def events(self, batch_size: int = 100) -> Iterator[Tuple[dict, dict]]:
+        # Yields (event, resume token); call ack() once the event is handled
+        with self.database_conn.collection.watch(
+                [{'$match': {'operationType': 'insert'}}],
+                resume_after=self._resume_token(),
+                batch_size=batch_size) as stream:
+            for change in stream:
+                yield (play_event(change['fullDocument'],
+                                  self.database_conn.user_id),
+                       change['_id'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Deliver pending play events or follow them locally')
+    parser.add_argument('--outbox', default='var/events/outbox.sqlite3')
+    parser.add_argument('--http', action='append', default=[],
+                        help='Receiver URL, may be given multiple times')
+    parser.add_argument('--socket', action='append', default=[],
+                        help='Unix socket path, may be given multiple times')
+    parser.add_argument('--lag', action='store_true')
+    args = parser.parse_args()
+
+    with EventPublisher(
+            configured_sinks(args.http, args.socket), args.outbox) as publisher:
+        if args.lag:
+            print(publisher.lag())
+        else:
+            publisher.dispatch()
+            publisher.compact()
@@ -0,0 +1,115 @@
+import json
+import queue
+import socket
+from abc import ABC, abstractmethod
+from typing import Iterable, List
+
+from ..config.configure_requests import get_session_manager
+from ..logging.logger import debug_logger
+
+
+class EventSink(ABC):
+    # deliver() returns once the batch is acknowledged and raises otherwise,
+    # the publisher only advances the sink offset after it returned
+    name = 'sink'
+
+    @abstractmethod
+    def deliver(self, events: List[dict], last_offset: int) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class QueueSink(EventSink):
+    # The bounded queue is the backpressure: a full queue fails the batch
+    # and it is delivered again on the next dispatch
+    def __init__(
+            self,
+            events: queue.Queue,
+            name: str = 'queue',
+            timeout: float = 5.0) -> None:
+        self.events = events
+        self.name = name
+        self.timeout = timeout
+
+    def deliver(self, events: List[dict], last_offset: int) -> None:
+        self.events.put(
+            {'last_offset': last_offset, 'events': events},
+            timeout=self.timeout)
+
+
+class UnixSocketSink(EventSink):
+    # Newline delimited JSON, the receiver answers every batch with
+    # {"ack": <last_offset>}
+    def __init__(
+            self,
+            path: str,
+            name: str = 'unix_socket',
+            timeout: float = 10.0) -> None:
+        self.path = path
+        self.name = name
+        self.timeout = timeout
+        self._socket = None
+        self._reader = None
+
+    def _connect(self) -> None:
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(self.timeout)
+            self._socket.connect(self.path)
+            self._reader = self._socket.makefile('rb')
+
+    def deliver(self, events: List[dict], last_offset: int) -> None:
+        try:
+            self._connect()
+            self._socket.sendall(json.dumps(
+                {'last_offset': last_offset, 'events': events}).encode() + b'\n')
+            ack = json.loads(self._reader.readline() or b'{}')
+        except (OSError, ValueError):
+            self.close()
+            raise
+        if ack.get('ack') != last_offset:
+            self.close()
+            raise ConnectionError(
+                f'{self.path} acknowledged {ack.get("ack")}, '
+                f'expected {last_offset}')
+
+    def close(self) -> None:
+        if self._socket is not None:
+            self._reader.close()
+            self._socket.close()
+            debug_logger.debug('Closed event socket %s', self.path)
+        self._socket = None
+        self._reader = None
+
+
+class HttpSink(EventSink):
+    # Webhook style POST of each batch, any 2xx status is an ack
+    def __init__(
+            self,
+            url: str,
+            name: str = 'http',
+            timeout: float = 10.0) -> None:
+        self.url = url
+        self.name = name
+        self.timeout = timeout
+        self.session = get_session_manager().session
+
+    def deliver(self, events: List[dict], last_offset: int) -> None:
+        response = self.session.post(
+            self.url,
+            json={'last_offset': last_offset, 'events': events},
+            headers={'Idempotency-Key': str(last_offset)},
+            timeout=self.timeout)
+        response.raise_for_status()
+
+
+def configured_sinks(
+        http_urls: Iterable[str] = (),
+        socket_paths: Iterable[str] = ()) -> List[EventSink]:
+    sinks: List[EventSink] = [
+        HttpSink(url, name=f'http:{url}') for url in http_urls if url]
+    sinks += [UnixSocketSink(path, name=f'unix:{path}')
+              for path in socket_paths if path]
+    return sinks
@@ -0,0 +1,173 @@
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional, Tuple
+
+from bson import ObjectId
+
+from .db_connection import DatabaseConnection
+from .logging.logger import debug_logger
+
+FILTER_FIELDS = {
+    'track_id': 'track.id',
+    'artist_id': 'track.artists.id',
+    'album_id': 'track.album.id',
+}
+
+
+def to_ms(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return round(value.timestamp() * 1000)
+
+
+def from_ms(value: int) -> datetime:
+    # Stored dates are naive UTC
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc).replace(
+        tzinfo=None)
+
+
+def naive_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def sort_key(document: dict) -> tuple:
+    # Plays of the same millisecond are ordered by _id
+    return document['played_at'], document['_id']
+
+
+def encode_cursor(document: dict) -> str:
+    return f"{to_ms(document['played_at'])}_{document['_id']}"
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, Optional[object]]:
+    played_at, _, last_id = cursor.partition('_')
+    if not last_id:
+        # Cursors issued before the _id tie breaker carry no _id
+        return from_ms(int(played_at)), None
+    if ObjectId.is_valid(last_id):
+        last_id = ObjectId(last_id)
+    return from_ms(int(played_at)), last_id
+
+
+def after_cursor(
+        document: dict,
+        played_at: datetime,
+        last_id: Optional[object],
+        newest_first: bool = True) -> bool:
+    if last_id is None:
+        key, bound = document['played_at'], played_at
+    else:
+        key, bound = sort_key(document), (played_at, last_id)
+    return key < bound if newest_first else key > bound
+
+
+class HistoryPage:
+    def __init__(self, items: List[dict], next_cursor: Optional[str]) -> None:
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __str__(self) -> str:
+        return f'HistoryPage with {len(self.items)} plays'
+
+
+class HistoryQueryRepository:
+    # Every query shape maps to one of the indexes declared in
+    # db_connection: played_at alone, or track / artist / album id followed
+    # by played_at, each with _id last. Pages continue after the last
+    # played_at and _id (keyset), so a deep page costs the same index seek as
+    # the first one and plays of the same millisecond are not skipped.
+    def __init__(self, database_conn: DatabaseConnection) -> None:
+        self.database_conn = database_conn
+
+    def build_query(
+            self,
+            start: Optional[datetime] = None,
+            end: Optional[datetime] = None,
+            cursor: Optional[str] = None,
+            newest_first: bool = True,
+            **filters) -> dict:
+        query = {}
+        for name, value in filters.items():
+            if name not in FILTER_FIELDS:
+                raise ValueError(f'Unsupported history filter {name}')
+            if value is not None:
+                query[FILTER_FIELDS[name]] = value
+
+        played_at = {}
+        if start is not None:
+            played_at['$gte'] = naive_utc(start)
+        if end is not None:
+            played_at['$lt'] = naive_utc(end)
+        if cursor is not None:
+            bound, last_id = decode_cursor(cursor)
+            operator = '$lt' if newest_first else '$gt'
+            if last_id is not None:
+                query['$or'] = [
+                    {'played_at': {operator: bound}},
+                    {'played_at': bound, '_id': {operator: last_id}}]
+            elif newest_first:
+                played_at['$lt'] = min(bound, played_at.get('$lt', bound))
+            else:
+                played_at['$gt'] = bound
+        if played_at:
+            query['played_at'] = played_at
+        return query
+
+    def find(
+            self,
+            start: Optional[datetime] = None,
+            end: Optional[datetime] = None,
+            artist_id: Optional[str] = None,
+            track_id: Optional[str] = None,
+            album_id: Optional[str] = None,
+            fields: Optional[List[str]] = None,
+            limit: int = 50,
+            cursor: Optional[str] = None,
+            newest_first: bool = True) -> HistoryPage:
+        query = self.build_query(
+            start=start,
+            end=end,
+            cursor=cursor,
+            newest_first=newest_first,
+            artist_id=artist_id,
+            track_id=track_id,
+            album_id=album_id)
+        projection = None
+        if fields is not None:
+            # played_at and _id are needed for the cursor
+            projection = {field: 1 for field in fields}
+            projection['played_at'] = 1
+            projection['_id'] = 1
+        direction = -1 if newest_first else 1
+        items = self.database_conn.find_many(
+            query,
+            projection=projection,
+            sort=[('played_at', direction), ('_id', direction)],
+            limit=limit)
+        debug_logger.debug('History query %s returned %d plays', query, len(items))
+        next_cursor = None
+        if len(items) == limit and items:
+            next_cursor = encode_cursor(items[-1])
+        if fields is not None and '_id' not in fields:
+            for item in items:
+                item.pop('_id', None)
+        return HistoryPage(items, next_cursor)
+
+    def iterate(self, page_size: int = 500, **kwargs) -> Iterator[dict]:
+        cursor = kwargs.pop('cursor', None)
+        while True:
+            page = self.find(limit=page_size, cursor=cursor, **kwargs)
+            yield from page.items
+            if page.next_cursor is None:
+                return
+            cursor = page.next_cursor
+
+    def newest_played_at(self) -> Optional[datetime]:
+        items = self.database_conn.find_many(
+            {}, projection={'played_at': 1, '_id': 0},
+            sort=[('played_at', -1)], limit=1)
+        return items[0]['played_at'] if items else None
@@ -1,11 +1,70 @@
+import atexit
+import copy
 import logging
 import logging.config
+import logging.handlers
+import os
+import queue
 import yaml
 
-with open('src/logging/log_conf.yaml', 'r') as conf:
+LOG_MODE = os.environ.get('SPOTIFY_LOG_MODE', 'default')
+LOG_CONFIGS = {
+    'default': 'src/logging/log_conf.yaml',
+    'fast': 'src/logging/log_conf_fast.yaml',
+}
+LOGGER_NAMES = ['infoLogger', 'debugLogger', 'apiLogger']
+
+
+class _LightQueueHandler(logging.handlers.QueueHandler):
+    # Message args and the traceback are merged on the calling thread, as
+    # args may change or die once the call returns. Handler formatting,
+    # timestamps and JSON, is left to the writer thread.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _RoutingQueueListener(logging.handlers.QueueListener):
+    def __init__(self, log_queue: queue.Queue, routes: dict) -> None:
+        super().__init__(log_queue, respect_handler_level=True)
+        self.routes = routes
+
+    def handle(self, record: logging.LogRecord) -> None:
+        record = self.prepare(record)
+        for handler in self.routes.get(record.name, self.routes['']):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def _enqueue_handlers(logger_names: list) -> _RoutingQueueListener:
+    log_queue = queue.SimpleQueue()
+    queue_handler = _LightQueueHandler(log_queue)
+    routes = {}
+    for name in logger_names + ['']:
+        logger = logging.getLogger(name or None)
+        routes[name] = list(logger.handlers)
+        logger.handlers = [queue_handler]
+    listener = _RoutingQueueListener(log_queue, routes)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+with open(LOG_CONFIGS.get(LOG_MODE, LOG_CONFIGS['default']), 'r') as conf:
     config = yaml.safe_load(conf.read())
     logging.config.dictConfig(config)
 
+log_listener = None
+if LOG_MODE == 'fast':
+    log_listener = _enqueue_handlers(LOGGER_NAMES)
+
 info_logger = logging.getLogger('infoLogger')
 debug_logger = logging.getLogger('debugLogger')
-api_logger = logging.getLogger('apiLogger')
\ No newline at end of file
+api_logger = logging.getLogger('apiLogger')
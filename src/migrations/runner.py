@@ -0,0 +1,121 @@
+import argparse
+import os
+import time
+from datetime import datetime
+from typing import Optional
+
+from pymongo import ReplaceOne
+
+from ..db_connection import MongoConnection
+from ..logging.logger import info_logger, debug_logger
+from .schema import SCHEMA_VERSION, VERSION_FIELD, upgrade
+
+
+class MigrationRunner:
+    # Walks the documents below the target version in _id order and
+    # replaces them in unordered bulk writes of batch_size. Each
+    # replacement only matches the version it was read at, so a document
+    # that ingestion or another runner wrote in the meantime is left alone.
+    # The last _id is checkpointed after every batch and max_docs_per_second
+    # keeps the load on the primary bounded.
+    def __init__(
+            self,
+            database_conn: MongoConnection,
+            batch_size: int = 1000,
+            max_docs_per_second: Optional[float] = 5000,
+            state_tbl: str = 'schema_migrations') -> None:
+        if database_conn.time_series:
+            # Only the meta field of time series measurements can be updated
+            raise ValueError(
+                'Time series collections cannot be migrated in place, '
+                'readers upgrade their documents instead')
+        self.database_conn = database_conn
+        self.batch_size = batch_size
+        self.max_docs_per_second = max_docs_per_second
+        self.state = database_conn.conn[database_conn.db][state_tbl]
+
+    def _state_id(self, target: int) -> str:
+        return f'{self.database_conn.tbl}:{target}'
+
+    def pending(self, target: int = SCHEMA_VERSION) -> int:
+        return self.database_conn.collection.count_documents(
+            {'$or': [{VERSION_FIELD: {'$lt': target}},
+                     {VERSION_FIELD: None}]})
+
+    def run(
+            self,
+            target: int = SCHEMA_VERSION,
+            max_batches: Optional[int] = None) -> dict:
+        state_id = self._state_id(target)
+        state = self.state.find_one({'_id': state_id}) or {
+            'last_id': None, 'migrated': 0, 'skipped': 0,
+            'started_at': datetime.utcnow(), 'done': False}
+        if state['done']:
+            info_logger.info('Migration %s already done', state_id)
+            return state
+
+        collection = self.database_conn.collection
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            started = time.monotonic()
+            query = {'$or': [{VERSION_FIELD: {'$lt': target}},
+                             {VERSION_FIELD: None}]}
+            if state['last_id'] is not None:
+                query = {'$and': [query, {'_id': {'$gt': state['last_id']}}]}
+            batch = list(collection.find(query).sort('_id', 1).limit(
+                self.batch_size))
+            if not batch:
+                state['done'] = True
+                state['finished_at'] = datetime.utcnow()
+                break
+            requests = [
+                ReplaceOne(
+                    {'_id': document['_id'],
+                     VERSION_FIELD: document.get(VERSION_FIELD)},
+                    upgrade(dict(document), target))
+                for document in batch]
+            result = collection.bulk_write(requests, ordered=False)
+            state['last_id'] = batch[-1]['_id']
+            state['migrated'] += result.modified_count
+            state['skipped'] += len(batch) - result.matched_count
+            self.state.replace_one({'_id': state_id}, state, upsert=True)
+            batches += 1
+            debug_logger.debug(
+                'Migrated %d documents up to %s', len(batch), state['last_id'])
+            if self.max_docs_per_second:
+                time.sleep(max(
+                    0, len(batch) / self.max_docs_per_second
+                    - (time.monotonic() - started)))
+
+        self.state.replace_one({'_id': state_id}, state, upsert=True)
+        info_logger.info(
+            'Migration of %s:%s to version %d: %d migrated, %d skipped, '
+            'resume after %s%s',
+            self.database_conn.db, self.database_conn.tbl, target,
+            state['migrated'], state['skipped'], state['last_id'],
+            ', done' if state['done'] else '')
+        return state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Upgrade stored plays to the current schema version')
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--tbl', default='song_history')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--max-docs-per-second', type=float, default=5000)
+    parser.add_argument('--max-batches', type=int, default=None)
+    parser.add_argument('--pending', action='store_true',
+                        help='Only count documents below the current version')
+    args = parser.parse_args()
+
+    with MongoConnection(
+            db=args.db,
+            tbl=args.tbl,
+            host=os.environ.get('WSL_HOST', 'localhost')) as database_conn:
+        runner = MigrationRunner(
+            database_conn, args.batch_size, args.max_docs_per_second)
+        if args.pending:
+            print(f'{runner.pending()} documents below version {SCHEMA_VERSION}')
+        else:
+            runner.run(max_batches=args.max_batches)
@@ -0,0 +1,48 @@
+from typing import Callable, Dict, NamedTuple
+
+# Documents written before versioning have no schema_version field and
+# count as version 0. Register a migration for every change of the stored
+# shape and raise SCHEMA_VERSION to the newest migration. Readers with a
+# projection upgrade partial documents, so a transform must only touch the
+# fields that are present.
+SCHEMA_VERSION = 1
+VERSION_FIELD = 'schema_version'
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    transform: Callable[[dict], dict]
+
+
+MIGRATIONS: Dict[int, Migration] = {}
+
+
+def migration(version: int, description: str):
+    # Registers a transform from version - 1 to version
+    def register(transform: Callable[[dict], dict]) -> Callable[[dict], dict]:
+        if version in MIGRATIONS:
+            raise ValueError(f'Migration to version {version} already exists')
+        MIGRATIONS[version] = Migration(version, description, transform)
+        return transform
+    return register
+
+
+def document_version(document: dict) -> int:
+    return document.get(VERSION_FIELD) or 0
+
+
+def upgrade(document: dict, target: int = SCHEMA_VERSION) -> dict:
+    # Applies the missing transforms in order, readers call this so they
+    # see one shape while a collection is only partly migrated
+    version = document_version(document)
+    while version < target:
+        version += 1
+        document = MIGRATIONS[version].transform(document)
+        document[VERSION_FIELD] = version
+    return document
+
+
+@migration(1, 'Add the schema version to unversioned documents')
+def _stamp_version(document: dict) -> dict:
+    return document
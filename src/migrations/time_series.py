@@ -0,0 +1,85 @@
+import argparse
+import os
+from datetime import datetime
+
+from ..db_connection import MongoConnection
+from ..logging.logger import info_logger
+
+
+def migrate_to_time_series(
+        source: MongoConnection,
+        target: MongoConnection,
+        batch_size: int = 1000,
+        state_tbl: str = 'schema_migrations') -> int:
+    # Copies in _id order and checkpoints the last copied _id after every
+    # batch, so a rerun continues where the last one stopped. Time series
+    # collections do not enforce unique _ids, the batch after the
+    # checkpoint is therefore checked for documents a crashed run already
+    # inserted before its checkpoint was written.
+    if not target.time_series:
+        raise ValueError('Target connection is not in time series mode')
+    state = target.conn[target.db][state_tbl]
+    state_id = f'time_series:{source.tbl}:{target.tbl}'
+    checkpoint = state.find_one({'_id': state_id}) or {'last_id': None}
+    last_id = checkpoint['last_id']
+    if last_id is not None:
+        info_logger.info('Resuming copy to %s after %s', target.tbl, last_id)
+    copied = 0
+    check_copied = True
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        batch = list(source.collection.find(query).sort('_id', 1).limit(
+            batch_size))
+        if not batch:
+            break
+        if check_copied:
+            existing = {document['_id'] for document in target.collection.find(
+                {'_id': {'$in': [document['_id'] for document in batch]}},
+                projection={'_id': 1})}
+            batch_end = batch[-1]['_id']
+            batch = [document for document in batch
+                     if document['_id'] not in existing]
+            check_copied = bool(existing)
+        else:
+            batch_end = batch[-1]['_id']
+        for document in batch:
+            document.setdefault('meta', {'user_id': target.user_id})
+        if batch:
+            target.collection.insert_many(batch, ordered=False)
+        copied += len(batch)
+        last_id = batch_end
+        state.update_one(
+            {'_id': state_id},
+            {'$set': {'last_id': last_id, 'updated_at': datetime.utcnow()},
+             '$inc': {'copied': len(batch)}},
+            upsert=True)
+        info_logger.info(
+            'Copied %d documents to %s, checkpoint at %s',
+            copied, target.tbl, last_id)
+    info_logger.info(
+        'Migration of %s:%s to time series %s done, %d documents copied',
+        source.db, source.tbl, target.tbl, copied)
+    return copied
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Copy play history into a time series collection')
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--source', default='song_history')
+    parser.add_argument('--target', default='song_history_ts')
+    parser.add_argument('--user-id', default='default')
+    parser.add_argument('--granularity', default='minutes')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    host = os.environ.get('WSL_HOST', 'localhost')
+    with MongoConnection(db=args.db, tbl=args.source, host=host) as source, \
+            MongoConnection(
+                db=args.db,
+                tbl=args.target,
+                host=host,
+                user_id=args.user_id,
+                time_series=True,
+                granularity=args.granularity) as target:
+        migrate_to_time_series(source, target, args.batch_size)
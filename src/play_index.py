@@ -0,0 +1,190 @@
+import argparse
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pydantic
+
+from .db_connection import MongoConnection
+from .history_queries import to_ms
+from .logging.logger import info_logger, debug_logger
+
+RECORD = np.dtype([('played_at', '<i8'), ('track', '<i4'), ('context', '<i4')])
+NO_CONTEXT = -1
+
+
+def _play_key(play) -> Tuple[int, str, Optional[str]]:
+    if isinstance(play, pydantic.BaseModel):
+        context = play.context.uri if play.context else None
+        return to_ms(play.played_at), play.track.id, context
+    context = play.get('context')
+    return (to_ms(play['played_at']), play['track']['id'],
+            context['uri'] if context else None)
+
+
+class _Dictionary:
+    # Append-only string table, the line number is the id
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.values: List[str] = []
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                self.values = file.read().splitlines()
+        self.ids: Dict[str, int] = {
+            value: position for position, value in enumerate(self.values)}
+        self._new: List[str] = []
+
+    def id(self, value: str) -> int:
+        position = self.ids.get(value)
+        if position is None:
+            position = self.ids[value] = len(self.values)
+            self.values.append(value)
+            self._new.append(value)
+        return position
+
+    def flush(self) -> None:
+        if self._new:
+            with open(self.path, 'a') as file:
+                file.write(''.join(f'{value}\n' for value in self._new))
+            self._new = []
+
+
+class PlayIndex:
+    # plays.bin holds fixed width (played_at ms, track id, context id)
+    # records in played_at order and is memory mapped for reads, so a time
+    # range is two binary searches and a zero copy slice. Dictionaries are
+    # written before the records that reference them.
+    def __init__(self, directory: str = 'var/play_index') -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, 'plays.bin')
+        self.tracks = _Dictionary(os.path.join(directory, 'tracks.txt'))
+        self.contexts = _Dictionary(os.path.join(directory, 'contexts.txt'))
+        if os.path.exists(self.path):
+            size = os.path.getsize(self.path)
+            if size % RECORD.itemsize:
+                with open(self.path, 'r+b') as file:
+                    file.truncate(size - size % RECORD.itemsize)
+        self._map()
+
+    def _map(self) -> None:
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size == 0:
+            self.records = np.empty(0, dtype=RECORD)
+        else:
+            self.records = np.memmap(self.path, dtype=RECORD, mode='r')
+        debug_logger.debug('Mapped play index with %d plays', len(self.records))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def newest_ms(self) -> Optional[int]:
+        return int(self.records['played_at'][-1]) if len(self.records) else None
+
+    def append(self, plays: list) -> int:
+        # Plays at or before the newest indexed one are skipped, use
+        # rebuild() to index a backfill
+        newest = self.newest_ms
+        keys = sorted(_play_key(play) for play in plays)
+        if newest is not None:
+            keys = [key for key in keys if key[0] > newest]
+        if not keys:
+            return 0
+        records = np.empty(len(keys), dtype=RECORD)
+        for position, (played_at, track_id, context) in enumerate(keys):
+            records[position] = (
+                played_at,
+                self.tracks.id(track_id),
+                NO_CONTEXT if context is None else self.contexts.id(context))
+        self.tracks.flush()
+        self.contexts.flush()
+        with open(self.path, 'ab') as file:
+            file.write(records.tobytes())
+        self._map()
+        info_logger.info('Indexed %d plays', len(keys))
+        return len(keys)
+
+    def update(self, plays: list) -> None:
+        # Save hook
+        self.append(plays)
+
+    def rebuild(self, plays: Iterator) -> int:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._map()
+        total = 0
+        batch = []
+        for play in plays:
+            batch.append(play)
+            if len(batch) == 10000:
+                total += self.append(batch)
+                batch = []
+        return total + self.append(batch)
+
+    def range(
+            self,
+            start: Optional[datetime] = None,
+            end: Optional[datetime] = None) -> np.ndarray:
+        played_at = self.records['played_at']
+        low = 0 if start is None else int(
+            np.searchsorted(played_at, to_ms(start), side='left'))
+        high = len(played_at) if end is None else int(
+            np.searchsorted(played_at, to_ms(end), side='left'))
+        return self.records[low:high]
+
+    def count(
+            self,
+            start: Optional[datetime] = None,
+            end: Optional[datetime] = None) -> int:
+        return len(self.range(start, end))
+
+    def top_tracks(
+            self,
+            start: Optional[datetime] = None,
+            end: Optional[datetime] = None,
+            limit: int = 10) -> List[Tuple[str, int]]:
+        counts = np.bincount(
+            self.range(start, end)['track'], minlength=len(self.tracks.values))
+        top = np.argsort(-counts, kind='stable')[:limit]
+        return [(self.tracks.values[track], int(counts[track]))
+                for track in top if counts[track]]
+
+    def plays(
+            self,
+            start: Optional[datetime] = None,
+            end: Optional[datetime] = None
+            ) -> Iterator[Tuple[datetime, str, Optional[str]]]:
+        for played_at, track, context in self.range(start, end).tolist():
+            yield (datetime.fromtimestamp(played_at / 1000, tz=timezone.utc),
+                   self.tracks.values[track],
+                   None if context == NO_CONTEXT
+                   else self.contexts.values[context])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build or query the offline play index')
+    parser.add_argument('--directory', default='var/play_index')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the index from MongoDB')
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--tbl', default='song_history')
+    parser.add_argument('--start', type=datetime.fromisoformat)
+    parser.add_argument('--end', type=datetime.fromisoformat)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    index = PlayIndex(args.directory)
+    if args.rebuild:
+        with MongoConnection(
+                db=args.db,
+                tbl=args.tbl,
+                host=os.environ.get('WSL_HOST', 'localhost')) as database_conn:
+            index.rebuild(database_conn.iterate(
+                {}, projection={'played_at': 1, 'track.id': 1, 'context': 1},
+                sort=[('played_at', 1)]))
+    print(f'{index.count(args.start, args.end)} plays')
+    for track_id, plays in index.top_tracks(args.start, args.end, args.top):
+        print(f'{plays:8d}  {track_id}')
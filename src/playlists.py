@@ -0,0 +1,159 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from ._auth.auth_flows import ClientCredentialsFlow
+from .db_connection import MongoClientManager, MongoConnection
+from .logging.logger import info_logger, debug_logger
+from .spotify_interaction import SpotifyInteraction
+
+TrackList = List[Optional[str]]
+
+
+def diff_tracks(old: TrackList, new: TrackList) -> List[dict]:
+    # Operations refer to positions in the old list and are applied back
+    # to front, so earlier positions stay valid
+    ops = []
+    matcher = SequenceMatcher(a=old, b=new, autojunk=False)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag in ('delete', 'replace'):
+            ops.append({'op': 'delete', 'start': old_start, 'end': old_end})
+        if tag in ('insert', 'replace'):
+            ops.append({
+                'op': 'insert', 'at': old_end if tag == 'replace' else old_start,
+                'tracks': new[new_start:new_end]})
+    return ops
+
+
+def apply_ops(tracks: TrackList, ops: List[dict]) -> TrackList:
+    tracks = list(tracks)
+    for op in reversed(ops):
+        if op['op'] == 'delete':
+            del tracks[op['start']:op['end']]
+        else:
+            tracks[op['at']:op['at']] = op['tracks']
+    return tracks
+
+
+class PlaylistTracker:
+    # One snapshot_id request per playlist and poll. Only when the id
+    # changed are the track ids fetched and diffed against the stored
+    # state; a version document keeps the edit operations, and every
+    # full_every versions also the full list so reconstruction never
+    # replays more than full_every deltas.
+    def __init__(
+            self,
+            interaction: SpotifyInteraction,
+            database_conn: MongoConnection,
+            state_tbl: str = 'playlist_state',
+            versions_tbl: str = 'playlist_versions',
+            full_every: int = 50,
+            workers: int = 4) -> None:
+        self.interaction = interaction
+        database = database_conn.conn[database_conn.db]
+        self.state = database[state_tbl]
+        self.versions = database[versions_tbl]
+        self.full_every = full_every
+        self.workers = workers
+        MongoClientManager.ensure_indexes(self.versions, [IndexModel(
+            [('playlist_id', ASCENDING), ('version', DESCENDING)],
+            unique=True)])
+
+    def poll_one(self, playlist_id: str) -> str:
+        snapshot_id = self.interaction.get_playlist_snapshot_id(playlist_id)
+        state = self.state.find_one({'_id': playlist_id}) or {
+            'snapshot_id': None, 'tracks': [], 'version': -1}
+        now = datetime.utcnow()
+        if state['snapshot_id'] == snapshot_id:
+            self.state.update_one(
+                {'_id': playlist_id}, {'$set': {'checked_at': now}})
+            debug_logger.debug('Playlist %s unchanged', playlist_id)
+            return 'unchanged'
+
+        tracks = self.interaction.get_playlist_track_ids(playlist_id)
+        ops = diff_tracks(state['tracks'], tracks)
+        version = state['version'] + 1
+        document = {
+            'playlist_id': playlist_id,
+            'version': version,
+            'snapshot_id': snapshot_id,
+            'previous_snapshot_id': state['snapshot_id'],
+            'captured_at': now,
+            'ops': ops,
+            'added': sum(len(op['tracks']) for op in ops if op['op'] == 'insert'),
+            'removed': sum(
+                op['end'] - op['start'] for op in ops if op['op'] == 'delete'),
+        }
+        if version % self.full_every == 0:
+            document['tracks'] = tracks
+        # The version is written first and keyed on (playlist, version), a
+        # crash before the state update rewrites the same version next poll
+        self.versions.replace_one(
+            {'playlist_id': playlist_id, 'version': version},
+            document, upsert=True)
+        self.state.replace_one(
+            {'_id': playlist_id},
+            {'snapshot_id': snapshot_id, 'tracks': tracks,
+             'version': version, 'checked_at': now},
+            upsert=True)
+        info_logger.info(
+            'Playlist %s changed: %d added, %d removed',
+            playlist_id, document['added'], document['removed'])
+        return 'changed'
+
+    def poll(self, playlist_ids: Iterable[str]) -> Dict[str, str]:
+        playlist_ids = list(playlist_ids)
+
+        def safe_poll(playlist_id: str) -> str:
+            try:
+                return self.poll_one(playlist_id)
+            except Exception:
+                info_logger.exception('Polling playlist %s failed', playlist_id)
+                return 'failed'
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(zip(playlist_ids, executor.map(safe_poll, playlist_ids)))
+
+    def tracks_at(
+            self,
+            playlist_id: str,
+            at: Optional[datetime] = None) -> Optional[TrackList]:
+        query = {'playlist_id': playlist_id}
+        if at is not None:
+            query['captured_at'] = {'$lte': at}
+        base = self.versions.find_one(
+            {**query, 'tracks': {'$exists': True}},
+            sort=[('version', DESCENDING)])
+        if base is None:
+            return None
+        tracks = base['tracks']
+        for version in self.versions.find(
+                {**query, 'version': {'$gt': base['version']}},
+                projection={'ops': 1},
+                sort=[('version', ASCENDING)]):
+            tracks = apply_ops(tracks, version['ops'])
+        return tracks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Record playlist changes based on their snapshot ids')
+    parser.add_argument('playlist_ids', nargs='+')
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with MongoConnection(
+            db=args.db,
+            tbl='song_history',
+            host=os.environ.get('WSL_HOST', 'localhost')) as database_conn:
+        tracker = PlaylistTracker(
+            SpotifyInteraction(ClientCredentialsFlow()), database_conn,
+            workers=args.workers)
+        for playlist_id, status in tracker.poll(args.playlist_ids).items():
+            print(f'{status:10s} {playlist_id}')
@@ -0,0 +1,196 @@
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+
+from .logging.logger import info_logger
+
+PROFILE_ENV = 'SPOTIFY_PROFILE'
+PROFILE_MODES = {'cpu', 'sample', 'memory', 'timers'}
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class _PhaseTimer:
+    __slots__ = ('profiler', 'name', 'started')
+
+    def __init__(self, profiler: 'Profiler', name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        stack.append(self.name)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        elapsed = time.perf_counter() - self.started
+        stack = self.profiler._stack()
+        path = '/'.join(stack)
+        stack.pop()
+        with self.profiler._lock:
+            totals = self.profiler.timings[path]
+            totals[0] += 1
+            totals[1] += elapsed
+
+
+class _StackSampler(threading.Thread):
+    def __init__(self, interval: float = 0.005) -> None:
+        super().__init__(name='stack-sampler', daemon=True)
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._own_ident = None
+
+    def run(self) -> None:
+        self._own_ident = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == self._own_ident:
+                    continue
+                code = frame.f_code
+                self.samples[
+                    f'{code.co_filename}:{frame.f_lineno} {code.co_name}'] += 1
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.join()
+
+
+class Profiler:
+    # Every entry point checks a plain attribute, so with profiling disabled
+    # phase() hands back a shared null context and nothing else runs
+    def __init__(self, report_dir: str = 'var/logs/profiles') -> None:
+        self.report_dir = report_dir
+        self.modes = set()
+        self.timings: Dict[str, list] = defaultdict(lambda: [0, 0.0])
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def configure(self, modes: Optional[Iterable[str]]) -> None:
+        if isinstance(modes, str):
+            modes = [mode.strip() for mode in modes.split(',') if mode.strip()]
+        modes = set(modes or [])
+        if 'all' in modes:
+            modes = {'cpu', 'memory', 'timers'}
+        unknown = modes - PROFILE_MODES
+        if unknown:
+            raise ValueError(f'Unknown profiling modes {sorted(unknown)}')
+        self.modes = modes
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.modes)
+
+    def _stack(self) -> list:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def phase(self, name: str):
+        if 'timers' not in self.modes:
+            return _NULL_CONTEXT
+        return _PhaseTimer(self, name)
+
+    @contextlib.contextmanager
+    def run(self, name: str = 'run'):
+        if not self.modes:
+            yield self
+            return
+        cpu_profile = cProfile.Profile() if 'cpu' in self.modes else None
+        sampler = _StackSampler() if 'sample' in self.modes else None
+        if 'memory' in self.modes:
+            tracemalloc.start(25)
+        if sampler:
+            sampler.start()
+        if cpu_profile:
+            cpu_profile.enable()
+        started = time.perf_counter()
+        try:
+            with self.phase(name):
+                yield self
+        finally:
+            wall_clock = time.perf_counter() - started
+            if cpu_profile:
+                cpu_profile.disable()
+            if sampler:
+                sampler.stop()
+            snapshot = None
+            peak = None
+            if 'memory' in self.modes:
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self._write_reports(
+                name, wall_clock, cpu_profile, sampler, snapshot, peak)
+
+    def _write_reports(
+            self,
+            name: str,
+            wall_clock: float,
+            cpu_profile: Optional[cProfile.Profile],
+            sampler: Optional[_StackSampler],
+            snapshot: Optional[tracemalloc.Snapshot],
+            peak: Optional[int]) -> None:
+        os.makedirs(self.report_dir, exist_ok=True)
+        prefix = os.path.join(
+            self.report_dir,
+            f'{datetime.now().strftime("%Y%m%dT%H%M%S")}-{name}')
+        written = []
+
+        if cpu_profile:
+            cpu_profile.dump_stats(f'{prefix}-cpu.prof')
+            stream = io.StringIO()
+            pstats.Stats(cpu_profile, stream=stream).sort_stats(
+                'cumulative').print_stats(50)
+            with open(f'{prefix}-cpu.txt', 'w') as file:
+                file.write(stream.getvalue())
+            written += [f'{prefix}-cpu.prof', f'{prefix}-cpu.txt']
+
+        if sampler:
+            total = sum(sampler.samples.values()) or 1
+            with open(f'{prefix}-sample.txt', 'w') as file:
+                for location, count in sampler.samples.most_common(50):
+                    file.write(f'{count / total:7.2%} {count:8d}  {location}\n')
+            written.append(f'{prefix}-sample.txt')
+
+        if snapshot:
+            with open(f'{prefix}-memory.txt', 'w') as file:
+                file.write(f'Peak traced memory: {peak / 1024:.1f} KiB\n\n')
+                for stat in snapshot.statistics('lineno')[:25]:
+                    file.write(f'{stat}\n')
+            written.append(f'{prefix}-memory.txt')
+
+        if 'timers' in self.modes:
+            with self._lock:
+                timings = {
+                    path: {'calls': calls, 'seconds': round(seconds, 6)}
+                    for path, (calls, seconds) in sorted(self.timings.items())}
+            with open(f'{prefix}-timers.json', 'w') as file:
+                json.dump(
+                    {'wall_clock': round(wall_clock, 6), 'phases': timings},
+                    file, indent=2)
+            written.append(f'{prefix}-timers.json')
+
+        info_logger.info(
+            'Profiling %s took %.3fs, reports: %s',
+            name, wall_clock, ', '.join(written))
+
+
+profiler = Profiler()
+profiler.configure(os.environ.get(PROFILE_ENV))
+
+
+def phase(name: str):
+    return profiler.phase(name)
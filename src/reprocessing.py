@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Iterator, List, Optional, Tuple
+
+from bson import ObjectId
+from pydantic.error_wrappers import ValidationError
+
+from .archive.raw_archive import RawResponseArchive
+from .db_connection import MongoConnection
+from .logging.logger import info_logger
+from .spotify_data.dataclasses import SpotifyHistoryObject
+
+Batch = Tuple[object, List[dict]]
+
+
+def reparse_plays(items: List[dict]) -> Tuple[List[dict], int]:
+    documents = []
+    failed = 0
+    for item in items:
+        try:
+            document = SpotifyHistoryObject(**item).dict()
+        except (ValidationError, KeyError, TypeError):
+            failed += 1
+            continue
+        if '_id' in item:
+            document['_id'] = item['_id']
+        documents.append(document)
+    return documents, failed
+
+
+class ReprocessingCheckpoint:
+    def __init__(self, name: str, directory: str = 'var/reprocessing') -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f'{name}.json')
+
+    def load(self) -> dict:
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def save(self, state: dict) -> None:
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(state, file, default=str)
+        os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def archive_batches(
+        archive: RawResponseArchive,
+        user_id: Optional[str],
+        after_id: int,
+        batch_size: int) -> Iterator[Batch]:
+    items = []
+    last_id = after_id
+    for meta, body in archive.iter_responses(
+            endpoint='play_history', user_id=user_id, after_id=after_id):
+        items.extend(json.loads(body).get('items', []))
+        last_id = meta['id']
+        if len(items) >= batch_size:
+            yield last_id, items
+            items = []
+    if items:
+        yield last_id, items
+
+
+def document_batches(
+        database_conn: MongoConnection,
+        after_id: Optional[object],
+        batch_size: int) -> Iterator[Batch]:
+    query = {'_id': {'$gt': after_id}} if after_id is not None else {}
+    while True:
+        items = database_conn.find_many(
+            query, projection={'meta': 0}, sort=[('_id', 1)], limit=batch_size)
+        if not items:
+            return
+        last_id = items[-1]['_id']
+        yield last_id, items
+        query = {'_id': {'$gt': last_id}}
+
+
+class Reprocessor:
+    # Batches are parsed in a process pool while the next ones are read,
+    # results are written and checkpointed strictly in submission order so
+    # a restart continues after the last written batch
+    def __init__(
+            self,
+            database_conn: MongoConnection,
+            checkpoint: ReprocessingCheckpoint,
+            workers: Optional[int] = None,
+            max_in_flight: Optional[int] = None) -> None:
+        self.database_conn = database_conn
+        self.checkpoint = checkpoint
+        self.workers = workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or self.workers * 2
+
+    def run(self, batches: Iterator[Batch], source: str) -> dict:
+        state = self.checkpoint.load()
+        state.setdefault('written', 0)
+        state.setdefault('failed', 0)
+        state['source'] = source
+        in_flight: Deque[Tuple[object, Future]] = deque()
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for position, items in batches:
+                in_flight.append(
+                    (position, executor.submit(reparse_plays, items)))
+                if len(in_flight) >= self.max_in_flight:
+                    self._write(state, *in_flight.popleft())
+            while in_flight:
+                self._write(state, *in_flight.popleft())
+
+        info_logger.info(
+            'Reprocessing done: %d documents written, %d failed',
+            state['written'], state['failed'])
+        return state
+
+    def _write(self, state: dict, position: object, future: Future) -> None:
+        documents, failed = future.result()
+        state['written'] += self.database_conn.replace_many(documents)
+        state['failed'] += failed
+        state['position'] = position
+        self.checkpoint.save(state)
+        info_logger.info(
+            'Reprocessed up to %s: %d written, %d failed',
+            position, state['written'], state['failed'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Re-parse stored plays with the current models')
+    parser.add_argument(
+        '--source', choices=['archive', 'documents'], default='documents')
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--tbl', default='song_history')
+    parser.add_argument('--user-id', default='default')
+    parser.add_argument('--time-series', action='store_true')
+    parser.add_argument('--archive-dir', default='var/archive')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--checkpoint', default='reprocessing')
+    parser.add_argument('--restart', action='store_true')
+    args = parser.parse_args()
+
+    checkpoint = ReprocessingCheckpoint(f'{args.checkpoint}-{args.source}')
+    if args.restart:
+        checkpoint.clear()
+    position = checkpoint.load().get('position')
+
+    with MongoConnection(
+            db=args.db,
+            tbl=args.tbl,
+            host=os.environ.get('WSL_HOST', 'localhost'),
+            user_id=args.user_id,
+            time_series=args.time_series) as database_conn:
+        if args.time_series:
+            # Batches of a run that died between delete and insert
+            database_conn.recover_replacements()
+        reprocessor = Reprocessor(database_conn, checkpoint, args.workers)
+        if args.source == 'archive':
+            with RawResponseArchive(args.archive_dir) as archive:
+                reprocessor.run(archive_batches(
+                    archive, args.user_id, int(position or 0),
+                    args.batch_size), args.source)
+        else:
+            reprocessor.run(document_batches(
+                database_conn,
+                ObjectId(position) if position else None,
+                args.batch_size), args.source)
@@ -1,101 +1,103 @@
 from types import FunctionType
-from typing import Union
+from typing import Optional
 from requests.exceptions import HTTPError
-from requests.models import Response
-import time
 
-from .errors.http_errors import SpotifyHttpError
+from .errors.http_errors import SpotifyHttpError, CircuitOpenError
 from .logging.logger import api_logger, info_logger, debug_logger
+from .retry_policy import RetryPolicy, default_retry_policy
+from .profiling import phase
+from .tracing import tracer
 
-def ApiLogger(msg:str = None, err_handling: bool = True):
+def ApiLogger(
+        msg: str = None,
+        err_handling: bool = True,
+        family: Optional[str] = None,
+        policy: Optional[RetryPolicy] = None):
     def decorator(func: FunctionType):
+        endpoint_family = family or func.__qualname__
+
         def wrapper(*args, **kwargs):
-            api_logger.info(f'Starting Api Call: {msg}')
-            try:
-                result = func(*args, **kwargs)
-                api_logger.info(f'Finished Api Call: {msg}')
-                return result
-            except HTTPError as e:
+            api_logger.info('Starting Api Call: %s', msg)
+            with tracer.start_span(
+                    endpoint_family, **{'api.call': msg}) as span:
                 try:
+                    with phase('fetch'):
+                        if err_handling:
+                            result = (policy or default_retry_policy).call(
+                                endpoint_family, func, *args, **kwargs)
+                        else:
+                            result = func(*args, **kwargs)
+                    api_logger.info('Finished Api Call: %s', msg)
+                    return result
+                except HTTPError as e:
                     api_logger.warning(
-                        f'Received error status code in {func.__name__}')
-                    result = RequestErrorFactory(
-                        e, func, *args, **kwargs).evaluate_action()
-                    if type(result) is not SpotifyHttpError:
-                        return result
-                    raise result
-                except SpotifyHttpError as e:
+                        'Received error status code in %s', func.__name__)
+                    span.set_attribute(
+                        'http.status_code', e.response.status_code)
+                    error = RequestErrorFactory(e).evaluate_action()
                     api_logger.exception('Could not handle API error')
-                    raise e from None
-            except:
-                api_logger.exception(
-                    f'Encountered an unexpected exception in {func.__name__}')
-                raise
+                    raise error from None
+                except CircuitOpenError:
+                    raise
+                except:
+                    api_logger.exception(
+                        f'Encountered an unexpected exception in {func.__name__}')
+                    raise
         return wrapper
     return decorator
 
 class RequestErrorFactory:
 
-    def __init__(
-            self, 
-            error: HTTPError, 
-            func: FunctionType, 
-            *args, **kwargs) -> None:
+    def __init__(self, error: HTTPError) -> None:
         self.error = error
-        self.func = func
         self.response = self.error.response
         self.request = self.error.request
         self.status_code = self.response.status_code
 
-        self.evaluate_action(*args, **kwargs)
-
     def unauthorized(self) -> SpotifyHttpError:
-        debug_logger.debug('Trying to resolve unauthorized request error')
+        debug_logger.debug('Unauthorized request error')
         msg = ''' Please make sure you are using a authentification flow with
         access to the data you are requesting, and a matching scope./n
-        If you are accessing another users data, you may not be authorized to 
+        If you are accessing another users data, you may not be authorized to
         do so.'''
         return self.create_error(msg)
 
+    def not_found(self) -> SpotifyHttpError:
+        debug_logger.debug('Object not found error')
+        msg = ''' The requested resource was not found. This did not
+        resolve after retrying'''
+        return self.create_error(msg)
 
-    def not_found(self, *args, **kwargs) -> Union[SpotifyHttpError, Response]:
-        debug_logger.debug('Trying to resolve object not found error')
-        self.wait()
-        try:
-            return self.func(*args, **kwargs)
-        except:
-            msg = ''' The requested resource was not found. This did not
-            resolve after waiting for one minute'''
-            return self.create_error(msg)
-
-    def rate_limited(self, *args, **kwargs):
-        debug_logger.debug('Trying to resolve Rate Limited error')
-        try:
-            retry_after = self.response.headers['Retry-After']
-        except KeyError as e:
-            msg = ''' There was a rate limited error, but no retry time was 
+    def rate_limited(self) -> SpotifyHttpError:
+        debug_logger.debug('Rate Limited error')
+        if 'Retry-After' not in self.response.headers:
+            msg = ''' There was a rate limited error, but no retry time was
             provided by the Spotify API. Please retry after a few minutes'''
             return self.create_error(msg)
+        msg = ''' Still rate limited after retrying, the retry budget was
+        exhausted. Please retry after a few minutes'''
+        return self.create_error(msg)
 
-        self.wait(retry_after)
-        return self.func(*args, **kwargs)
-
-    def wait(self, seconds:int = 60) -> None:
-        time.sleep(seconds)
+    def server_error(self) -> SpotifyHttpError:
+        debug_logger.debug('Server error')
+        msg = ''' The Spotify API kept failing after retrying with backoff'''
+        return self.create_error(msg)
 
     def create_error(self, msg: str = '') -> SpotifyHttpError:
         return SpotifyHttpError(e = self.error, msg = msg)
 
-    def evaluate_action(self, *args, **kwargs):
+    def evaluate_action(self) -> SpotifyHttpError:
         status = self.status_code
-        debug_logger.debug(f'Evaluating action for code {status}')
+        debug_logger.debug('Evaluating action for code %s', status)
         if status in [401, 403]:
             return self.unauthorized()
         if status == 404:
-            return self.not_found(*args, **kwargs)
+            return self.not_found()
         if status == 429:
-            return self.rate_limited(*args, **kwargs)
+            return self.rate_limited()
+        if status >= 500:
+            return self.server_error()
         debug_logger.debug(
-            'No exception handling found for this error code, ' + 
+            'No exception handling found for this error code, ' +
             'raise generic error')
         return self.create_error()
@@ -0,0 +1,204 @@
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+from .errors.http_errors import CircuitOpenError
+from .logging.logger import api_logger, debug_logger
+
+
+class RetryRule:
+    def __init__(
+            self,
+            statuses: Iterable[int],
+            max_attempts: int,
+            honor_retry_after: bool = False,
+            counts_as_failure: bool = True) -> None:
+        self.statuses = set(statuses)
+        self.max_attempts = max_attempts
+        self.honor_retry_after = honor_retry_after
+        self.counts_as_failure = counts_as_failure
+
+
+DEFAULT_RULES = [
+    RetryRule([429], max_attempts=4, honor_retry_after=True,
+              counts_as_failure=False),
+    RetryRule([500, 502, 503, 504], max_attempts=4),
+    RetryRule([404], max_attempts=2, counts_as_failure=False),
+]
+CONNECTION_RULE = RetryRule([], max_attempts=3)
+
+
+class RetryBudget:
+    # Every request deposits `ratio` tokens, every retry withdraws one token.
+    # Retries are therefore capped at a fraction of the overall traffic.
+    def __init__(self, ratio: float = 0.2, max_tokens: float = 10) -> None:
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+            self,
+            name: str,
+            failure_threshold: int = 5,
+            reset_timeout: float = 30,
+            clock: Callable[[], float] = time.monotonic) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(
+                        f'Circuit for {self.name} is open, failing fast')
+                self.state = self.HALF_OPEN
+                self._probe_running = False
+            if self._probe_running:
+                raise CircuitOpenError(
+                    f'Circuit for {self.name} is half open, probe running')
+            self._probe_running = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                api_logger.info('Circuit for %s closed', self.name)
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_running = False
+
+    def release(self) -> None:
+        # Ends a call that says nothing about the health of the endpoint,
+        # like a client error, without changing the state
+        with self._lock:
+            self._probe_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probe_running = False
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                if self.state != self.OPEN:
+                    api_logger.warning('Circuit for %s opened', self.name)
+                self.state = self.OPEN
+                # Spread the recovery probes of different processes
+                self.opened_at = self.clock() + random.uniform(
+                    0, self.reset_timeout * 0.2)
+
+
+class RetryPolicy:
+    def __init__(
+            self,
+            rules: Iterable[RetryRule] = DEFAULT_RULES,
+            base_delay: float = 0.5,
+            max_delay: float = 60,
+            budget: Optional[RetryBudget] = None,
+            breaker_factory: Callable[[str], CircuitBreaker] = CircuitBreaker,
+            sleep: Callable[[float], None] = time.sleep,
+            connection_rule: Optional[RetryRule] = CONNECTION_RULE) -> None:
+        self.rules = list(rules)
+        self.connection_rule = connection_rule
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self.breaker_factory = breaker_factory
+        self.sleep = sleep
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get_breaker(self, family: str) -> CircuitBreaker:
+        with self._lock:
+            if family not in self.breakers:
+                self.breakers[family] = self.breaker_factory(family)
+            return self.breakers[family]
+
+    def rule_for(self, error: Exception) -> Optional[RetryRule]:
+        if isinstance(error, (ConnectionError, Timeout)):
+            return self.connection_rule
+        if isinstance(error, HTTPError) and error.response is not None:
+            for rule in self.rules:
+                if error.response.status_code in rule.statuses:
+                    return rule
+        return None
+
+    def backoff(self, attempt: int, rule: RetryRule, error: Exception) -> float:
+        if rule.honor_retry_after:
+            retry_after = error.response.headers.get('Retry-After')
+            if retry_after is not None:
+                # A server asking for more than max_delay must not park
+                # the worker, the next attempt is rate limited again if
+                # it comes too early
+                try:
+                    delay = float(retry_after) + random.uniform(
+                        0, self.base_delay)
+                    return min(self.max_delay, delay)
+                except ValueError:
+                    pass
+        # Full jitter: uniform between zero and the exponential cap
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, cap)
+
+    def call(self, family: str, func: Callable, *args, **kwargs):
+        breaker = self.get_breaker(family)
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            breaker.before_call()
+            try:
+                result = func(*args, **kwargs)
+            except (HTTPError, ConnectionError, Timeout) as e:
+                rule = self.rule_for(e)
+                if rule is not None and rule.counts_as_failure:
+                    breaker.record_failure()
+                else:
+                    breaker.release()
+                attempt += 1
+                if rule is None or attempt >= rule.max_attempts:
+                    raise
+                if not self.budget.withdraw():
+                    api_logger.warning(
+                        'Retry budget exhausted, not retrying %s', family)
+                    raise
+                delay = self.backoff(attempt, rule, e)
+                debug_logger.debug(
+                    'Retry %d for %s in %.2fs', attempt, family, delay)
+                self.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+
+
+default_retry_policy = RetryPolicy()
+# For requests that must not be sent twice, like exchanging a single use
+# authorization code
+no_retry_policy = RetryPolicy(rules=[], connection_rule=None)
@@ -0,0 +1,242 @@
+import argparse
+import heapq
+import os
+import uuid
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from typing import Dict, Iterable, Iterator, List, Literal, Tuple, Union
+
+import pydantic
+import pymongo
+from pymongo import ASCENDING, IndexModel, ReplaceOne, UpdateOne
+
+from .db_connection import MongoClientManager, MongoConnection
+from .errors.database_errors import RollupsLocked
+from .logging.logger import info_logger
+
+Play = Union[pydantic.BaseModel, dict]
+
+
+class _Bucket:
+    def __init__(self) -> None:
+        self.plays = 0
+        self.ms_played = 0
+        self.tracks = Counter()
+        self.artists = Counter()
+
+    def add(self, duration_ms: int, track_id: str, artist_ids: List[str]) -> None:
+        self.plays += 1
+        self.ms_played += duration_ms
+        self.tracks[track_id] += 1
+        for artist_id in artist_ids:
+            self.artists[artist_id] += 1
+
+
+def _play_fields(play: Play) -> Tuple[datetime, int, str, List[str]]:
+    if isinstance(play, dict):
+        track = play['track']
+        return (play['played_at'], track['duration_ms'], track['id'],
+                [artist['id'] for artist in track['artists']])
+    track = play.track
+    return (play.played_at, track.duration_ms, track.id,
+            [artist.id for artist in track.artists])
+
+
+def day_key(day: date) -> str:
+    return day.isoformat()
+
+
+def week_key(day: date) -> str:
+    year, week, _ = day.isocalendar()
+    return f'{year}-W{week:02d}'
+
+
+class ListeningRollups:
+    def __init__(
+            self,
+            database_conn: MongoConnection,
+            top_k: int = 10,
+            daily_tbl: str = 'rollup_daily',
+            weekly_tbl: str = 'rollup_weekly',
+            locks_tbl: str = 'rollup_locks',
+            lock_seconds: float = 3600) -> None:
+        self.database_conn = database_conn
+        self.user_id = database_conn.user_id
+        self.top_k = top_k
+        database = database_conn.conn[database_conn.db]
+        self.collections = {
+            'day': database[daily_tbl],
+            'week': database[weekly_tbl],
+        }
+        for period, collection in self.collections.items():
+            MongoClientManager.ensure_indexes(collection, [IndexModel(
+                [('user_id', ASCENDING), (period, ASCENDING)], unique=True)])
+        self.locks = database[locks_tbl]
+        self.lock_seconds = lock_seconds
+
+    @contextmanager
+    def locked(self, holder: str) -> Iterator[None]:
+        # A rebuild overwrites buckets with what it read, increments of
+        # plays saved meanwhile would be lost or counted twice. Ingestion
+        # and rebuilds of a user therefore hold this lock, which expires
+        # after lock_seconds if its holder dies.
+        holder = f'{holder}:{uuid.uuid4().hex[:8]}'
+        now = datetime.utcnow()
+        try:
+            self.locks.update_one(
+                {'_id': self.user_id, '$or': [
+                    {'holder': None}, {'expires_at': {'$lte': now}}]},
+                {'$set': {'holder': holder, 'expires_at': now + timedelta(
+                    seconds=self.lock_seconds)}},
+                upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            lock = self.locks.find_one({'_id': self.user_id}) or {}
+            raise RollupsLocked(
+                f'Rollups of user {self.user_id} are locked by '
+                f'{lock.get("holder")} until {lock.get("expires_at")}')
+        try:
+            yield
+        finally:
+            self.locks.update_one(
+                {'_id': self.user_id, 'holder': holder},
+                {'$set': {'holder': None, 'expires_at': datetime.utcnow()}})
+
+    def _accumulate(
+            self, plays: Iterable[Play]) -> Dict[str, Dict[str, _Bucket]]:
+        buckets = {'day': defaultdict(_Bucket), 'week': defaultdict(_Bucket)}
+        for play in plays:
+            played_at, duration_ms, track_id, artist_ids = _play_fields(play)
+            day = played_at.date()
+            buckets['day'][day_key(day)].add(duration_ms, track_id, artist_ids)
+            buckets['week'][week_key(day)].add(duration_ms, track_id, artist_ids)
+        return buckets
+
+    def update(self, plays: List[Play]) -> None:
+        for period, period_buckets in self._accumulate(plays).items():
+            requests = []
+            for key, bucket in period_buckets.items():
+                increments = {'plays': bucket.plays, 'ms_played': bucket.ms_played}
+                increments.update(
+                    {f'tracks.{k}': v for k, v in bucket.tracks.items()})
+                increments.update(
+                    {f'artists.{k}': v for k, v in bucket.artists.items()})
+                requests.append(UpdateOne(
+                    {'user_id': self.user_id, period: key},
+                    {'$inc': increments},
+                    upsert=True))
+            if requests:
+                self.collections[period].bulk_write(requests, ordered=False)
+        info_logger.info('Updated listening rollups for %d plays', len(plays))
+
+    def rebuild(self, start: date, end: date, batch_size: int = 5000) -> None:
+        with self.locked('rebuild'):
+            self._rebuild(start, end, batch_size)
+
+    def _rebuild(self, start: date, end: date, batch_size: int) -> None:
+        # Whole ISO weeks are recomputed, so the range is widened to the
+        # surrounding Monday and Sunday
+        start = start - timedelta(days=start.weekday())
+        end = end + timedelta(days=6 - end.weekday())
+        query = {'played_at': {
+            '$gte': datetime.combine(start, time.min),
+            '$lt': datetime.combine(end + timedelta(days=1), time.min),
+        }}
+        cursor = self.database_conn.iterate(
+            query,
+            projection={
+                'played_at': 1,
+                'track.id': 1,
+                'track.duration_ms': 1,
+                'track.artists.id': 1,
+            },
+            batch_size=batch_size)
+        buckets = self._accumulate(cursor)
+
+        bounds = {
+            'day': (day_key(start), day_key(end)),
+            'week': (week_key(start), week_key(end)),
+        }
+        for period, (first, last) in bounds.items():
+            collection = self.collections[period]
+            # Buckets are replaced in place and only the emptied ones are
+            # deleted, readers never see the range missing
+            requests = [ReplaceOne(
+                {'user_id': self.user_id, period: key},
+                {'user_id': self.user_id,
+                 period: key,
+                 'plays': bucket.plays,
+                 'ms_played': bucket.ms_played,
+                 'tracks': dict(bucket.tracks),
+                 'artists': dict(bucket.artists)},
+                upsert=True)
+                for key, bucket in sorted(buckets[period].items())]
+            if requests:
+                collection.bulk_write(requests, ordered=False)
+            collection.delete_many({
+                'user_id': self.user_id,
+                period: {'$gte': first, '$lte': last,
+                         '$nin': list(buckets[period])},
+            })
+            info_logger.info(
+                'Rebuilt %d %s rollups from %s to %s',
+                len(requests), period, first, last)
+
+    def _summarize(self, period: str, document: dict) -> dict:
+        artists = document.get('artists', {})
+        return {
+            period: document[period],
+            'plays': document.get('plays', 0),
+            'ms_played': document.get('ms_played', 0),
+            'distinct_tracks': len(document.get('tracks', {})),
+            'distinct_artists': len(artists),
+            'top_artists': heapq.nlargest(
+                self.top_k, artists.items(), key=lambda item: item[1]),
+        }
+
+    def _read(self, period: str, first: str, last: str) -> List[dict]:
+        cursor = self.collections[period].find(
+            {'user_id': self.user_id, period: {'$gte': first, '$lte': last}},
+            projection={'_id': 0}).sort(period, ASCENDING)
+        return [self._summarize(period, document) for document in cursor]
+
+    def daily(self, start: date, end: date) -> List[dict]:
+        return self._read('day', day_key(start), day_key(end))
+
+    def weekly(self, start: date, end: date) -> List[dict]:
+        return self._read('week', week_key(start), week_key(end))
+
+    def top(
+            self,
+            kind: Literal['artists', 'tracks'],
+            start: date,
+            end: date,
+            limit: int = 10) -> List[Tuple[str, int]]:
+        counts = Counter()
+        cursor = self.collections['day'].find(
+            {'user_id': self.user_id,
+             'day': {'$gte': day_key(start), '$lte': day_key(end)}},
+            projection={kind: 1, '_id': 0})
+        for document in cursor:
+            counts.update(document.get(kind, {}))
+        return counts.most_common(limit)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Recompute listening rollups for a date range')
+    parser.add_argument('--start', type=date.fromisoformat, required=True)
+    parser.add_argument('--end', type=date.fromisoformat, required=True)
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--tbl', default='song_history')
+    parser.add_argument('--user-id', default='default')
+    parser.add_argument('--time-series', action='store_true')
+    args = parser.parse_args()
+
+    with MongoConnection(
+            db=args.db,
+            tbl=args.tbl,
+            host=os.environ.get('WSL_HOST', 'localhost'),
+            user_id=args.user_id,
+            time_series=args.time_series) as database_conn:
+        ListeningRollups(database_conn).rebuild(args.start, args.end)
@@ -0,0 +1,231 @@
+import argparse
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pydantic
+
+from .db_connection import MongoConnection
+from .logging.logger import info_logger, debug_logger
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entities (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    entity_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    detail TEXT NOT NULL DEFAULT '',
+    plays INTEGER NOT NULL DEFAULT 0,
+    last_played TEXT,
+    UNIQUE (kind, entity_id)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS names USING fts5(
+    name, detail,
+    content='entities', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2',
+    prefix='1 2 3'
+);
+CREATE TRIGGER IF NOT EXISTS entities_insert AFTER INSERT ON entities BEGIN
+    INSERT INTO names (rowid, name, detail)
+        VALUES (new.id, new.name, new.detail);
+END;
+CREATE TRIGGER IF NOT EXISTS entities_rename AFTER UPDATE OF name, detail
+        ON entities WHEN old.name IS NOT new.name
+        OR old.detail IS NOT new.detail BEGIN
+    INSERT INTO names (names, rowid, name, detail)
+        VALUES ('delete', old.id, old.name, old.detail);
+    INSERT INTO names (rowid, name, detail)
+        VALUES (new.id, new.name, new.detail);
+END;
+CREATE TRIGGER IF NOT EXISTS entities_delete AFTER DELETE ON entities BEGIN
+    INSERT INTO names (names, rowid, name, detail)
+        VALUES ('delete', old.id, old.name, old.detail);
+END;
+'''
+KINDS = ('track', 'album', 'artist')
+_TOKEN = re.compile(r'\w+')
+
+
+def normalize(text: str) -> str:
+    # Same folding as the unicode61 tokenizer with remove_diacritics
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(
+        char for char in decomposed if not unicodedata.combining(char)
+        ).casefold()
+
+
+def _play_entities(play) -> Tuple[str, List[Tuple[str, str, str, str]]]:
+    if isinstance(play, pydantic.BaseModel):
+        play = play.dict()
+    track = play['track']
+    album = track['album']
+    artists = ', '.join(artist['name'] for artist in track['artists'])
+    entities = [
+        ('track', track['id'], track['name'], artists),
+        ('album', album['id'], album['name'],
+         ', '.join(artist['name'] for artist in album['artists'])),
+    ]
+    entities += [
+        ('artist', artist['id'], artist['name'], '')
+        for artist in track['artists']]
+    played_at = play['played_at']
+    if isinstance(played_at, datetime):
+        played_at = played_at.isoformat()
+    return played_at, entities
+
+
+class SearchIndex:
+    # Names of every track, album and artist that was played, with a play
+    # count, in a SQLite FTS5 table. The prefix indexes answer typeahead
+    # queries of one to three characters per token without scanning the
+    # term list, matches are ordered by play count.
+    def __init__(
+            self,
+            path: str = 'var/search/index.sqlite3',
+            cache_size: int = 1024) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        # Short prefixes match a large part of the index, so results are
+        # cached until PRAGMA data_version shows a write from any process
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[tuple, List[dict]]' = OrderedDict()
+        self._data_version = None
+
+    def update(self, plays: Iterable) -> int:
+        # Save hook
+        counts: Dict[Tuple[str, str], int] = defaultdict(int)
+        names: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        last_played: Dict[Tuple[str, str], str] = {}
+        for play in plays:
+            played_at, entities = _play_entities(play)
+            for kind, entity_id, name, detail in entities:
+                key = (kind, entity_id)
+                counts[key] += 1
+                names[key] = (name, detail)
+                last_played[key] = max(last_played.get(key, ''), played_at)
+        if not counts:
+            return 0
+        # The triggers keep the FTS table in sync, renamed entities are
+        # re-indexed and everything else only touches the counters
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT INTO entities '
+                '(kind, entity_id, name, detail, plays, last_played) '
+                'VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (kind, entity_id) DO UPDATE SET '
+                'name = excluded.name, detail = excluded.detail, '
+                'plays = plays + excluded.plays, '
+                'last_played = MAX(COALESCE(last_played, excluded.last_played), '
+                'excluded.last_played)',
+                [(*key, *names[key], plays_count, last_played[key])
+                 for key, plays_count in counts.items()])
+            # data_version only counts commits of other connections
+            self._cache.clear()
+        debug_logger.debug('Indexed %d names for search', len(counts))
+        return len(counts)
+
+    def search(
+            self,
+            query: str,
+            kinds: Optional[Iterable[str]] = None,
+            limit: int = 10,
+            include_detail: bool = False) -> List[dict]:
+        tokens = _TOKEN.findall(normalize(query))
+        if not tokens:
+            return []
+        # Every token is a prefix, quoting keeps FTS5 operators literal
+        column = '' if include_detail else 'name : '
+        match = ' AND '.join(f'{column}"{token}"*' for token in tokens)
+        sql = ('SELECT e.kind, e.entity_id, e.name, e.detail, e.plays, '
+               'e.last_played FROM names JOIN entities e ON e.id = names.rowid '
+               'WHERE names MATCH ?')
+        params: list = [match]
+        if kinds:
+            kinds = list(kinds)
+            sql += f' AND e.kind IN ({", ".join("?" for _ in kinds)})'
+            params += kinds
+        sql += ' ORDER BY e.plays DESC, e.name LIMIT ?'
+        params.append(limit)
+        key = tuple(params) + (include_detail,)
+        with self._lock:
+            data_version = self._db.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                self._cache.clear()
+                self._data_version = data_version
+            results = self._cache.get(key)
+            if results is not None:
+                self._cache.move_to_end(key)
+                return results
+            rows = self._db.execute(sql, params).fetchall()
+            results = [
+                {'kind': kind, 'id': entity_id, 'name': name, 'detail': detail,
+                 'plays': plays, 'last_played': last}
+                for kind, entity_id, name, detail, plays, last in rows]
+            self._cache[key] = results
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return results
+
+    def rebuild(self, plays: Iterable, batch_size: int = 5000) -> int:
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM entities')
+            self._cache.clear()
+        batch = []
+        total = 0
+        for play in plays:
+            batch.append(play)
+            if len(batch) == batch_size:
+                self.update(batch)
+                total += len(batch)
+                batch = []
+        self.update(batch)
+        total += len(batch)
+        with self._lock, self._db:
+            self._db.execute("INSERT INTO names (names) VALUES ('optimize')")
+        info_logger.info('Rebuilt search index from %d plays', total)
+        return total
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Search the names of played tracks, albums and artists')
+    parser.add_argument('query', nargs='?')
+    parser.add_argument('--kind', action='append', choices=KINDS)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--path', default='var/search/index.sqlite3')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the index from MongoDB')
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--tbl', default='song_history')
+    args = parser.parse_args()
+
+    index = SearchIndex(args.path)
+    if args.rebuild:
+        with MongoConnection(
+                db=args.db,
+                tbl=args.tbl,
+                host=os.environ.get('WSL_HOST', 'localhost')) as database_conn:
+            index.rebuild(database_conn.iterate(
+                {}, projection={
+                    'played_at': 1, 'track.id': 1, 'track.name': 1,
+                    'track.artists': 1, 'track.album.id': 1,
+                    'track.album.name': 1, 'track.album.artists': 1}))
+    if args.query:
+        for result in index.search(args.query, args.kind, args.limit):
+            print(f'{result["plays"]:6d}  {result["kind"]:6s}  '
+                  f'{result["name"]}  {result["detail"]}')
+    index.close()
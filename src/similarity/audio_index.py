@@ -0,0 +1,355 @@
+import argparse
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from ..db_connection import MongoConnection
+from ..history_queries import HistoryQueryRepository
+from ..logging.logger import info_logger, debug_logger
+
+# Feature name and the (low, high) range it is scaled from to 0..1
+AUDIO_FEATURES: Tuple[Tuple[str, float, float], ...] = (
+    ('danceability', 0.0, 1.0),
+    ('energy', 0.0, 1.0),
+    ('key', 0.0, 11.0),
+    ('loudness', -60.0, 0.0),
+    ('mode', 0.0, 1.0),
+    ('speechiness', 0.0, 1.0),
+    ('acousticness', 0.0, 1.0),
+    ('instrumentalness', 0.0, 1.0),
+    ('liveness', 0.0, 1.0),
+    ('valence', 0.0, 1.0),
+    ('tempo', 0.0, 250.0),
+)
+DIMENSIONS = len(AUDIO_FEATURES)
+_LOW = np.array([low for _, low, _ in AUDIO_FEATURES], dtype=np.float32)
+_SPAN = np.array(
+    [high - low for _, low, high in AUDIO_FEATURES], dtype=np.float32)
+
+Match = Tuple[str, float]
+
+
+def feature_matrix(features: Sequence[dict]) -> np.ndarray:
+    raw = np.array(
+        [[feature.get(name) or 0.0 for name, _, _ in AUDIO_FEATURES]
+         for feature in features], dtype=np.float32).reshape(-1, DIMENSIONS)
+    scaled = np.clip((raw - _LOW) / _SPAN, 0.0, 1.0)
+    # Centre before normalising, otherwise every vector points into the
+    # positive orthant and all cosine similarities end up close to 1
+    return normalize(scaled - 0.5)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    # Row-wise indices of the k largest scores, best first
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+class AudioFeatureIndex:
+    # Unit length float32 vectors are appended to vectors.f32 and memory
+    # mapped for queries, track ids go line by line into ids.txt. The dot
+    # product of two rows is their cosine similarity. An optional IVF index
+    # (spherical k-means lists) narrows large catalogues to a few lists.
+    def __init__(
+            self,
+            directory: str = 'var/similarity',
+            chunk_rows: int = 65536) -> None:
+        self.directory = directory
+        self.chunk_rows = chunk_rows
+        os.makedirs(directory, exist_ok=True)
+        self.vector_path = os.path.join(directory, 'vectors.f32')
+        self.id_path = os.path.join(directory, 'ids.txt')
+        self.ivf_path = os.path.join(directory, 'ivf.npz')
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments: Optional[np.ndarray] = None
+        self._lists: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self._vectors: Optional[np.ndarray] = None
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, track_id: str) -> bool:
+        return track_id in self.rows
+
+    def _load(self) -> None:
+        if os.path.exists(self.id_path):
+            with open(self.id_path, 'r') as file:
+                self.ids = file.read().split()
+        row_bytes = DIMENSIONS * 4
+        stored = 0
+        if os.path.exists(self.vector_path):
+            stored = os.path.getsize(self.vector_path) // row_bytes
+        # A crash between the two appends leaves one file longer
+        count = min(stored, len(self.ids))
+        if count < stored:
+            with open(self.vector_path, 'r+b') as file:
+                file.truncate(count * row_bytes)
+        if count < len(self.ids):
+            self.ids = self.ids[:count]
+            self._write_ids(self.ids, 'w')
+        self.rows = {track_id: row for row, track_id in enumerate(self.ids)}
+        self._map()
+        if os.path.exists(self.ivf_path):
+            with np.load(self.ivf_path) as ivf:
+                self.centroids = ivf['centroids']
+                self.assignments = ivf['assignments']
+            self._assign_new_rows()
+        debug_logger.debug(
+            'Loaded audio feature index with %d tracks', len(self.ids))
+
+    def _map(self) -> None:
+        if not self.ids:
+            self._vectors = np.empty((0, DIMENSIONS), dtype=np.float32)
+            return
+        self._vectors = np.memmap(
+            self.vector_path, dtype=np.float32, mode='r',
+            shape=(len(self.ids), DIMENSIONS))
+
+    def _write_ids(self, ids: Iterable[str], mode: str) -> None:
+        with open(self.id_path, mode) as file:
+            file.write(''.join(f'{track_id}\n' for track_id in ids))
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors
+
+    def add(self, features: Iterable[Optional[dict]]) -> int:
+        new = {}
+        for feature in features:
+            if not feature or not feature.get('id'):
+                continue
+            if feature['id'] not in self.rows:
+                new[feature['id']] = feature
+        if not new:
+            return 0
+        matrix = feature_matrix(list(new.values()))
+        with open(self.vector_path, 'ab') as file:
+            file.write(matrix.tobytes())
+        self._write_ids(new, 'a')
+        for track_id in new:
+            self.rows[track_id] = len(self.ids)
+            self.ids.append(track_id)
+        self._map()
+        self._assign_new_rows()
+        info_logger.info('Added %d tracks to the audio feature index', len(new))
+        return len(new)
+
+    def vector(self, track_id: str) -> np.ndarray:
+        return np.array(self._vectors[self.rows[track_id]])
+
+    def build_ivf(
+            self,
+            n_lists: Optional[int] = None,
+            iterations: int = 10,
+            sample_size: int = 100000,
+            seed: int = 0) -> None:
+        count = len(self.ids)
+        if count == 0:
+            return
+        n_lists = n_lists or max(1, int(np.sqrt(count)))
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(self._vectors[np.sort(rng.choice(
+            count, size=min(sample_size, count), replace=False))])
+        centroids = sample[rng.choice(
+            len(sample), size=min(n_lists, len(sample)), replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalize(sums)
+        self.centroids = centroids
+        self.assignments = self._assign(0, count)
+        self._save_ivf()
+        info_logger.info(
+            'Built IVF index with %d lists over %d tracks',
+            len(centroids), count)
+
+    def _assign(self, start: int, stop: int) -> np.ndarray:
+        labels = [
+            np.argmax(np.asarray(
+                self._vectors[offset:min(offset + self.chunk_rows, stop)])
+                @ self.centroids.T, axis=1).astype(np.int32)
+            for offset in range(start, stop, self.chunk_rows)]
+        return np.concatenate(labels) if labels else np.empty(0, np.int32)
+
+    def _assign_new_rows(self) -> None:
+        if self.centroids is None or len(self.assignments) >= len(self.ids):
+            return
+        self.assignments = np.concatenate([
+            self.assignments, self._assign(len(self.assignments), len(self.ids))])
+        self._save_ivf()
+
+    def _save_ivf(self) -> None:
+        self._lists = None
+        tmp_path = self.ivf_path + '.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, assignments=self.assignments)
+        os.replace(tmp_path, self.ivf_path)
+
+    def search(
+            self,
+            queries: np.ndarray,
+            k: int = 10,
+            exclude: Iterable[str] = (),
+            approximate: bool = False,
+            n_probe: int = 8) -> List[List[Match]]:
+        queries = normalize(np.atleast_2d(queries).astype(np.float32))
+        excluded = np.array(
+            [self.rows[track_id] for track_id in exclude
+             if track_id in self.rows], dtype=np.int64)
+        wanted = k + len(excluded)
+        if approximate and self.centroids is not None:
+            best_rows, best_scores = self._search_ivf(queries, wanted, n_probe)
+        else:
+            best_rows, best_scores = self._search_exact(queries, wanted)
+        results = []
+        for rows, scores in zip(best_rows, best_scores):
+            keep = ~np.isin(rows, excluded) & (rows >= 0)
+            results.append([
+                (self.ids[row], float(score))
+                for row, score in zip(rows[keep][:k], scores[keep][:k])])
+        return results
+
+    def _search_exact(
+            self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        # Chunks keep the score matrix bounded, per chunk winners are merged
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for offset in range(0, len(self.ids), self.chunk_rows):
+            chunk = np.asarray(self._vectors[offset:offset + self.chunk_rows])
+            scores = queries @ chunk.T
+            top = _top_k(scores, k)
+            best_rows = np.concatenate([best_rows, top + offset], axis=1)
+            best_scores = np.concatenate(
+                [best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            top = _top_k(best_scores, k)
+            best_rows = np.take_along_axis(best_rows, top, axis=1)
+            best_scores = np.take_along_axis(best_scores, top, axis=1)
+        return best_rows, best_scores
+
+    def _search_ivf(
+            self,
+            queries: np.ndarray,
+            k: int,
+            n_probe: int) -> Tuple[np.ndarray, np.ndarray]:
+        if self._lists is None:
+            # Row numbers grouped by list, with the start offset of each list
+            order = np.argsort(self.assignments, kind='stable')
+            bounds = np.searchsorted(
+                self.assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = order, bounds
+        order, bounds = self._lists
+        probes = _top_k(queries @ self.centroids.T, n_probe)
+        best_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for position, (query, lists) in enumerate(zip(queries, probes)):
+            candidates = np.sort(np.concatenate(
+                [order[bounds[label]:bounds[label + 1]] for label in lists]))
+            if not len(candidates):
+                continue
+            scores = np.asarray(self._vectors[candidates]) @ query
+            top = _top_k(scores[np.newaxis, :], k)[0]
+            best_rows[position, :len(top)] = candidates[top]
+            best_scores[position, :len(top)] = scores[top]
+        return best_rows, best_scores
+
+    def similar_to(
+            self,
+            track_ids: Iterable[str],
+            k: int = 10,
+            **kwargs) -> List[Match]:
+        # Tracks most similar to the centroid of the given ones
+        seeds = [track_id for track_id in track_ids if track_id in self.rows]
+        if not seeds:
+            return []
+        centroid = np.asarray(
+            self._vectors[sorted(self.rows[seed] for seed in seeds)]).mean(axis=0)
+        return self.search(centroid, k=k, exclude=seeds, **kwargs)[0]
+
+
+class AudioFeatureEnricher:
+    # Save hook that fetches audio features for newly played tracks
+    def __init__(
+            self,
+            interaction,
+            index: AudioFeatureIndex,
+            batch_size: int = 100) -> None:
+        self.interaction = interaction
+        self.index = index
+        self.batch_size = batch_size
+
+    def enrich(self, track_ids: Iterable[str]) -> int:
+        missing = list(dict.fromkeys(
+            track_id for track_id in track_ids if track_id not in self.index))
+        added = 0
+        for offset in range(0, len(missing), self.batch_size):
+            features = self.interaction.get_audio_features(
+                missing[offset:offset + self.batch_size])
+            added += self.index.add(features)
+        return added
+
+    def update(self, plays: list) -> None:
+        self.enrich(
+            play.track.id if hasattr(play, 'track') else play['track']['id']
+            for play in plays)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Maintain and query the audio feature similarity index')
+    parser.add_argument('--directory', default='var/similarity')
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--tbl', default='song_history')
+    parser.add_argument('--enrich', action='store_true',
+                        help='Fetch audio features for all listened tracks')
+    parser.add_argument('--build-ivf', type=int, nargs='?', const=0,
+                        help='Build the approximate index with N lists')
+    parser.add_argument('--similar-today', action='store_true')
+    parser.add_argument('--track', action='append', default=[])
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--approximate', action='store_true')
+    args = parser.parse_args()
+
+    index = AudioFeatureIndex(args.directory)
+    with MongoConnection(
+            db=args.db,
+            tbl=args.tbl,
+            host=os.environ.get('WSL_HOST', 'localhost')) as database_conn:
+        history = HistoryQueryRepository(database_conn)
+        if args.enrich:
+            from .._auth.auth_flows import ClientCredentialsFlow
+            from ..spotify_interaction import SpotifyInteraction
+            enricher = AudioFeatureEnricher(
+                SpotifyInteraction(ClientCredentialsFlow()), index)
+            enricher.enrich(
+                play['track']['id']
+                for play in history.iterate(fields=['track.id']))
+        seeds = list(args.track)
+        if args.similar_today:
+            today = datetime.now(timezone.utc).replace(
+                hour=0, minute=0, second=0, microsecond=0)
+            seeds += [play['track']['id'] for play in history.iterate(
+                start=today, fields=['track.id'])]
+
+    if args.build_ivf is not None:
+        index.build_ivf(args.build_ivf or None)
+    if seeds:
+        for track_id, score in index.similar_to(
+                seeds, k=args.k, approximate=args.approximate):
+            print(f'{score:.4f}  {track_id}')
@@ -0,0 +1,489 @@
+import argparse
+import hashlib
+import math
+import os
+import zlib
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pydantic
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+
+from .db_connection import MongoClientManager, MongoConnection
+from .logging.logger import info_logger, debug_logger
+
+FLEET = '_all'
+PERIODS = {'month': '%Y-%m', 'year': '%Y'}
+_MASK64 = (1 << 64) - 1
+
+
+def _hash64(value: str) -> int:
+    # Stable across processes, unlike hash()
+    return int.from_bytes(
+        hashlib.blake2b(value.encode(), digest_size=8).digest(), 'little')
+
+
+def _pack(array: np.ndarray) -> bytes:
+    return zlib.compress(array.tobytes(), 1)
+
+
+def _unpack(data: bytes, dtype, shape=None) -> np.ndarray:
+    array = np.frombuffer(zlib.decompress(data), dtype=dtype).copy()
+    return array if shape is None else array.reshape(shape)
+
+
+def _sigma(x: float) -> float:
+    if x == 1:
+        return math.inf
+    y, z = 1.0, x
+    while True:
+        x *= x
+        previous = z
+        z += x * y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x: float) -> float:
+    if x in (0, 1):
+        return 0.0
+    y, z = 1.0, 1 - x
+    while True:
+        x = math.sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1 - x) ** 2 * y
+        if z == previous:
+            return z / 3
+
+
+class HyperLogLog:
+    # 2**p one byte registers, the standard error is 1.04 / sqrt(2**p),
+    # 0.8% for p = 14. Merging takes the register wise maximum.
+    def __init__(self, p: int = 14) -> None:
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def add(self, value: str) -> None:
+        hashed = _hash64(value)
+        index = hashed >> (64 - self.p)
+        rest = (hashed << self.p) & _MASK64
+        rank = 64 - rest.bit_length() + 1 if rest else 64 - self.p + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        if other.p != self.p:
+            raise ValueError('Cannot merge HyperLogLogs of different precision')
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self) -> int:
+        # Ertl's improved estimator, unbiased over the whole range without
+        # switching to linear counting or empirical bias tables
+        size = len(self.registers)
+        q = 64 - self.p
+        histogram = np.bincount(self.registers, minlength=q + 2)
+        z = size * _tau(1 - histogram[q + 1] / size)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += size * _sigma(histogram[0] / size)
+        return round(size * size / (2 * math.log(2)) / z)
+
+    def to_document(self) -> dict:
+        return {'p': self.p, 'registers': _pack(self.registers)}
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'HyperLogLog':
+        sketch = cls(document['p'])
+        sketch.registers = _unpack(document['registers'], np.uint8)
+        return sketch
+
+
+class CountMinSketch:
+    # depth rows of width counters. An estimate never undercounts and
+    # overcounts by at most e / width of the total with probability
+    # 1 - exp(-depth). Sketches of the same shape merge by addition.
+    def __init__(self, width: int = 2048, depth: int = 5) -> None:
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype=np.uint32)
+        self.total = 0
+
+    def _columns(self, key: str) -> np.ndarray:
+        # Double hashing, one 64 bit hash gives all rows
+        hashed = _hash64(key)
+        low, high = hashed & 0xFFFFFFFF, hashed >> 32
+        return (low + np.arange(self.depth, dtype=np.uint64) * (high | 1)) \
+            % self.width
+
+    def add(self, key: str, count: int = 1) -> int:
+        columns = self._columns(key)
+        rows = np.arange(self.depth)
+        self.table[rows, columns] += count
+        self.total += count
+        return int(self.table[rows, columns].min())
+
+    def estimate(self, key: str) -> int:
+        return int(self.table[np.arange(self.depth), self._columns(key)].min())
+
+    def merge(self, other: 'CountMinSketch') -> 'CountMinSketch':
+        if self.table.shape != other.table.shape:
+            raise ValueError('Cannot merge Count-Min sketches of different shape')
+        self.table += other.table
+        self.total += other.total
+        return self
+
+    def to_document(self) -> dict:
+        return {'width': self.width, 'depth': self.depth, 'total': self.total,
+                'table': _pack(self.table)}
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'CountMinSketch':
+        sketch = cls(document['width'], document['depth'])
+        sketch.table = _unpack(
+            document['table'], np.uint32, (sketch.depth, sketch.width))
+        sketch.total = document['total']
+        return sketch
+
+
+class HeavyHitters:
+    # A Count-Min sketch plus the capacity keys with the highest estimates.
+    # Keys that were never candidates in any merged part can be missed, so
+    # capacity should be well above the top-k that is queried.
+    def __init__(self, capacity: int = 200, **sketch_args) -> None:
+        self.capacity = capacity
+        self.sketch = CountMinSketch(**sketch_args)
+        self.candidates: Dict[str, int] = {}
+
+    def add(self, key: str, count: int = 1) -> None:
+        estimate = self.sketch.add(key, count)
+        if key in self.candidates or len(self.candidates) < self.capacity:
+            self.candidates[key] = estimate
+            return
+        if len(self.candidates) < 2 * self.capacity:
+            self.candidates[key] = estimate
+        else:
+            self._trim()
+            if estimate > min(self.candidates.values()):
+                self.candidates[key] = estimate
+
+    def _trim(self) -> None:
+        ranked = sorted(
+            ((self.sketch.estimate(key), key) for key in self.candidates),
+            reverse=True)[:self.capacity]
+        self.candidates = {key: estimate for estimate, key in ranked}
+
+    def merge(self, other: 'HeavyHitters') -> 'HeavyHitters':
+        self.sketch.merge(other.sketch)
+        self.candidates.update(other.candidates)
+        self._trim()
+        return self
+
+    def top(self, limit: int = 10) -> List[Tuple[str, int]]:
+        self._trim()
+        return list(self.candidates.items())[:limit]
+
+    def to_document(self) -> dict:
+        self._trim()
+        return {'capacity': self.capacity, 'sketch': self.sketch.to_document(),
+                'candidates': list(self.candidates)}
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'HeavyHitters':
+        hitters = cls(document['capacity'])
+        hitters.sketch = CountMinSketch.from_document(document['sketch'])
+        hitters.candidates = {
+            key: hitters.sketch.estimate(key) for key in document['candidates']}
+        return hitters
+
+
+class TDigest:
+    # Merging t-digest with the arcsine scale function: at most about
+    # compression centroids, small ones near the tails so extreme quantiles
+    # stay accurate. Digests merge by compressing their joint centroids.
+    def __init__(self, compression: float = 100) -> None:
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self._buffer: List[float] = []
+
+    def add(self, value: float) -> None:
+        self._buffer.append(value)
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+        if len(self._buffer) >= 10 * self.compression:
+            self._compress()
+
+    @property
+    def count(self) -> int:
+        return int(self.weights.sum()) + len(self._buffer)
+
+    def _scale(self, q: float) -> float:
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def _scale_inverse(self, k: float) -> float:
+        return (math.sin(min(k * 2 * math.pi / self.compression, math.pi / 2))
+                + 1) / 2
+
+    def _compress(
+            self,
+            means: Optional[np.ndarray] = None,
+            weights: Optional[np.ndarray] = None) -> None:
+        means = np.concatenate([
+            self.means, np.asarray(self._buffer, dtype=float),
+            means if means is not None else []])
+        weights = np.concatenate([
+            self.weights, np.ones(len(self._buffer)),
+            weights if weights is not None else []])
+        self._buffer = []
+        if not len(means):
+            return
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        merged_means, merged_weights = [], []
+        mean, weight = means[0], weights[0]
+        done = 0.0
+        limit = total * self._scale_inverse(self._scale(0) + 1)
+        for next_mean, next_weight in zip(means[1:], weights[1:]):
+            if done + weight + next_weight <= limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                merged_means.append(mean)
+                merged_weights.append(weight)
+                done += weight
+                limit = total * self._scale_inverse(
+                    self._scale(done / total) + 1)
+                mean, weight = next_mean, next_weight
+        merged_means.append(mean)
+        merged_weights.append(weight)
+        self.means = np.asarray(merged_means)
+        self.weights = np.asarray(merged_weights)
+
+    def merge(self, other: 'TDigest') -> 'TDigest':
+        other._compress()
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self._compress(other.means, other.weights)
+        return self
+
+    def quantile(self, q: float) -> Optional[float]:
+        self._compress()
+        if not len(self.means):
+            return None
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        return float(np.interp(
+            q * total,
+            np.concatenate([[0], centers, [total]]),
+            np.concatenate([[self.minimum], self.means, [self.maximum]])))
+
+    def to_document(self) -> dict:
+        self._compress()
+        return {'compression': self.compression,
+                'minimum': self.minimum, 'maximum': self.maximum,
+                'means': _pack(self.means), 'weights': _pack(self.weights)}
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'TDigest':
+        digest = cls(document['compression'])
+        digest.means = _unpack(document['means'], float)
+        digest.weights = _unpack(document['weights'], float)
+        digest.minimum = document['minimum']
+        digest.maximum = document['maximum']
+        return digest
+
+
+class PlaySketch:
+    # Everything kept per user and time bucket
+    def __init__(self) -> None:
+        self.plays = 0
+        self.tracks = HyperLogLog()
+        self.artists = HyperLogLog()
+        self.top_tracks = HeavyHitters()
+        self.top_artists = HeavyHitters()
+        self.durations = TDigest()
+
+    def add(self, track_id: str, artist_ids: List[str], duration_ms: int) -> None:
+        self.plays += 1
+        self.tracks.add(track_id)
+        self.top_tracks.add(track_id)
+        for artist_id in artist_ids:
+            self.artists.add(artist_id)
+            self.top_artists.add(artist_id)
+        self.durations.add(duration_ms)
+
+    def merge(self, other: 'PlaySketch') -> 'PlaySketch':
+        self.plays += other.plays
+        self.tracks.merge(other.tracks)
+        self.artists.merge(other.artists)
+        self.top_tracks.merge(other.top_tracks)
+        self.top_artists.merge(other.top_artists)
+        self.durations.merge(other.durations)
+        return self
+
+    def to_document(self) -> dict:
+        return {
+            'plays': self.plays,
+            'tracks': self.tracks.to_document(),
+            'artists': self.artists.to_document(),
+            'top_tracks': self.top_tracks.to_document(),
+            'top_artists': self.top_artists.to_document(),
+            'durations': self.durations.to_document(),
+        }
+
+    @classmethod
+    def from_document(cls, document: dict) -> 'PlaySketch':
+        sketch = cls()
+        sketch.plays = document['plays']
+        sketch.tracks = HyperLogLog.from_document(document['tracks'])
+        sketch.artists = HyperLogLog.from_document(document['artists'])
+        sketch.top_tracks = HeavyHitters.from_document(document['top_tracks'])
+        sketch.top_artists = HeavyHitters.from_document(document['top_artists'])
+        sketch.durations = TDigest.from_document(document['durations'])
+        return sketch
+
+
+def _play_fields(play) -> Tuple[datetime, str, List[str], int]:
+    if isinstance(play, pydantic.BaseModel):
+        track = play.track
+        return (play.played_at, track.id,
+                [artist.id for artist in track.artists], track.duration_ms)
+    track = play['track']
+    return (play['played_at'], track['id'],
+            [artist['id'] for artist in track['artists']], track['duration_ms'])
+
+
+class SketchStore:
+    # One document per user, period and bucket in the `sketches` collection,
+    # plus the same buckets for the whole fleet under user id '_all'. Each
+    # save merges a sketch of the new plays into the stored one and replaces
+    # it only if its version did not change in between, so concurrent
+    # workers never lose an update. Reads are a handful of documents of a
+    # few hundred KB at most, whatever the number of plays behind them.
+    def __init__(
+            self,
+            database_conn: MongoConnection,
+            tbl: str = 'sketches',
+            retries: int = 20) -> None:
+        self.database_conn = database_conn
+        self.user_id = database_conn.user_id
+        self.collection = database_conn.conn[database_conn.db][tbl]
+        self.retries = retries
+        MongoClientManager.ensure_indexes(self.collection, [IndexModel(
+            [('user_id', ASCENDING), ('period', ASCENDING),
+             ('bucket', ASCENDING)], name='user_period_bucket')])
+
+    @staticmethod
+    def _id(user_id: str, period: str, bucket: str) -> str:
+        return f'{user_id}:{period}:{bucket}'
+
+    def _merge_into(
+            self, user_id: str, period: str, bucket: str,
+            delta: PlaySketch) -> None:
+        _id = self._id(user_id, period, bucket)
+        for _ in range(self.retries):
+            stored = self.collection.find_one({'_id': _id})
+            sketch = PlaySketch() if stored is None \
+                else PlaySketch.from_document(stored)
+            sketch.merge(delta)
+            document = {
+                '_id': _id, 'user_id': user_id, 'period': period,
+                'bucket': bucket, 'updated_at': datetime.utcnow(),
+                'version': 1 if stored is None else stored['version'] + 1,
+                **sketch.to_document()}
+            if stored is None:
+                try:
+                    self.collection.insert_one(document)
+                    return
+                except DuplicateKeyError:
+                    continue
+            result = self.collection.replace_one(
+                {'_id': _id, 'version': stored['version']}, document)
+            if result.matched_count:
+                return
+            debug_logger.debug('Sketch %s changed concurrently, retrying', _id)
+        raise RuntimeError(f'Could not update sketch {_id}')
+
+    def update(
+            self,
+            plays: Iterable,
+            user_ids: Optional[Iterable[str]] = None) -> None:
+        # Save hook
+        deltas: Dict[Tuple[str, str], PlaySketch] = defaultdict(PlaySketch)
+        for play in plays:
+            played_at, track_id, artist_ids, duration_ms = _play_fields(play)
+            for period, pattern in PERIODS.items():
+                deltas[period, played_at.strftime(pattern)].add(
+                    track_id, artist_ids, duration_ms)
+        for user_id in user_ids or (self.user_id, FLEET):
+            for (period, bucket), delta in deltas.items():
+                self._merge_into(user_id, period, bucket, delta)
+        info_logger.info('Updated %d sketches', len(deltas))
+
+    def load(
+            self,
+            period: str,
+            buckets: Iterable[str],
+            user_id: Optional[str] = None) -> PlaySketch:
+        # user_id None reads the fleet wide sketches
+        sketch = PlaySketch()
+        for document in self.collection.find({'_id': {'$in': [
+                self._id(user_id or FLEET, period, bucket)
+                for bucket in buckets]}}):
+            sketch.merge(PlaySketch.from_document(document))
+        return sketch
+
+    def rebuild_fleet(self) -> None:
+        # The fleet buckets are the merge of all user buckets, recomputed
+        # here after user sketches were rebuilt or removed
+        merged: Dict[Tuple[str, str], PlaySketch] = defaultdict(PlaySketch)
+        for document in self.collection.find({'user_id': {'$ne': FLEET}}):
+            merged[document['period'], document['bucket']].merge(
+                PlaySketch.from_document(document))
+        self.collection.delete_many({'user_id': FLEET})
+        for (period, bucket), sketch in merged.items():
+            self._merge_into(FLEET, period, bucket, sketch)
+        info_logger.info('Rebuilt %d fleet sketches', len(merged))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Approximate distinct counts, top lists and durations')
+    parser.add_argument('--period', choices=PERIODS, default='year')
+    parser.add_argument('--bucket', action='append', required=True,
+                        help='e.g. 2021 for years or 2021-07 for months')
+    parser.add_argument('--user-id', default=None,
+                        help='Defaults to all users')
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--rebuild-fleet', action='store_true')
+    args = parser.parse_args()
+
+    with MongoConnection(
+            db=args.db,
+            tbl='song_history',
+            host=os.environ.get('WSL_HOST', 'localhost')) as database_conn:
+        store = SketchStore(database_conn)
+        if args.rebuild_fleet:
+            store.rebuild_fleet()
+        sketch = store.load(args.period, args.bucket, args.user_id)
+        print(f'plays             {sketch.plays}')
+        print(f'distinct tracks   ~{sketch.tracks.count()}')
+        print(f'distinct artists  ~{sketch.artists.count()}')
+        quantiles = [sketch.durations.quantile(q) for q in (0.5, 0.9, 0.99)]
+        if quantiles[0] is not None:
+            print('duration ms p50 / p90 / p99  '
+                  + ' / '.join(f'{value:.0f}' for value in quantiles))
+        for kind, hitters in (('track', sketch.top_tracks),
+                              ('artist', sketch.top_artists)):
+            for key, count in hitters.top(args.top):
+                print(f'{kind:6s} ~{count:8d}  {key}')
@@ -63,8 +63,9 @@ class SpotifyHistoryObject(pydantic.BaseModel):
     context: Optional[SpotifyHistoryObjectContext]
 
     def __init__(self, **data):
-        debug_logger.debug(f'Instantiate Spotify History Object for track' + 
-                            f'{data["track"]["id"]}')
+        debug_logger.debug(
+            'Instantiate Spotify History Object for track %s',
+            data['track']['id'])
         super().__init__(**data)
 
     class Config:
@@ -99,18 +100,18 @@ class SpotifyHistory(pydantic.BaseModel):
     href: str
 
     def __init__(self, **data) -> None:
-        info_logger.info(f'Instantiating Spotify History for {data["href"]}')
+        info_logger.info('Instantiating Spotify History for %s', data['href'])
         super().__init__(**data)
         if self.is_last:
-            info_logger.info(f'Done instantiating final Spotify History')
+            info_logger.info('Done instantiating final Spotify History')
         else:
-            info_logger.info(f'Done instantiating Spotify History from ' + 
-                f'{self.cursors.before_datetime} to ' + 
-                f'{self.cursors.after_datetime}')
+            info_logger.info(
+                'Done instantiating Spotify History from %s to %s',
+                self.cursors.before_datetime, self.cursors.after_datetime)
 
     @property
     def is_last(self) -> bool:
-        debug_logger.debug(f'Is final Spotify History: {not bool(self.next)}')
+        debug_logger.debug('Is final Spotify History: %s', not bool(self.next))
         return not bool(self.next)
 
     def __str__(self) -> str:
@@ -1,35 +1,112 @@
 import requests
-from datetime import datetime, timezone
-from typing import List, Optional, Literal, Union
+from typing import Iterable, List, Optional, Literal, Union
 from pydantic.error_wrappers import ValidationError
 
-from .errors.token_errors import MissingScopeError
-from ._auth.auth_flows import AuthFlow
+from ._auth.auth_flows import AuthFlow, ScopeRouter
 from .db_connection import DatabaseConnection
+from .history_queries import naive_utc, to_ms
 from .request_utils import ApiLogger
 from .logging.logger import info_logger, debug_logger
-from .spotify_data.dataclasses import SpotifyArtist, SpotifyHistory, SpotifySong
-from .config.configure_requests import configure_request
+from .spotify_data.dataclasses import (
+    SpotifyArtist, SpotifyHistory, SpotifyHistoryObject, SpotifySong)
+from .archive.raw_archive import RawResponseArchive
+from .profiling import phase
+from .tracing import tracer, current_span
+from .config.configure_requests import get_session_manager
 
-conf_requests = configure_request()
+conf_requests = get_session_manager().session
+
+# Scope each endpoint needs, None where any token is enough
+ENDPOINT_SCOPES = {
+    'playlist': None,
+    'track': None,
+    'play_history': 'user-read-recently-played',
+    'top_artists_or_tracks': 'user-top-read',
+    'audio_features': None,
+}
+
+
+def required_scope(endpoints: Optional[Iterable[str]] = None) -> str:
+    # One space separated scope covering the endpoints, all by default, so
+    # a single authorization at startup serves the whole run
+    endpoints = ENDPOINT_SCOPES if endpoints is None else endpoints
+    return ' '.join(sorted({
+        ENDPOINT_SCOPES[endpoint] for endpoint in endpoints
+        if ENDPOINT_SCOPES[endpoint]}))
 
 
 class SpotifyInteraction:
     def __init__(
             self, 
-            connection: AuthFlow) -> None:
+            connection: AuthFlow,
+            archive: Optional[RawResponseArchive] = None,
+            user_id: str = 'default',
+            flows: Optional[List[AuthFlow]] = None) -> None:
         info_logger.info(f'Instantiate SpotifyInteraction')
         self.conn = connection
+        self.router = ScopeRouter([connection, *(flows or [])])
+        self.archive = archive
+        self.user_id = user_id
+
+    def _flow(self, endpoint: str) -> AuthFlow:
+        return self.router.flow_for(ENDPOINT_SCOPES[endpoint])
+
+    def _archive_response(
+            self, endpoint: str, response: requests.Response) -> None:
+        if self.archive is None:
+            return
+        try:
+            self.archive.store(
+                endpoint=endpoint,
+                body=response.content,
+                user_id=self.user_id,
+                url=response.url)
+        except Exception:
+            info_logger.exception(f'Archiving {endpoint} response failed')
 
     @ApiLogger('Sending Playlist Request')
     def _get_playlist_req(self, playlist_id: str) -> requests.Response:
-        return self.conn.get_request(
+        return self._flow('playlist').get_request(
             endpoint= f'https://api.spotify.com/v1/playlists/{playlist_id}',
         )
 
     def get_playlist(self, playlist_id: str) -> dict:
         return self._get_playlist_req(playlist_id).json()
 
+    @ApiLogger('Sending Playlist snapshot request')
+    def _get_playlist_snapshot_req(self, playlist_id: str) -> requests.Response:
+        return self._flow('playlist').get_request(
+            endpoint= f'https://api.spotify.com/v1/playlists/{playlist_id}',
+            params = {'fields': 'snapshot_id'}
+        )
+
+    def get_playlist_snapshot_id(self, playlist_id: str) -> str:
+        return self._get_playlist_snapshot_req(playlist_id).json()['snapshot_id']
+
+    @ApiLogger('Sending Playlist tracks request')
+    def _get_playlist_tracks_req(
+            self, playlist_id: str, offset: int) -> requests.Response:
+        return self._flow('playlist').get_request(
+            endpoint= f'https://api.spotify.com/v1/playlists/{playlist_id}/tracks',
+            params = {
+                'fields': 'items(track(id)),next',
+                'limit': 100,
+                'offset': offset,
+            }
+        )
+
+    def get_playlist_track_ids(self, playlist_id: str) -> List[Optional[str]]:
+        # Local files and removed tracks come back without an id
+        track_ids = []
+        while True:
+            page = self._get_playlist_tracks_req(
+                playlist_id, len(track_ids)).json()
+            track_ids += [
+                item['track']['id'] if item.get('track') else None
+                for item in page['items']]
+            if not page.get('next') or not page['items']:
+                return track_ids
+
     @ApiLogger('Sending a Track request')
     def _get_track_req(
             self, 
@@ -38,7 +115,7 @@ class SpotifyInteraction:
         params = None
         if market:
             params = {'market': market}
-        return self.conn.get_request(
+        return self._flow('track').get_request(
             endpoint = f'https://api.spotify.com/v1/tracks/{track_id}',
             params = params
         )
@@ -47,53 +124,52 @@ class SpotifyInteraction:
             self, 
             track_id: str, 
             market: Optional[str] = None) -> SpotifySong:
-        track_resp = self._get_track_req(track_id=track_id, market=market)
-        try:
-            return SpotifySong(**track_resp.json())
-        except ValidationError as e:
-            info_logger.exception(f'SpotifyTrack parsing failed on ' + 
-                                  f'\n{track_resp.json()}\n')
-            raise e
+        with tracer.start_span(
+                'SpotifyInteraction.get_track', **{'track.id': track_id}):
+            track_resp = self._get_track_req(track_id=track_id, market=market)
+            self._archive_response('track', track_resp)
+            try:
+                with phase('parse'), tracer.start_span(
+                        'parse', model='SpotifySong'):
+                    return SpotifySong(**track_resp.json())
+            except ValidationError as e:
+                info_logger.exception(f'SpotifyTrack parsing failed on ' + 
+                                      f'\n{track_resp.json()}\n')
+                raise e
 
     @ApiLogger('Sending Play History Request')
     def _get_play_history_req(
             self, start_point_unix_ms: int) -> requests.Response:
-
-        required_scope = 'user-read-recently-played'
-        self.conn.check_scope(required_scope)
-
         params = {
             'limit': 20,
             'after': start_point_unix_ms
         }
-        return self.conn.get_request(
+        return self._flow('play_history').get_request(
             endpoint = 'https://api.spotify.com/v1/me/player/recently-played/',
             params = params,
         )
 
+    @tracer.traced('SpotifyInteraction.get_play_history_page')
     def _get_play_history(self, start_point_unix_ms: int) -> SpotifyHistory:
-        try:
-            history_resp = self._get_play_history_req(
-                start_point_unix_ms=start_point_unix_ms)
-        except MissingScopeError:
-            info_logger.warning(
-                f'Scope not authorized', exc_info=True)
-            self.conn.reset_refreshing_token('user-top-read')
-            try:
-                history_resp = self._get_play_history_req(
-                    start_point_unix_ms=start_point_unix_ms)
-            except:
-                raise
+        span = current_span()
+        span.set_attribute('page.cursor', start_point_unix_ms)
         history_resp = self._get_play_history_req(
             start_point_unix_ms=start_point_unix_ms)
+        self._archive_response('play_history', history_resp)
         try:
-            return SpotifyHistory(**history_resp.json())
+            with phase('parse'), tracer.start_span(
+                    'parse', model='SpotifyHistory'):
+                history = SpotifyHistory(**history_resp.json())
+            span.set_attribute('page.items', len(history.items))
+            span.set_attribute('page.is_last', history.is_last)
+            return history
         except ValidationError as e:
             info_logger.exception(f'SpotifyHistory parsing failed on ' + 
                                   f'\n{history_resp.json()}\n')
             raise e
 
 
+    @tracer.traced('SpotifyInteraction.get_full_play_history')
     def get_full_play_history(
             self, start_point_unix_ms: int) -> List[SpotifySong]:
 
@@ -103,24 +179,93 @@ class SpotifyInteraction:
         while not history_list[-1].is_last:
             history_list.append(self._get_play_history(
                 start_point_unix_ms=history_list[-1].cursors.after))
-        return [item for hist in history_list for item in hist.items]
+        items = [item for hist in history_list for item in hist.items]
+        span = current_span()
+        span.set_attribute('history.pages', len(history_list))
+        span.set_attribute('history.items', len(items))
+        return items
 
-    def get_new_play_history(
-            self, 
+    def _load_checkpoint(self, database_conn: DatabaseConnection) -> dict:
+        checkpoint = database_conn.load_checkpoint()
+        if checkpoint is not None:
+            info_logger.info(
+                'Resume play history after cursor %s', checkpoint['after'])
+            return checkpoint
+        # First run with checkpoints: start after the newest stored play,
+        # an empty collection gets everything the API still returns
+        newest = database_conn.find_newest()
+        info_logger.info(
+            'No ingestion checkpoint, start after newest stored play %s',
+            newest)
+        return {
+            'after': to_ms(newest) if newest else 0,
+            'played_at': naive_utc(newest) if newest else None,
+            'pending_until': None,
+        }
+
+    def _drop_stored(
+            self,
             database_conn: DatabaseConnection,
-            fallback_datetime: datetime = datetime(
-                2021, 7, 24, 10, 0, tzinfo=timezone.utc)
-                ) -> List[SpotifySong]:
-        try:
-            start_point = database_conn.find_newest()
-            start_point_ts = round(start_point.timestamp() * 1000)
-            info_logger.info(f'Load play history after {start_point}')
-        except:
-            info_logger.warning('No existing start point found in MongoDB, ' + 
-                                f'use fallback timestamp {fallback_datetime}')
-            start_point_ts = round(fallback_datetime.timestamp() * 1000)
+            items: List[SpotifyHistoryObject],
+            checkpoint: dict) -> List[SpotifyHistoryObject]:
+        # Only after a crash between saving a page and committing its
+        # checkpoint: skip the plays of that page that were already stored
+        played_at = {'$lte': checkpoint['pending_until']}
+        if checkpoint['played_at'] is not None:
+            played_at['$gt'] = checkpoint['played_at']
+        stored = {
+            (to_ms(play['played_at']), play['track']['id'])
+            for play in database_conn.find_many(
+                {'played_at': played_at},
+                projection={'played_at': 1, 'track.id': 1, '_id': 0})}
+        return [item for item in items
+                if (to_ms(item.played_at), item.track.id) not in stored]
 
-        return self.get_full_play_history(start_point_ts)
+    @tracer.traced('SpotifyInteraction.ingest_new_play_history')
+    def ingest_new_play_history(
+            self, database_conn: DatabaseConnection) -> int:
+        # Every page is saved and then committed to the checkpoint, an
+        # interrupted walk resumes after the last committed page
+        checkpoint = self._load_checkpoint(database_conn)
+        saved = 0
+        pages = 0
+        while True:
+            history = self._get_play_history(
+                start_point_unix_ms=checkpoint['after'])
+            pages += 1
+            items = history.items
+            if items and checkpoint.get('pending_until') is not None:
+                items = self._drop_stored(database_conn, items, checkpoint)
+            newest = checkpoint['played_at']
+            if history.items:
+                newest = naive_utc(
+                    max(item.played_at for item in history.items))
+            if items:
+                database_conn.save_checkpoint(
+                    {**checkpoint, 'pending_until': newest})
+                database_conn.save_many(items)
+                saved += len(items)
+            after = checkpoint['after']
+            if history.cursors and history.cursors.after:
+                after = history.cursors.after
+            checkpoint = {
+                'after': after, 'played_at': newest, 'pending_until': None}
+            database_conn.save_checkpoint(checkpoint)
+            if history.is_last:
+                break
+        span = current_span()
+        span.set_attribute('history.pages', pages)
+        span.set_attribute('history.items', saved)
+        info_logger.info(
+            'Ingested %d plays from %d pages, checkpoint at cursor %s',
+            saved, pages, checkpoint['after'])
+        return saved
+
+    @tracer.traced('SpotifyInteraction.get_new_play_history')
+    def get_new_play_history(
+            self, database_conn: DatabaseConnection) -> List[SpotifySong]:
+        return self.get_full_play_history(
+            self._load_checkpoint(database_conn)['after'])
 
     @ApiLogger('Sending Top Artist or Track request')
     def _get_top_artists_or_tracks_req(
@@ -130,17 +275,13 @@ class SpotifyInteraction:
                 'short_term', 'medium_term', 'long_term'] = 'medium_term',
             limit: int = 20,
             offset: int = 0) -> requests.Response:
-
-        required_scope = 'user-top-read'
-        self.conn.check_scope(required_scope)
-
         endpoint = f'https://api.spotify.com/v1/me/top/{type}'
         params = {
             'time_range': time_range,
             'limit': limit,
             'offset': offset
         }
-        return self.conn.get_request(
+        return self._flow('top_artists_or_tracks').get_request(
             endpoint = endpoint,
             params = params,
         )
@@ -152,32 +293,26 @@ class SpotifyInteraction:
                 'short_term', 'medium_term', 'long_term'] = 'medium_term',
             limit: int = 20,
             offset: int = 0) -> List[SpotifySong]:
-        try:
-            items = self._get_top_artists_or_tracks_req(
-                type, time_range, limit, offset).json()
-        except MissingScopeError:
-            info_logger.warning(
-                f'Scope not authorized', exc_info=True)
-            self.conn.reset_refreshing_token('user-top-read')
-            try:
-                items = self._get_top_artists_or_tracks_req(
-                    type, time_range, limit, offset).json()
-            except:
-                raise
-        if type == 'tracks':
-            return [SpotifySong(**track) for track in items['items']]
-        return [SpotifyArtist(**artist) for artist in items['items']]
+        top_resp = self._get_top_artists_or_tracks_req(
+            type, time_range, limit, offset)
+        self._archive_response(f'top_{type}', top_resp)
+        with phase('parse'), tracer.start_span(
+                'parse', model=f'top_{type}', **{'top.time_range': time_range}):
+            items = top_resp.json()
+            if type == 'tracks':
+                return [SpotifySong(**track) for track in items['items']]
+            return [SpotifyArtist(**artist) for artist in items['items']]
 
     @ApiLogger('Sending audio feature request')
     def _get_audio_features_req(
             self, track_id: str, multiple_tracks: bool = False) -> requests.Response:
         if multiple_tracks:
             params = {'ids': track_id}
-            return self.conn.get_request(
+            return self._flow('audio_features').get_request(
                 endpoint = f'https://api.spotify.com/v1/audio-features',
                 params = params
             )
-        return self.conn.get_request(
+        return self._flow('audio_features').get_request(
             endpoint = f'https://api.spotify.com/v1/audio-features/{track_id}'
         )
 
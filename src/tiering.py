@@ -0,0 +1,370 @@
+import argparse
+import hashlib
+import heapq
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Optional
+
+import bson
+
+from .archive.codecs import get_codec
+from .db_connection import MongoConnection
+from .history_queries import (
+    FILTER_FIELDS, HistoryPage, HistoryQueryRepository, after_cursor,
+    decode_cursor, encode_cursor, from_ms, naive_utc, sort_key, to_ms)
+from .logging.logger import info_logger, debug_logger
+from .migrations.schema import upgrade
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS segments (
+    name TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    start_ms INTEGER NOT NULL,
+    end_ms INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    codec TEXT NOT NULL,
+    state TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS segments_range
+    ON segments (user_id, start_ms, end_ms);
+'''
+
+
+def _month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(value: datetime) -> datetime:
+    return _month_start(_month_start(value) + timedelta(days=32))
+
+
+def _values(document, path: List[str]) -> list:
+    # Resolves a dotted path through nested documents and arrays
+    if not path:
+        return [document]
+    if isinstance(document, list):
+        return [value for item in document for value in _values(item, path)]
+    if not isinstance(document, dict) or path[0] not in document:
+        return []
+    return _values(document[path[0]], path[1:])
+
+
+def matches(document: dict, **filters) -> bool:
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if value not in _values(document, FILTER_FIELDS[name].split('.')):
+            return False
+    return True
+
+
+class ColdStore:
+    # Plays are kept as BSON documents sorted by played_at, compressed as a
+    # whole into one segment file per month and tiering run. The SQLite
+    # index holds the time range of every segment, so range reads only open
+    # the overlapping ones.
+    def __init__(
+            self,
+            directory: str = 'var/cold',
+            codec: str = 'auto',
+            cache_segments: int = 8) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.codec = get_codec(codec)
+        self._codecs = {self.codec.name: self.codec}
+        self._db = sqlite3.connect(
+            os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        self._cache: 'OrderedDict[str, List[dict]]' = OrderedDict()
+        self.cache_segments = cache_segments
+        self._lock = threading.Lock()
+
+    def write_segment(self, documents: List[dict], user_id: str) -> str:
+        documents = sorted(documents, key=lambda document: document['played_at'])
+        start = to_ms(documents[0]['played_at'])
+        end = to_ms(documents[-1]['played_at'])
+        month = from_ms(start).strftime('%Y-%m')
+        name = f'{user_id}/{month}/{start}-{end}-{time.time_ns()}.seg'
+        payload = self.codec.compress(
+            b''.join(bson.encode(document) for document in documents))
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(payload)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (name, user_id, start, end, len(documents), len(payload),
+                 hashlib.sha256(payload).hexdigest(), self.codec.name,
+                 'written'))
+        debug_logger.debug(
+            'Wrote cold segment %s with %d plays', name, len(documents))
+        return name
+
+    def _segment_row(self, name: str) -> tuple:
+        with self._lock:
+            return self._db.execute(
+                'SELECT count, sha256, codec FROM segments WHERE name = ?',
+                (name,)).fetchone()
+
+    def _read_file(self, name: str, codec_name: str) -> List[dict]:
+        with open(os.path.join(self.directory, name), 'rb') as file:
+            payload = file.read()
+        if codec_name not in self._codecs:
+            self._codecs[codec_name] = get_codec(codec_name)
+        return bson.decode_all(self._codecs[codec_name].decompress(payload))
+
+    def verify(self, name: str, ids: Optional[set] = None) -> bool:
+        # Re-reads the file: checksum, document count and, if given, that
+        # exactly the expected _ids made it into the segment
+        count, sha256, codec_name = self._segment_row(name)
+        with open(os.path.join(self.directory, name), 'rb') as file:
+            if hashlib.sha256(file.read()).hexdigest() != sha256:
+                return False
+        documents = self._read_file(name, codec_name)
+        if len(documents) != count:
+            return False
+        if ids is not None and {document['_id'] for document in documents} != ids:
+            return False
+        self._set_state(name, 'verified')
+        return True
+
+    def _set_state(self, name: str, state: str) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                'UPDATE segments SET state = ? WHERE name = ?', (state, name))
+
+    def mark_deleted(self, name: str) -> None:
+        self._set_state(name, 'hot_deleted')
+
+    def pending(self, user_id: str) -> List[str]:
+        # Verified segments whose plays may still be in the hot collection
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                "SELECT name FROM segments WHERE user_id = ? "
+                "AND state = 'verified' ORDER BY start_ms", (user_id,))]
+
+    def discard_unverified(self, user_id: str) -> None:
+        with self._lock, self._db:
+            names = [row[0] for row in self._db.execute(
+                "SELECT name FROM segments WHERE user_id = ? "
+                "AND state = 'written'", (user_id,))]
+            self._db.execute(
+                "DELETE FROM segments WHERE user_id = ? AND state = 'written'",
+                (user_id,))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+            info_logger.warning('Discarded unverified cold segment %s', name)
+
+    def newest_ms(self, user_id: str) -> Optional[int]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT MAX(end_ms) FROM segments WHERE user_id = ? "
+                "AND state != 'written'", (user_id,)).fetchone()[0]
+
+    def segment(self, name: str) -> List[dict]:
+        with self._lock:
+            documents = self._cache.get(name)
+            if documents is not None:
+                self._cache.move_to_end(name)
+                return documents
+        _, _, codec_name = self._segment_row(name)
+        # Segments keep the schema version of the time they were written
+        documents = [upgrade(document)
+                     for document in self._read_file(name, codec_name)]
+        with self._lock:
+            self._cache[name] = documents
+            while len(self._cache) > self.cache_segments:
+                self._cache.popitem(last=False)
+        return documents
+
+    def read(
+            self,
+            user_id: str,
+            start: Optional[datetime] = None,
+            end: Optional[datetime] = None,
+            newest_first: bool = True,
+            **filters) -> Iterator[dict]:
+        start_ms = to_ms(start) if start is not None else 0
+        end_ms = to_ms(end) if end is not None else 2 ** 62
+        with self._lock:
+            names = [row[0] for row in self._db.execute(
+                "SELECT name FROM segments WHERE user_id = ? "
+                "AND state != 'written' AND end_ms >= ? AND start_ms < ? "
+                "ORDER BY start_ms", (user_id, start_ms, end_ms))]
+        start = naive_utc(start) if start is not None else None
+        end = naive_utc(end) if end is not None else None
+
+        def in_range(document: dict) -> bool:
+            played_at = document['played_at']
+            return ((start is None or played_at >= start)
+                    and (end is None or played_at < end)
+                    and matches(document, **filters))
+
+        # Segments of different runs may overlap, so merge instead of chain
+        streams = [
+            sorted((document for document in self.segment(name)
+                    if in_range(document)),
+                   key=sort_key, reverse=newest_first)
+            for name in names]
+        yield from heapq.merge(*streams, key=sort_key, reverse=newest_first)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class TieringJob:
+    # Moves plays older than max_age out of the hot collection month by
+    # month. A segment is verified against the exact _ids read from MongoDB
+    # before those _ids are deleted in batches; a crash after verification
+    # resumes with the deletion on the next run.
+    def __init__(
+            self,
+            database_conn: MongoConnection,
+            cold_store: ColdStore,
+            max_age: timedelta = timedelta(days=365),
+            delete_batch_size: int = 1000) -> None:
+        self.database_conn = database_conn
+        self.cold_store = cold_store
+        self.max_age = max_age
+        self.delete_batch_size = delete_batch_size
+        self.user_id = database_conn.user_id
+
+    def _delete(self, ids: List) -> int:
+        deleted = 0
+        for offset in range(0, len(ids), self.delete_batch_size):
+            deleted += self.database_conn.collection.delete_many(
+                self.database_conn._scoped({'_id': {
+                    '$in': ids[offset:offset + self.delete_batch_size]}})
+                ).deleted_count
+        return deleted
+
+    def _finish(self, name: str) -> int:
+        ids = [document['_id'] for document in self.cold_store.segment(name)]
+        deleted = self._delete(ids)
+        self.cold_store.mark_deleted(name)
+        info_logger.info(
+            'Moved %d plays to cold segment %s, deleted %d from MongoDB',
+            len(ids), name, deleted)
+        return deleted
+
+    def run(self, now: Optional[datetime] = None) -> int:
+        self.cold_store.discard_unverified(self.user_id)
+        moved = sum(self._finish(name)
+                    for name in self.cold_store.pending(self.user_id))
+
+        cutoff = naive_utc(
+            (now or datetime.now(timezone.utc)) - self.max_age)
+        oldest = self.database_conn.find_many(
+            {'played_at': {'$lt': cutoff}},
+            projection={'played_at': 1, '_id': 0},
+            sort=[('played_at', 1)], limit=1)
+        if not oldest:
+            info_logger.info('No plays older than %s to tier', cutoff)
+            return moved
+        window_start = _month_start(oldest[0]['played_at'])
+        while window_start < cutoff:
+            window_end = min(_next_month(window_start), cutoff)
+            documents = self.database_conn.find_many(
+                {'played_at': {'$gte': window_start, '$lt': window_end}},
+                sort=[('played_at', 1)])
+            if documents:
+                name = self.cold_store.write_segment(documents, self.user_id)
+                if not self.cold_store.verify(
+                        name, {document['_id'] for document in documents}):
+                    raise IOError(f'Cold segment {name} failed verification')
+                moved += self._finish(name)
+            window_start = window_end
+        return moved
+
+
+class TieredHistoryReader:
+    # Answers history ranges from both tiers. Plays newer than the newest
+    # cold segment only live in MongoDB, so the cold tier is skipped for
+    # ranges that start after it.
+    def __init__(
+            self,
+            repository: HistoryQueryRepository,
+            cold_store: ColdStore,
+            user_id: str = 'default') -> None:
+        self.repository = repository
+        self.cold_store = cold_store
+        self.user_id = user_id
+
+    def find(
+            self,
+            start: Optional[datetime] = None,
+            end: Optional[datetime] = None,
+            limit: int = 50,
+            cursor: Optional[str] = None,
+            newest_first: bool = True,
+            **filters) -> HistoryPage:
+        hot = self.repository.find(
+            start=start, end=end, limit=limit, cursor=cursor,
+            newest_first=newest_first, **filters).items
+        newest_cold = self.cold_store.newest_ms(self.user_id)
+        if newest_cold is None or (
+                start is not None and to_ms(start) > newest_cold):
+            cold = []
+        else:
+            if cursor is not None:
+                # The cursor millisecond is read again for its later _ids
+                bound, last_id = decode_cursor(cursor)
+                if newest_first:
+                    bound_end = bound + timedelta(milliseconds=1)
+                    end = min(bound_end, naive_utc(end)) if end else bound_end
+                else:
+                    start = max(bound, naive_utc(start)) if start else bound
+            cold = []
+            for document in self.cold_store.read(
+                    self.user_id, start, end, newest_first, **filters):
+                if cursor is not None and not after_cursor(
+                        document, bound, last_id, newest_first):
+                    continue
+                cold.append(document)
+                if len(cold) == limit:
+                    break
+        items = list(heapq.merge(
+            hot, cold, key=sort_key, reverse=newest_first))[:limit]
+        next_cursor = None
+        if len(items) == limit:
+            next_cursor = encode_cursor(items[-1])
+        return HistoryPage(items, next_cursor)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Move old plays from MongoDB into local cold segments')
+    parser.add_argument('--max-age-days', type=int, default=365)
+    parser.add_argument('--directory', default='var/cold')
+    parser.add_argument('--db', default='spotify_user_history')
+    parser.add_argument('--tbl', default='song_history')
+    parser.add_argument('--user-id', default='default')
+    parser.add_argument('--time-series', action='store_true')
+    parser.add_argument('--delete-batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    with MongoConnection(
+            db=args.db,
+            tbl=args.tbl,
+            host=os.environ.get('WSL_HOST', 'localhost'),
+            user_id=args.user_id,
+            time_series=args.time_series) as database_conn:
+        cold_store = ColdStore(args.directory)
+        TieringJob(
+            database_conn, cold_store,
+            max_age=timedelta(days=args.max_age_days),
+            delete_batch_size=args.delete_batch_size).run()
+        cold_store.close()
@@ -0,0 +1,216 @@
+import atexit
+import functools
+import json
+import os
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, List, Optional
+
+from .logging.logger import info_logger
+
+TRACING_ENV = 'SPOTIFY_TRACING'
+DEFAULT_TRACE_FILE = 'var/logs/traces.jsonl'
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_CLIENT = 3
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+_current_span: ContextVar[Optional['Span']] = ContextVar(
+    'current_span', default=None)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Span:
+    def __init__(
+            self,
+            tracer: 'Tracer',
+            name: str,
+            kind: int = SPAN_KIND_INTERNAL,
+            attributes: Optional[dict] = None) -> None:
+        parent = _current_span.get()
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.events: List[dict] = []
+        self.status_code = STATUS_OK
+        self.status_message = ''
+        self.start_ns = 0
+        self.end_ns = 0
+        self._token = None
+
+    def set_attribute(self, key: str, value) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def record_exception(self, error: BaseException) -> None:
+        self.status_code = STATUS_ERROR
+        self.status_message = str(error)
+        self.events.append({
+            'timeUnixNano': str(time.time_ns()),
+            'name': 'exception',
+            'attributes': [
+                {'key': 'exception.type',
+                 'value': _otlp_value(type(error).__name__)},
+                {'key': 'exception.message', 'value': _otlp_value(str(error))},
+            ],
+        })
+
+    def __enter__(self) -> 'Span':
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.record_exception(exc)
+        _current_span.reset(self._token)
+        self.tracer.exporter.export(self)
+
+    def to_otlp(self) -> dict:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [
+                {'key': key, 'value': _otlp_value(value)}
+                for key, value in self.attributes.items()],
+            'status': {'code': self.status_code},
+        }
+        if self.parent_span_id:
+            span['parentSpanId'] = self.parent_span_id
+        if self.status_message:
+            span['status']['message'] = self.status_message
+        if self.events:
+            span['events'] = self.events
+        return span
+
+
+class _NullSpan:
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def record_exception(self, error: BaseException) -> None:
+        pass
+
+    def __enter__(self) -> '_NullSpan':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class JsonFileExporter:
+    # Writes OTLP/JSON (one ExportTraceServiceRequest per line), which the
+    # OpenTelemetry collector file receiver and most trace viewers import
+    def __init__(
+            self,
+            path: str = DEFAULT_TRACE_FILE,
+            service_name: str = 'spotify_user_history',
+            batch_size: int = 64) -> None:
+        self.path = path
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self._spans: List[Span] = []
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+            if len(self._spans) >= self.batch_size:
+                self._flush()
+
+    def _flush(self) -> None:
+        if not self._spans:
+            return
+        request = {'resourceSpans': [{
+            'resource': {'attributes': [{
+                'key': 'service.name',
+                'value': _otlp_value(self.service_name)}]},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': [span.to_otlp() for span in self._spans],
+            }],
+        }]}
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(request) + '\n')
+        self._spans = []
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.exporter: Optional[JsonFileExporter] = None
+
+    def configure(self, exporter: Optional[JsonFileExporter]) -> None:
+        if self.exporter is not None:
+            self.exporter.flush()
+        self.exporter = exporter
+        if exporter is not None:
+            atexit.register(exporter.flush)
+            info_logger.info('Tracing spans to %s', exporter.path)
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def start_span(
+            self,
+            name: str,
+            kind: int = SPAN_KIND_INTERNAL,
+            **attributes):
+        if self.exporter is None:
+            return NULL_SPAN
+        return Span(self, name, kind, attributes)
+
+    def traced(self, name: Optional[str] = None, **attributes) -> Callable:
+        def decorator(func: Callable) -> Callable:
+            span_name = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if self.exporter is None:
+                    return func(*args, **kwargs)
+                with Span(self, span_name, attributes=attributes):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+def current_span():
+    return _current_span.get() or NULL_SPAN
+
+
+tracer = Tracer()
+if os.environ.get(TRACING_ENV):
+    tracer.configure(JsonFileExporter(
+        DEFAULT_TRACE_FILE if os.environ[TRACING_ENV] == '1'
+        else os.environ[TRACING_ENV]))
@@ -0,0 +1,54 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.similarity.audio_index import AUDIO_FEATURES, AudioFeatureIndex
+
+
+def features(track_id: str, seed: int) -> dict:
+    rng = np.random.default_rng(seed)
+    feature = {name: float(low + rng.random() * (high - low))
+               for name, low, high in AUDIO_FEATURES}
+    feature['id'] = track_id
+    return feature
+
+
+class TestAudioFeatureIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.index = AudioFeatureIndex(self.directory, chunk_rows=16)
+        self.index.add([features(f'track{i}', i) for i in range(100)])
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_exact_search_matches_brute_force(self):
+        query = self.index.vector('track3')
+        expected = np.argsort(-(np.asarray(self.index.vectors) @ query))[:5]
+        result = self.index.search(query, k=5)[0]
+        self.assertEqual(
+            [track_id for track_id, _ in result],
+            [f'track{row}' for row in expected])
+
+    def test_add_skips_known_tracks_and_persists(self):
+        added = self.index.add([features('track1', 1), features('new', 500)])
+        self.assertEqual(added, 1)
+        reopened = AudioFeatureIndex(self.directory)
+        self.assertEqual(len(reopened), 101)
+        np.testing.assert_array_equal(
+            reopened.vector('new'), self.index.vector('new'))
+
+    def test_similar_to_excludes_seeds(self):
+        result = self.index.similar_to(['track1', 'track2'], k=3)
+        self.assertEqual(len(result), 3)
+        self.assertNotIn('track1', [track_id for track_id, _ in result])
+
+    def test_ivf_probing_all_lists_is_exact(self):
+        self.index.build_ivf(n_lists=4)
+        query = self.index.vector('track7')
+        self.assertEqual(
+            self.index.search(query, k=5, approximate=True, n_probe=4),
+            self.index.search(query, k=5))
@@ -100,6 +100,23 @@ class TestRefreshingToken(TestCase):
         r = refreshing_token._request_access_token()
         self.assertEqual(r.status_code, 200)   
 
+    @mock.patch.object(RefreshingToken, '_load_existing_access_token', return_value = 'existing_token')
+    @requests_mock.Mocker()
+    def test_auth_code_exchange_is_not_retried(self, mock_existing_token, request_mocker):
+        request_mocker.post(
+            'https://accounts.spotify.com/api/token',
+            text='resp',
+            status_code=503)
+        auth_code_request = MockAuthCodeRequest()
+        refreshing_token = RefreshingToken(auth_code_request=auth_code_request)
+
+        with mock.patch.object(
+                auth_code_request.auth_config, 'remove_auth_code') as remove:
+            with self.assertRaises(Exception):
+                refreshing_token._request_access_token()
+        self.assertEqual(request_mocker.call_count, 1)
+        remove.assert_called_once_with('test_scope')
+
     @mock.patch.object(RefreshingToken, '_load_existing_access_token', return_value = 'existing_token')
     @requests_mock.Mocker()
     def test_load_new_access_token_exception(self, mock_existing_token, request_mocker):
@@ -0,0 +1,62 @@
+import unittest
+from datetime import datetime, timezone
+
+import bson
+from bson import ObjectId
+
+from src.bson_writer import BsonEncoder, MESSAGE_OVERHEAD, batches
+from src.spotify_data.dataclasses import SpotifyHistoryObject
+
+
+def play(index: int, context: bool = True) -> SpotifyHistoryObject:
+    return SpotifyHistoryObject(**{
+        'played_at': f'2021-07-01T10:{index:02d}:00.123Z',
+        'track': {
+            'artists': [{'id': f'artist{i}', 'name': f'Artíst {i}'}
+                        for i in range(index % 3)],
+            'album': {
+                'album_type': 'album',
+                'artists': [{'id': 'artist0', 'name': 'Artíst 0'}],
+                'id': 'album', 'name': 'Album', 'release_date': '2020-01-01'},
+            'duration_ms': 180000 + index, 'explicit': bool(index % 2),
+            'href': 'https://api.spotify.com/v1/tracks/x',
+            'id': f'track{index}', 'name': f'Track {index}', 'popularity': 50},
+        'context': {'type': 'playlist', 'uri': 'spotify:playlist:x'}
+        if context else None,
+    })
+
+
+class TestBsonEncoder(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.encoder = BsonEncoder()
+
+    def test_bytes_match_bson_encode_of_dict(self):
+        for index in range(12):
+            model = play(index, context=index % 4 != 0)
+            self.assertEqual(
+                self.encoder.encode(model), bson.encode(model.dict()))
+
+    def test_id_first_and_extra_fields_last(self):
+        model = play(1)
+        _id = ObjectId()
+        extra = {'schema_version': 1, 'meta': {'user_id': 'user'},
+                 'big': 2 ** 40, 'ratio': 0.5,
+                 'at': datetime(1969, 12, 31, 23, 59, 59, 999999,
+                                tzinfo=timezone.utc)}
+        self.assertEqual(
+            self.encoder.encode(model, _id, extra),
+            bson.encode({'_id': _id, **model.dict(), **extra}))
+
+    def test_batches_respect_message_size(self):
+        documents = self.encoder.encode_many([play(3)] * 10)
+        size = len(documents[0].raw)
+        split = list(batches(
+            documents, max_message_size=MESSAGE_OVERHEAD + 3 * size + 10))
+        self.assertEqual([len(batch) for batch in split], [3, 3, 3, 1])
+        split = list(batches(documents, max_batch_size=4))
+        self.assertEqual([len(batch) for batch in split], [4, 4, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import mongomock
+
+from src.coordination import Coordinator, IngestionWorker, assign
+from src.db_connection import MongoClientManager, MongoConnection
+from src.errors.database_errors import LeaseLost
+
+USERS = [f'user{index}' for index in range(1000)]
+
+
+class TestAssign(unittest.TestCase):
+
+    def test_users_are_spread_evenly(self):
+        for workers in (['a'], ['a', 'b', 'c'], ['a', 'b', 'c', 'd', 'e', 'f', 'g']):
+            assignment = assign(USERS, workers)
+            self.assertEqual(set(assignment), set(USERS))
+            loads = [list(assignment.values()).count(worker) for worker in workers]
+            self.assertLessEqual(max(loads), -(-len(USERS) // len(workers)))
+            self.assertGreaterEqual(min(loads), len(USERS) // len(workers) - 2)
+
+    def test_assignment_is_deterministic_and_moves_few_users(self):
+        before = assign(USERS, ['a', 'b', 'c'])
+        self.assertEqual(before, assign(reversed(USERS), ['c', 'a', 'b']))
+        after = assign(USERS, ['a', 'b', 'c', 'd'])
+        moved = sum(before[user] != after[user] for user in USERS)
+        self.assertLess(moved, 300)
+
+    def test_no_workers(self):
+        self.assertEqual(assign(USERS, []), {})
+
+
+class TestCoordinator(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.client = mongomock.MongoClient()
+        self.database = self.client['db']
+        self.first = Coordinator(self.database, 'first')
+        self.second = Coordinator(self.database, 'second')
+        self.first.register_users(['user'])
+        self.now = datetime(2021, 7, 1)
+
+    def connection(self, fence_token: int) -> MongoConnection:
+        # mongomock cannot create time series collections
+        with mock.patch.object(
+                MongoClientManager, 'get_client', return_value=self.client), \
+                mock.patch.object(
+                    MongoConnection, '_create_time_series_collection'):
+            return MongoConnection(
+                'db', 'song_history_ts', user_id='user', time_series=True,
+                fence_token=fence_token)
+
+    def test_claim_with_a_stale_token_fails(self):
+        stale = list(self.first.leases.find({}))
+        self.second.heartbeat(self.now)
+        self.assertEqual(self.second.rebalance(self.now), {'user': 1})
+        # The second worker's heartbeat has expired, but its claim raised the
+        # token the first worker read
+        later = self.now + timedelta(seconds=100)
+        self.first.heartbeat(later)
+        find = self.first.leases.find
+        with mock.patch.object(
+                self.first.leases, 'find',
+                side_effect=lambda *args, **kwargs:
+                    stale if args == ({},) else find(*args, **kwargs)):
+            self.assertEqual(self.first.rebalance(later), {})
+        self.assertEqual(self.first.leases.find_one()['owner'], 'second')
+
+    def test_expired_lease_is_taken_over_and_fences_the_old_owner(self):
+        self.second.heartbeat(self.now)
+        self.second.rebalance(self.now)
+        self.connection(1).save_checkpoint({'after': 1})
+
+        later = self.now + timedelta(seconds=100)
+        self.first.heartbeat(later)
+        self.assertEqual(self.first.rebalance(later), {'user': 2})
+        self.connection(2).save_checkpoint({'after': 2})
+
+        self.assertIsNone(self.second.begin('user', 0))
+        with self.assertRaises(LeaseLost):
+            self.second.complete('user', 1, 0)
+        with self.assertRaises(LeaseLost):
+            self.connection(1).save_checkpoint({'after': 3})
+        self.assertEqual(self.connection(2).load_checkpoint()['after'], 2)
+
+    def test_user_is_ingested_once_per_cycle(self):
+        self.first.heartbeat()
+        self.first.rebalance()
+        token = self.first.begin('user', 5)
+        self.assertEqual(token, 1)
+        self.first.complete('user', token, 5)
+        self.assertIsNone(self.first.begin('user', 5))
+        self.assertEqual(self.first.begin('user', 6), token)
+
+    def test_failed_ingestion_waits_for_the_next_cycle(self):
+        self.first.heartbeat()
+        ingest = mock.Mock(side_effect=RuntimeError('API down'))
+        worker = IngestionWorker(self.first, ingest, interval_seconds=3600)
+        with mock.patch.object(worker, 'current_cycle', return_value=5):
+            self.assertEqual(worker.run_cycle(), {'user': 'failed'})
+            self.assertEqual(worker.run_cycle(), {'user': 'skipped'})
+        self.assertEqual(ingest.call_count, 1)
+        with mock.patch.object(worker, 'current_cycle', return_value=6):
+            worker.run_cycle()
+        self.assertEqual(ingest.call_count, 2)
+
+    def test_fenced_connection_needs_time_series(self):
+        # Only the time series collection scopes plays to their user
+        with mock.patch.object(
+                MongoClientManager, 'get_client', return_value=self.client):
+            with self.assertRaises(ValueError):
+                MongoConnection(
+                    'db', 'song_history', user_id='user', fence_token=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+from unittest import mock
+
+import mongomock
+import pymongo
+from pymongo import IndexModel
+
+from src import db_connection
+from src.db_connection import MongoClientManager, MongoConnection
+from src.errors.database_errors import DbConnectionTimeout
+
+
+def fake_client(*args, **kwargs):
+    client = mock.MagicMock()
+    client.server_info.return_value = {'version': '7.0.0'}
+    return client
+
+
+class TestMongoClientManager(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # Fresh registries, so tests neither see nor leak shared clients
+        for name, value in (('_clients', {}), ('_versions', {}),
+                            ('_indexed', set())):
+            patcher = mock.patch.object(MongoClientManager, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(
+            db_connection, 'MongoClient', side_effect=fake_client)
+        self.mongo_client = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_one_client_per_host_and_pool_config(self):
+        first = MongoClientManager.get_client('localhost', 27017)
+        self.assertIs(MongoClientManager.get_client('localhost', 27017), first)
+        other_pool = MongoClientManager.get_client(
+            'localhost', 27017, max_pool_size=10)
+        other_host = MongoClientManager.get_client('db', 27017)
+        self.assertIsNot(other_pool, first)
+        self.assertIsNot(other_host, first)
+        self.assertEqual(self.mongo_client.call_count, 3)
+        self.assertEqual(MongoClientManager.server_version(first), '7.0.0')
+
+    def test_pool_size_and_timeouts_applied(self):
+        MongoClientManager.get_client(
+            'localhost', 27017, max_pool_size=8,
+            server_selection_timeout_ms=100, connect_timeout_ms=200)
+        self.mongo_client.assert_called_once_with(
+            'localhost', 27017, maxPoolSize=8,
+            serverSelectionTimeoutMS=100, connectTimeoutMS=200)
+
+    def test_unreachable_server_not_cached(self):
+        client = fake_client()
+        client.server_info.side_effect = (
+            pymongo.errors.ServerSelectionTimeoutError('down'))
+        self.mongo_client.side_effect = [client]
+        with self.assertRaises(DbConnectionTimeout):
+            MongoConnection('db', 'tbl')
+        client.close.assert_called_once()
+        self.assertEqual(MongoClientManager._clients, {})
+
+    def test_ensure_indexes_once_per_collection(self):
+        client = mongomock.MongoClient()
+        indexes = [IndexModel([('played_at', -1)], name='played_at_desc')]
+        plays = client['db']['plays']
+        with mock.patch.object(
+                plays, 'create_indexes',
+                wraps=plays.create_indexes) as create_indexes:
+            MongoClientManager.ensure_indexes(plays, indexes)
+            MongoClientManager.ensure_indexes(plays, indexes)
+        create_indexes.assert_called_once_with(indexes)
+        self.assertIn('played_at_desc', plays.index_information())
+        with mock.patch.object(
+                mongomock.collection.Collection,
+                'create_indexes') as create_indexes:
+            MongoClientManager.ensure_indexes(client['db']['other'], indexes)
+        create_indexes.assert_called_once()
+
+    def test_connections_share_the_client(self):
+        with mock.patch.object(
+                MongoClientManager, 'ensure_indexes') as ensure_indexes:
+            first = MongoConnection('db', 'plays')
+            second = MongoConnection('db', 'other')
+        self.assertIs(first.conn, second.conn)
+        self.assertEqual(self.mongo_client.call_count, 1)
+        self.assertEqual(ensure_indexes.call_count, 2)
+
+
+class TestTimeSeriesReplacement(unittest.TestCase):
+
+    def setUp(self) -> None:
+        # mongomock cannot create time series collections
+        with mock.patch.object(
+                MongoClientManager, 'get_client',
+                return_value=mongomock.MongoClient()), \
+                mock.patch.object(
+                    MongoConnection, '_create_time_series_collection'):
+            self.conn = MongoConnection(
+                'db', 'song_history_ts', user_id='user', time_series=True)
+        self.conn.collection.insert_many(
+            [{'_id': position, 'version': 1} for position in range(3)])
+
+    def documents(self) -> list:
+        return [{'_id': position, 'version': 2} for position in range(2)]
+
+    def test_replaces_and_clears_the_pending_batch(self):
+        self.assertEqual(self.conn.replace_many(self.documents()), 2)
+        stored = {document['_id']: document['version']
+                  for document in self.conn.collection.find()}
+        self.assertEqual(stored, {0: 2, 1: 2, 2: 1})
+        self.assertEqual(
+            self.conn.pending_replacements.count_documents({}), 0)
+
+    def test_batch_deleted_before_a_crash_is_recovered(self):
+        with mock.patch.object(
+                self.conn.collection, 'insert_many',
+                side_effect=pymongo.errors.AutoReconnect('down')):
+            with self.assertRaises(pymongo.errors.AutoReconnect):
+                self.conn.replace_many(self.documents())
+        self.assertEqual(self.conn.collection.count_documents({}), 1)
+        self.assertEqual(self.conn.recover_replacements(), 2)
+        stored = {document['_id']: document['version']
+                  for document in self.conn.collection.find()}
+        self.assertEqual(stored, {0: 2, 1: 2, 2: 1})
+        self.assertEqual(self.conn.recover_replacements(), 0)
+        self.assertEqual(
+            self.conn.collection.find_one({'_id': 0})['meta'],
+            {'user_id': 'user'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import datetime
+import os
+import queue
+import shutil
+import tempfile
+import unittest
+
+from src.events.publisher import EventPublisher
+from src.events.sinks import EventSink, QueueSink
+
+
+def play(index: int) -> dict:
+    return {
+        'played_at': datetime.datetime(2021, 8, 1, 12, index),
+        'track': {
+            'id': f'track{index}',
+            'name': f'Track {index}',
+            'duration_ms': 1000,
+            'artists': [{'id': 'artist', 'name': 'Artist'}],
+            'album': {'id': 'album'},
+        },
+    }
+
+
+class FailingSink(EventSink):
+    name = 'failing'
+
+    def __init__(self) -> None:
+        self.failing = True
+        self.received = []
+
+    def deliver(self, events, last_offset) -> None:
+        if self.failing:
+            raise ConnectionError('receiver down')
+        self.received.extend(events)
+
+
+class TestEventPublisher(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.events = queue.Queue()
+        self.failing = FailingSink()
+        self.publisher = EventPublisher(
+            [QueueSink(self.events), self.failing],
+            os.path.join(self.directory, 'outbox.sqlite3'),
+            batch_size=2)
+
+    def tearDown(self) -> None:
+        self.publisher.close()
+        shutil.rmtree(self.directory)
+
+    def test_batches_are_acknowledged_per_sink(self):
+        delivered = self.publisher.publish([play(index) for index in range(5)])
+        self.assertEqual(delivered, {'queue': 5, 'failing': 0})
+        self.assertEqual(self.events.qsize(), 3)
+        self.assertEqual(self.publisher.lag(), {'queue': 0, 'failing': 5})
+
+    def test_failed_batches_are_redelivered(self):
+        self.publisher.publish([play(index) for index in range(3)])
+        self.failing.failing = False
+        self.publisher.dispatch()
+        self.assertEqual(
+            [event['offset'] for event in self.failing.received], [1, 2, 3])
+        self.assertEqual(self.publisher.compact(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import asyncio
+import re
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import mongomock
+
+from src.api.server import HistoryApi
+from src.db_connection import MongoClientManager, MongoConnection
+
+
+class RecordingWriter:
+    def __init__(self) -> None:
+        self.data = b''
+        self.closed = False
+
+    def write(self, data: bytes) -> None:
+        self.data += data
+
+    async def drain(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class TestHistoryApi(unittest.TestCase):
+
+    def setUp(self) -> None:
+        with mock.patch.object(
+                MongoClientManager, 'get_client',
+                return_value=mongomock.MongoClient()):
+            self.database_conn = MongoConnection('db', 'song_history')
+        self.database_conn.collection.insert_one(
+            {'played_at': datetime(2021, 7, 1), 'track': {'id': 'track'}})
+
+    def request(self, raw: bytes) -> bytes:
+        async def run() -> bytes:
+            api = HistoryApi(self.database_conn)
+            reader = asyncio.StreamReader()
+            reader.feed_data(raw)
+            reader.feed_eof()
+            writer = RecordingWriter()
+            await api.handle_connection(reader, writer)
+            return writer.data
+        return asyncio.run(run())
+
+    def respond(self, api: HistoryApi, path: str, params: dict = None):
+        return asyncio.run(api.respond(path, params or {}, None))
+
+    def test_routes_and_error_statuses(self):
+        response = self.request(
+            b'GET /plays/recent?limit=5 HTTP/1.1\r\n\r\n'
+            b'GET /nowhere HTTP/1.1\r\n\r\n'
+            b'POST /plays/recent HTTP/1.1\r\n\r\n'
+            b'GET /top/tracks?limit=x HTTP/1.1\r\n\r\n')
+        statuses = re.findall(rb'HTTP/1\.1 (\d+)', response)
+        self.assertEqual(statuses, [b'200', b'404', b'405', b'400'])
+        self.assertIn(b'"track"', response)
+
+    def test_malformed_content_length_is_rejected(self):
+        response = self.request(
+            b'GET /plays/recent HTTP/1.1\r\nContent-Length: abc\r\n\r\n'
+            b'GET /plays/recent HTTP/1.1\r\n\r\n')
+        self.assertTrue(response.startswith(b'HTTP/1.1 400 Bad Request'))
+        self.assertEqual(response.count(b'HTTP/1.1'), 1)
+
+    def test_only_cacheable_routes_are_cached(self):
+        api = HistoryApi(self.database_conn)
+        with mock.patch.object(
+                api.rollups, 'top', return_value=[('track', 1)]) as top:
+            self.respond(api, '/top/tracks')
+            self.respond(api, '/top/tracks')
+            self.assertEqual(top.call_count, 1)
+        self.respond(api, '/plays/recent')
+        self.assertEqual(len(api.cache._entries), 1)
+
+    def test_ingestion_invalidates_cached_responses(self):
+        api = HistoryApi(self.database_conn)
+        with mock.patch.object(
+                api.rollups, 'top', return_value=[('track', 1)]) as top:
+            _, _, etag = self.respond(api, '/top/tracks')
+            self.database_conn._run_save_hooks([])
+            self.respond(api, '/top/tracks')
+            self.assertEqual(top.call_count, 2)
+            status, _, _ = asyncio.run(api.respond('/top/tracks', {}, etag))
+            self.assertEqual(status, 304)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import mongomock
+
+from src.db_connection import MongoClientManager, MongoConnection
+from src.history_queries import HistoryQueryRepository
+
+
+class TestHistoryQueryRepository(unittest.TestCase):
+
+    def setUp(self) -> None:
+        with mock.patch.object(
+                MongoClientManager, 'get_client',
+                return_value=mongomock.MongoClient()):
+            self.database_conn = MongoConnection('db', 'song_history')
+        self.repository = HistoryQueryRepository(self.database_conn)
+        start = datetime(2021, 7, 1)
+        # Three plays in every millisecond, so pages end inside a millisecond
+        self.database_conn.collection.insert_many([
+            {'played_at': start + timedelta(milliseconds=position // 3),
+             'track': {'id': f'track{position}'}}
+            for position in range(20)])
+
+    def test_pages_do_not_skip_plays_of_the_same_millisecond(self):
+        for newest_first in (True, False):
+            ids = [play['track']['id'] for play in self.repository.iterate(
+                page_size=4, newest_first=newest_first)]
+            self.assertEqual(len(ids), 20)
+            self.assertEqual(len(set(ids)), 20)
+
+    def test_cursor_survives_projection(self):
+        page = self.repository.find(limit=4, fields=['track.id'])
+        self.assertNotIn('_id', page.items[0])
+        following = self.repository.find(
+            limit=4, fields=['track.id'], cursor=page.next_cursor)
+        self.assertFalse(
+            {play['track']['id'] for play in page.items}
+            & {play['track']['id'] for play in following.items})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from src.db_connection import DatabaseConnection
+from src.history_queries import naive_utc, to_ms
+from src.spotify_data.dataclasses import SpotifyHistory
+from src.spotify_interaction import SpotifyInteraction
+
+START = datetime(2021, 7, 1, tzinfo=timezone.utc)
+
+
+def play(index: int) -> dict:
+    return {
+        'played_at': (START + timedelta(minutes=index)).isoformat(),
+        'track': {
+            'artists': [{'id': 'artist', 'name': 'Artist'}],
+            'album': {
+                'album_type': 'album',
+                'artists': [{'id': 'artist', 'name': 'Artist'}],
+                'id': 'album', 'name': 'Album', 'release_date': '2020-01-01'},
+            'duration_ms': 180000, 'explicit': False,
+            'href': 'https://api.spotify.com/v1/tracks/x',
+            'id': f'track{index}', 'name': f'Track {index}', 'popularity': 50},
+        'context': None,
+    }
+
+
+def page(indexes: range, last: bool) -> SpotifyHistory:
+    after = to_ms(START + timedelta(minutes=indexes[-1]))
+    return SpotifyHistory(
+        items=[play(index) for index in indexes],
+        next=None if last else f'https://api.spotify.com/next?after={after}',
+        cursors={'after': after, 'before': None},
+        limit=20,
+        href='https://api.spotify.com/v1/me/player/recently-played')
+
+
+class CrashBeforeCommit(Exception):
+    pass
+
+
+class FakeDatabase(DatabaseConnection):
+    # Plays and the checkpoint in memory, optionally failing the first
+    # checkpoint commit after a page was saved
+    def __init__(self, crash_on_commit: bool = False) -> None:
+        super().__init__()
+        self.plays = []
+        self.checkpoint = None
+        self.crash_on_commit = crash_on_commit
+
+    def _create_connection(self):
+        return None
+
+    def close_connection(self):
+        pass
+
+    def save_one(self, data):
+        self.save_many([data])
+
+    def save_many(self, data):
+        for item in data:
+            document = item.dict()
+            document['played_at'] = naive_utc(document['played_at'])
+            self.plays.append(document)
+
+    def find_newest(self):
+        if not self.plays:
+            return None
+        return max(document['played_at'] for document in self.plays).replace(
+            tzinfo=timezone.utc)
+
+    def find_many(self, query, projection=None, sort=None, limit=0):
+        bounds = query.get('played_at', {})
+        return [
+            document for document in self.plays
+            if ('$gt' not in bounds or document['played_at'] > bounds['$gt'])
+            and ('$lte' not in bounds or document['played_at'] <= bounds['$lte'])]
+
+    def replace_many(self, documents):
+        return 0
+
+    def load_checkpoint(self):
+        return None if self.checkpoint is None else dict(self.checkpoint)
+
+    def save_checkpoint(self, checkpoint):
+        if self.crash_on_commit and checkpoint['pending_until'] is None:
+            self.crash_on_commit = False
+            raise CrashBeforeCommit()
+        self.checkpoint = dict(checkpoint)
+
+
+class TestIngestionCheckpoint(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.pages = {
+            0: page(range(0, 3), last=False),
+            to_ms(START + timedelta(minutes=2)): page(range(3, 5), last=True),
+            to_ms(START + timedelta(minutes=4)): SpotifyHistory(
+                items=[], limit=20,
+                href='https://api.spotify.com/v1/me/player/recently-played'),
+        }
+        self.interaction = SpotifyInteraction(connection=mock.Mock())
+        self.requested = []
+
+        def get_page(start_point_unix_ms):
+            self.requested.append(start_point_unix_ms)
+            return self.pages[start_point_unix_ms]
+        self.interaction._get_play_history = get_page
+
+    def track_ids(self, database_conn: FakeDatabase) -> list:
+        return [document['track']['id'] for document in database_conn.plays]
+
+    def test_resume_after_crash_between_save_and_commit(self):
+        database_conn = FakeDatabase(crash_on_commit=True)
+        with self.assertRaises(CrashBeforeCommit):
+            self.interaction.ingest_new_play_history(database_conn)
+        # The first page is stored, its checkpoint is still pending
+        self.assertEqual(len(database_conn.plays), 3)
+        self.assertIsNotNone(database_conn.checkpoint['pending_until'])
+
+        self.assertEqual(
+            self.interaction.ingest_new_play_history(database_conn), 2)
+        self.assertEqual(
+            self.track_ids(database_conn), [f'track{i}' for i in range(5)])
+        self.assertIsNone(database_conn.checkpoint['pending_until'])
+        self.assertEqual(
+            database_conn.checkpoint['after'],
+            to_ms(START + timedelta(minutes=4)))
+
+    def test_first_run_starts_after_newest_stored_play(self):
+        database_conn = FakeDatabase()
+        database_conn.save_many(page(range(0, 3), last=True).items)
+        self.assertEqual(
+            self.interaction.ingest_new_play_history(database_conn), 2)
+        self.assertEqual(
+            self.requested, [to_ms(START + timedelta(minutes=2))])
+        self.assertEqual(len(set(self.track_ids(database_conn))), 5)
+
+    def test_first_run_on_empty_collection_starts_at_zero(self):
+        database_conn = FakeDatabase()
+        self.assertEqual(
+            self.interaction.ingest_new_play_history(database_conn), 5)
+        self.assertEqual(self.requested[0], 0)
+        self.assertEqual(
+            self.interaction.ingest_new_play_history(database_conn), 0)
+        self.assertEqual(len(database_conn.plays), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import logging
+import unittest
+from unittest import mock
+
+from src.logging import filters, logger
+from src.logging.filters import RateLimitFilter
+
+
+class Collector(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(record)
+
+
+class TestRateLimitFilter(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.filter = RateLimitFilter(rate=1, burst=2, max_level='INFO')
+
+    def record(self, msg: str, level: int = logging.INFO) -> logging.LogRecord:
+        return logging.LogRecord('tests', level, __file__, 0, msg, None, None)
+
+    def test_suppressed_count_carried_by_next_record(self):
+        with mock.patch.object(filters.time, 'monotonic', return_value=0):
+            passed = [self.filter.filter(self.record('Request %s'))
+                      for _ in range(5)]
+        self.assertEqual(passed, [True, True, False, False, False])
+        with mock.patch.object(filters.time, 'monotonic', return_value=1):
+            record = self.record('Request %s')
+            self.assertTrue(self.filter.filter(record))
+        self.assertEqual(record.suppressed, 3)
+
+    def test_buckets_per_template_and_warnings_pass(self):
+        with mock.patch.object(filters.time, 'monotonic', return_value=0):
+            for _ in range(3):
+                self.filter.filter(self.record('Request %s'))
+            self.assertTrue(self.filter.filter(self.record('Other %s')))
+            self.assertTrue(self.filter.filter(
+                self.record('Request %s', logging.WARNING)))
+
+
+class TestQueuedLogging(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.root_handlers = logging.getLogger().handlers
+        self.collector = Collector()
+        self.logger = logging.getLogger('tests.queued')
+        self.logger.handlers = [self.collector]
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        with mock.patch.object(logger.atexit, 'register'):
+            self.listener = logger._enqueue_handlers(['tests.queued'])
+
+    def tearDown(self) -> None:
+        logging.getLogger().handlers = self.root_handlers
+        self.logger.handlers = []
+        self.logger.filters = []
+
+    def test_records_reach_routed_handler(self):
+        self.logger.info('Saved %s plays', 3)
+        self.listener.stop()
+        self.assertEqual(len(self.collector.records), 1)
+        self.assertEqual(self.collector.records[0].getMessage(), 'Saved 3 plays')
+
+    def test_message_merged_on_calling_thread(self):
+        tracks = ['a']
+        self.logger.info('Tracks %s', tracks)
+        tracks.append('b')
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('Failed')
+        self.listener.stop()
+        first, second = self.collector.records
+        self.assertEqual(first.msg, "Tracks ['a']")
+        self.assertIsNone(first.args)
+        self.assertIsNone(second.exc_info)
+        self.assertIn('ValueError: boom', second.exc_text)
+
+    def test_rate_limited_before_enqueue(self):
+        self.logger.addFilter(RateLimitFilter(rate=0, burst=2))
+        for i in range(5):
+            self.logger.info('Request %s', i)
+        self.listener.stop()
+        self.assertEqual(
+            [record.msg for record in self.collector.records],
+            ['Request 0', 'Request 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
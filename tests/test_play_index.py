@@ -0,0 +1,48 @@
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from src.play_index import PlayIndex
+
+START = datetime(2021, 7, 1, tzinfo=timezone.utc)
+
+
+def play(minutes: int, track_id: str, context: str = None) -> dict:
+    return {
+        'played_at': START + timedelta(minutes=minutes),
+        'track': {'id': track_id},
+        'context': {'uri': context} if context else None,
+    }
+
+
+class TestPlayIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.index = PlayIndex(self.directory)
+        self.index.append(
+            [play(minutes, f'track{minutes % 3}', 'spotify:playlist:x')
+             for minutes in range(0, 100, 5)])
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.directory)
+
+    def test_range_count_uses_half_open_interval(self):
+        self.assertEqual(
+            self.index.count(START + timedelta(minutes=10),
+                             START + timedelta(minutes=30)), 4)
+        self.assertEqual(self.index.count(), 20)
+
+    def test_older_plays_are_skipped_and_index_reopens(self):
+        added = self.index.append([play(0, 'old'), play(200, 'new')])
+        self.assertEqual(added, 1)
+        reopened = PlayIndex(self.directory)
+        self.assertEqual(len(reopened), 21)
+        self.assertEqual(
+            list(reopened.plays(START + timedelta(minutes=200))),
+            [(START + timedelta(minutes=200), 'new', None)])
+
+    def test_top_tracks(self):
+        self.assertEqual(
+            self.index.top_tracks(limit=2), [('track0', 7), ('track2', 7)])
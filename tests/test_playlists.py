@@ -0,0 +1,26 @@
+import random
+import unittest
+
+from src.playlists import apply_ops, diff_tracks
+
+
+class TestPlaylistDeltas(unittest.TestCase):
+
+    def test_ops_reconstruct_new_version(self):
+        rng = random.Random(7)
+        for _ in range(200):
+            old = [rng.choice('abcdefgh') for _ in range(rng.randint(0, 20))]
+            new = [rng.choice('abcdefgh') for _ in range(rng.randint(0, 20))]
+            self.assertEqual(apply_ops(old, diff_tracks(old, new)), new)
+
+    def test_delta_is_proportional_to_churn(self):
+        old = [f'track{index}' for index in range(1000)]
+        new = old[:500] + ['added'] + old[501:]
+        ops = diff_tracks(old, new)
+        self.assertEqual(ops, [
+            {'op': 'delete', 'start': 500, 'end': 501},
+            {'op': 'insert', 'at': 501, 'tracks': ['added']}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from src.profiling import Profiler
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.report_dir = os.path.join(directory.name, 'profiles')
+        self.profiler = Profiler(report_dir=self.report_dir)
+
+    def test_without_mode_phases_share_null_context(self):
+        self.assertFalse(self.profiler.enabled)
+        self.assertIs(self.profiler.phase('fetch'), self.profiler.phase('store'))
+        with self.profiler.run('main'), self.profiler.phase('fetch'):
+            pass
+        self.assertEqual(dict(self.profiler.timings), {})
+        self.assertFalse(os.path.exists(self.report_dir))
+
+    def test_nested_phases_recorded_by_path(self):
+        self.profiler.configure('timers')
+        with self.profiler.phase('ingest'):
+            for _ in range(2):
+                with self.profiler.phase('fetch'):
+                    pass
+            with self.profiler.phase('store'):
+                pass
+        self.assertEqual(
+            {path: calls for path, (calls, _) in self.profiler.timings.items()},
+            {'ingest': 1, 'ingest/fetch': 2, 'ingest/store': 1})
+
+    def test_phase_paths_kept_per_thread(self):
+        self.profiler.configure('timers')
+
+        def work():
+            with self.profiler.phase('worker'):
+                pass
+
+        with self.profiler.phase('main'):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        self.assertEqual(set(self.profiler.timings), {'main', 'worker'})
+
+    def test_reports_written_to_profile_directory(self):
+        self.profiler.configure('cpu,timers')
+        with self.profiler.run('main'), self.profiler.phase('fetch'):
+            sum(range(1000))
+        reports = sorted(os.listdir(self.report_dir))
+        self.assertEqual(
+            [report.split('-', 1)[1] for report in reports],
+            ['main-cpu.prof', 'main-cpu.txt', 'main-timers.json'])
+        timers = [report for report in reports if report.endswith('.json')][0]
+        with open(os.path.join(self.report_dir, timers)) as file:
+            report = json.load(file)
+        self.assertEqual(set(report['phases']), {'main', 'main/fetch'})
+        self.assertGreater(report['wall_clock'], 0)
+
+    def test_unknown_mode_rejected(self):
+        with self.assertRaises(ValueError):
+            self.profiler.configure('cpu,gpu')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.archive.raw_archive import RawResponseArchive
+
+
+class TestRawResponseArchive(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.archive = RawResponseArchive(
+            self.directory, codec='zlib', batch_size=2)
+
+    def tearDown(self) -> None:
+        self.archive.close()
+        shutil.rmtree(self.directory)
+
+    def test_identical_payloads_are_stored_once(self):
+        self.archive.store('play_history', b'{"items": []}')
+        self.archive.store('play_history', b'{"items": []}')
+        self.archive.store('track', b'{"id": "1"}')
+        self.archive.flush()
+        blobs = self.archive._db.execute('SELECT COUNT(*) FROM blobs').fetchone()
+        self.assertEqual(blobs[0], 2)
+        self.assertEqual(len(os.listdir(self.archive.segment_dir)), 1)
+
+    def test_iter_responses_filters_by_endpoint(self):
+        self.archive.store('play_history', b'first', user_id='user')
+        self.archive.store('track', b'second', user_id='user')
+        self.archive.store('play_history', b'third', user_id='user')
+        bodies = [body for _, body in
+                  self.archive.iter_responses(endpoint='play_history')]
+        self.assertEqual(bodies, [b'first', b'third'])
+
+    def test_load_round_trip(self):
+        digest = self.archive.store('track', b'payload' * 100)
+        self.assertEqual(self.archive.load(digest), b'payload' * 100)
+        self.archive.flush()
+        self.assertEqual(self.archive.load(digest), b'payload' * 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
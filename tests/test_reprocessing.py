@@ -0,0 +1,128 @@
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+
+import mongomock
+
+from src import reprocessing
+from src.db_connection import MongoClientManager, MongoConnection
+from src.reprocessing import (
+    ReprocessingCheckpoint, Reprocessor, document_batches, reparse_plays)
+
+START = datetime(2021, 7, 1)
+
+
+def play(index: int, popularity: int = 50) -> dict:
+    return {
+        'played_at': START + timedelta(minutes=index),
+        'track': {
+            'artists': [{'id': 'artist', 'name': 'Artist'}],
+            'album': {
+                'album_type': 'album',
+                'artists': [{'id': 'artist', 'name': 'Artist'}],
+                'id': 'album', 'name': 'Album', 'release_date': '2020-01-01'},
+            'duration_ms': 180000, 'explicit': False,
+            'href': 'https://api.spotify.com/v1/tracks/x',
+            'id': f'track{index}', 'name': f'Track {index}',
+            'popularity': popularity},
+        'context': None,
+    }
+
+
+def replace_each(collection):
+    # mongomock cannot apply pymongo 4 ReplaceOne requests in bulk_write
+    def bulk_write(requests, ordered=True):
+        results = [collection.replace_one(
+            request._filter, request._doc, upsert=request._upsert)
+            for request in requests]
+        return SimpleNamespace(
+            matched_count=sum(result.matched_count for result in results),
+            upserted_count=sum(
+                result.upserted_id is not None for result in results))
+    return bulk_write
+
+
+def slow_for_first_batch(items):
+    # The first batches finish last, so writes must wait for them
+    if items[0]['track']['id'] in ('track0', 'track2'):
+        time.sleep(0.05)
+    return reparse_plays(items)
+
+
+class TestReparsePlays(unittest.TestCase):
+
+    def test_keeps_id_and_counts_invalid_items(self):
+        items = [dict(play(0), _id='a'), play(1, popularity=500),
+                 {'played_at': START}, play(2)]
+        documents, failed = reparse_plays(items)
+        self.assertEqual(failed, 2)
+        self.assertEqual([document.get('_id') for document in documents],
+                         ['a', None])
+        self.assertEqual(documents[1]['track']['id'], 'track2')
+
+
+class TestReprocessor(unittest.TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = ReprocessingCheckpoint('test', directory.name)
+        with mock.patch.object(
+                MongoClientManager, 'get_client',
+                return_value=mongomock.MongoClient()):
+            self.conn = MongoConnection('db', 'song_history')
+        collection = self.conn.collection
+        patcher = mock.patch.object(
+            collection, 'bulk_write', side_effect=replace_each(collection))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        collection.insert_many(
+            [dict(play(index), _id=index) for index in range(7)])
+        # Threads instead of processes, the mocks are not picklable
+        patcher = mock.patch.object(
+            reprocessing, 'ProcessPoolExecutor', ThreadPoolExecutor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def written(self) -> list:
+        return [call.args[0][-1]['_id']
+                for call in self.replace_many.call_args_list]
+
+    def run_reprocessor(self, after_id=None) -> dict:
+        with mock.patch.object(
+                self.conn, 'replace_many',
+                wraps=self.conn.replace_many) as self.replace_many, \
+                mock.patch.object(
+                    reprocessing, 'reparse_plays', slow_for_first_batch):
+            reprocessor = Reprocessor(
+                self.conn, self.checkpoint, workers=3, max_in_flight=3)
+            return reprocessor.run(
+                document_batches(self.conn, after_id, 2), 'documents')
+
+    def test_batches_written_in_order_while_in_flight(self):
+        state = self.run_reprocessor()
+        self.assertEqual(self.written(), [1, 3, 5, 6])
+        self.assertEqual(state['written'], 7)
+        self.assertEqual(self.checkpoint.load()['position'], 6)
+        self.assertEqual(self.conn.collection.count_documents({}), 7)
+
+    def test_resumes_after_checkpointed_position(self):
+        self.checkpoint.save({'written': 4, 'failed': 0, 'position': 3})
+        position = self.checkpoint.load()['position']
+        state = self.run_reprocessor(position)
+        self.assertEqual(self.written(), [5, 6])
+        self.assertEqual(state['written'], 7)
+        self.assertEqual(self.checkpoint.load()['position'], 6)
+
+    def test_checkpoint_cleared(self):
+        self.checkpoint.save({'position': 3})
+        self.checkpoint.clear()
+        self.assertEqual(self.checkpoint.load(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
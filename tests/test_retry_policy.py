@@ -0,0 +1,121 @@
+import unittest
+from unittest.case import TestCase
+
+import requests
+from requests.exceptions import HTTPError
+
+from src.errors.http_errors import CircuitOpenError
+from src.retry_policy import CircuitBreaker, RetryBudget, RetryPolicy
+
+
+def http_error(status_code: int, headers: dict = None) -> HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return HTTPError(response=response)
+
+
+class FailingCall:
+    def __init__(self, errors: list, result: str = 'ok'):
+        self.errors = list(errors)
+        self.result = result
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.result
+
+
+class TestRetryPolicy(TestCase):
+
+    def setUp(self) -> None:
+        self.sleeps = []
+        self.policy = RetryPolicy(sleep=self.sleeps.append)
+
+    def test_retries_server_errors_with_backoff(self):
+        call = FailingCall([http_error(503), http_error(502)])
+        self.assertEqual(self.policy.call('family', call), 'ok')
+        self.assertEqual(call.calls, 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(all(0 <= s <= self.policy.max_delay for s in self.sleeps))
+
+    def test_honors_retry_after(self):
+        call = FailingCall([http_error(429, {'Retry-After': '7'})])
+        self.policy.call('family', call)
+        self.assertGreaterEqual(self.sleeps[0], 7)
+
+    def test_clamps_retry_after_to_max_delay(self):
+        call = FailingCall([http_error(429, {'Retry-After': '3600'})])
+        self.policy.call('family', call)
+        self.assertEqual(self.sleeps, [self.policy.max_delay])
+
+    def test_does_not_retry_unauthorized(self):
+        call = FailingCall([http_error(401)])
+        with self.assertRaises(HTTPError):
+            self.policy.call('family', call)
+        self.assertEqual(call.calls, 1)
+
+    def test_gives_up_after_max_attempts(self):
+        call = FailingCall([http_error(500)] * 10)
+        with self.assertRaises(HTTPError):
+            self.policy.call('family', call)
+        self.assertEqual(call.calls, 4)
+
+    def test_no_retry_policy_calls_once(self):
+        policy = RetryPolicy(rules=[], connection_rule=None)
+        for error in (http_error(503), requests.exceptions.ConnectionError()):
+            call = FailingCall([error])
+            with self.assertRaises(type(error)):
+                policy.call('family', call)
+            self.assertEqual(call.calls, 1)
+
+    def test_client_errors_leave_half_open_breaker(self):
+        breaker = CircuitBreaker('family', failure_threshold=1, reset_timeout=0)
+        self.policy.breakers['family'] = breaker
+        breaker.record_failure()
+        with self.assertRaises(HTTPError):
+            self.policy.call('family', FailingCall([http_error(401)]))
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # The probe ended, the next call may probe again
+        self.assertEqual(self.policy.call('family', FailingCall([])), 'ok')
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_budget_limits_retries(self):
+        self.policy.budget = RetryBudget(ratio=0, max_tokens=1)
+        call = FailingCall([http_error(500)] * 10)
+        with self.assertRaises(HTTPError):
+            self.policy.call('family', call)
+        self.assertEqual(call.calls, 2)
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self) -> None:
+        self.now = 0.0
+        self.breaker = CircuitBreaker(
+            'family', failure_threshold=2, reset_timeout=10,
+            clock=lambda: self.now)
+
+    def test_opens_after_threshold_and_fails_fast(self):
+        self.breaker.record_failure()
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_half_open_probe_closes_circuit(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 100
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.before_call()
+
+
+if __name__ == '__main__':
+    unittest.main()
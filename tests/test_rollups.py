@@ -0,0 +1,118 @@
+import unittest
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import mongomock
+from pymongo import ReplaceOne
+
+from src.db_connection import MongoClientManager, MongoConnection
+from src.errors.database_errors import RollupsLocked
+from src.rollups import ListeningRollups
+
+
+def apply_each(collection):
+    # mongomock cannot apply pymongo 4 requests in bulk_write
+    def bulk_write(requests, ordered=True):
+        for request in requests:
+            if isinstance(request, ReplaceOne):
+                collection.replace_one(
+                    request._filter, request._doc, upsert=request._upsert)
+            else:
+                collection.update_one(
+                    request._filter, request._doc, upsert=request._upsert)
+    return bulk_write
+
+
+def play(played_at: datetime, track_id: str, artist_ids: list,
+         duration_ms: int = 1000) -> dict:
+    return {
+        'played_at': played_at,
+        'track': {'id': track_id, 'duration_ms': duration_ms,
+                  'artists': [{'id': artist_id} for artist_id in artist_ids]},
+    }
+
+
+MONDAY = datetime(2023, 5, 1, 12)
+PLAYS = [
+    play(MONDAY, 't1', ['a1']),
+    play(MONDAY + timedelta(minutes=5), 't1', ['a1']),
+    play(MONDAY + timedelta(minutes=10), 't2', ['a1', 'a2'], 3000),
+    play(MONDAY + timedelta(days=1), 't3', ['a3']),
+]
+
+
+class TestListeningRollups(unittest.TestCase):
+
+    def setUp(self) -> None:
+        with mock.patch.object(
+                MongoClientManager, 'get_client',
+                return_value=mongomock.MongoClient()):
+            self.conn = MongoConnection('db', 'song_history', user_id='user')
+            self.rollups = ListeningRollups(self.conn, top_k=1)
+        for period, collection in self.rollups.collections.items():
+            patcher = mock.patch.object(
+                collection, 'bulk_write', side_effect=apply_each(collection))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_update_increments_upserted_buckets(self):
+        self.rollups.update(PLAYS[:2])
+        self.rollups.update(PLAYS[2:])
+        monday = self.rollups.collections['day'].find_one({'day': '2023-05-01'})
+        self.assertEqual(monday['plays'], 3)
+        self.assertEqual(monday['ms_played'], 5000)
+        self.assertEqual(monday['tracks'], {'t1': 2, 't2': 1})
+        self.assertEqual(monday['artists'], {'a1': 3, 'a2': 1})
+        week = self.rollups.collections['week'].find_one({'week': '2023-W18'})
+        self.assertEqual(week['plays'], 4)
+
+    def test_daily_summary_keeps_top_artists(self):
+        self.rollups.update(PLAYS)
+        daily = self.rollups.daily(date(2023, 5, 1), date(2023, 5, 2))
+        self.assertEqual([day['day'] for day in daily],
+                         ['2023-05-01', '2023-05-02'])
+        self.assertEqual(daily[0]['distinct_artists'], 2)
+        self.assertEqual(daily[0]['top_artists'], [('a1', 3)])
+
+    def test_top_sums_days_in_range(self):
+        tuesday = MONDAY + timedelta(days=1)
+        self.rollups.update(PLAYS + [play(tuesday, 't2', [])] * 2)
+        self.assertEqual(
+            self.rollups.top('tracks', date(2023, 5, 1), date(2023, 5, 2), 2),
+            [('t2', 3), ('t1', 2)])
+        self.assertEqual(
+            self.rollups.top('tracks', date(2023, 5, 2), date(2023, 5, 2), 1),
+            [('t2', 2)])
+
+    def test_rebuild_recomputes_and_removes_emptied_buckets(self):
+        self.rollups.update(PLAYS)
+        # Counted twice by an earlier crash, and a day without plays left
+        self.rollups.update(PLAYS[:1])
+        self.rollups.collections['day'].insert_one(
+            {'user_id': 'user', 'day': '2023-05-03', 'plays': 1})
+        self.conn.collection.insert_many([dict(p) for p in PLAYS])
+        self.rollups.rebuild(date(2023, 5, 1), date(2023, 5, 1))
+        days = {document['day']: document['plays']
+                for document in self.rollups.collections['day'].find()}
+        self.assertEqual(days, {'2023-05-01': 3, '2023-05-02': 1})
+        week = self.rollups.collections['week'].find_one({'week': '2023-W18'})
+        self.assertEqual(week['plays'], 4)
+
+    def test_rebuild_refused_while_ingestion_holds_lock(self):
+        with self.rollups.locked('ingestion'):
+            with self.assertRaises(RollupsLocked):
+                self.rollups.rebuild(date(2023, 5, 1), date(2023, 5, 1))
+        self.rollups.rebuild(date(2023, 5, 1), date(2023, 5, 1))
+
+    def test_expired_lock_is_taken_over(self):
+        self.rollups.locks.insert_one({
+            '_id': 'user', 'holder': 'ingestion:dead',
+            'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+        with self.rollups.locked('rebuild'):
+            holder = self.rollups.locks.find_one({'_id': 'user'})['holder']
+            self.assertTrue(holder.startswith('rebuild:'))
+        self.assertIsNone(self.rollups.locks.find_one({'_id': 'user'})['holder'])
+
+
+if __name__ == '__main__':
+    unittest.main()
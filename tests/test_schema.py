@@ -0,0 +1,130 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import mongomock
+
+from src.db_connection import MongoClientManager, MongoConnection
+from src.migrations.runner import MigrationRunner
+from src.migrations.schema import (
+    MIGRATIONS, SCHEMA_VERSION, VERSION_FIELD, migration, upgrade)
+
+
+class TestSchemaUpgrade(unittest.TestCase):
+
+    def tearDown(self) -> None:
+        MIGRATIONS.pop(SCHEMA_VERSION + 1, None)
+
+    def test_unversioned_documents_are_upgraded_in_order(self):
+        @migration(SCHEMA_VERSION + 1, 'Rename context')
+        def rename_context(document):
+            document['play_context'] = document.pop('context')
+            return document
+
+        old = {'played_at': 1, 'context': None}
+        upgraded = upgrade(dict(old), SCHEMA_VERSION + 1)
+        self.assertEqual(upgraded, {
+            'played_at': 1, 'play_context': None,
+            VERSION_FIELD: SCHEMA_VERSION + 1})
+        self.assertEqual(upgrade(dict(upgraded), SCHEMA_VERSION + 1), upgraded)
+        with self.assertRaises(ValueError):
+            migration(SCHEMA_VERSION + 1, 'Duplicate')(rename_context)
+
+    def test_current_documents_are_unchanged(self):
+        document = {'played_at': 1, VERSION_FIELD: SCHEMA_VERSION}
+        self.assertEqual(upgrade(dict(document)), document)
+
+
+def replace_each(collection):
+    # mongomock cannot apply pymongo 4 ReplaceOne requests in bulk_write
+    def bulk_write(requests, ordered=True):
+        results = [collection.replace_one(request._filter, request._doc)
+                   for request in requests]
+        return SimpleNamespace(
+            matched_count=sum(result.matched_count for result in results),
+            modified_count=sum(result.modified_count for result in results))
+    return bulk_write
+
+
+class TestMigrationRunner(unittest.TestCase):
+
+    def setUp(self) -> None:
+        with mock.patch.object(
+                MongoClientManager, 'get_client',
+                return_value=mongomock.MongoClient()):
+            self.database_conn = MongoConnection('db', 'song_history')
+        collection = self.database_conn.collection
+        patcher = mock.patch.object(
+            collection, 'bulk_write', side_effect=replace_each(collection))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Written before versioning, without schema_version
+        self.database_conn.collection.insert_many(
+            [{'position': position} for position in range(25)])
+        self.runner = MigrationRunner(
+            self.database_conn, batch_size=10, max_docs_per_second=None)
+
+    def test_version_index_declared(self):
+        index = self.database_conn.collection.index_information()[
+            'schema_version_id']
+        self.assertEqual(
+            list(index['key']), [('schema_version', 1), ('_id', 1)])
+
+    def test_resumes_after_the_checkpointed_id(self):
+        state = self.runner.run(max_batches=1)
+        self.assertFalse(state['done'])
+        self.assertEqual(state['migrated'], 10)
+        self.assertEqual(self.runner.pending(), 15)
+        checkpoint = state['last_id']
+
+        runner = MigrationRunner(
+            self.database_conn, batch_size=10, max_docs_per_second=None)
+        with mock.patch.object(
+                self.database_conn.collection, 'find',
+                wraps=self.database_conn.collection.find) as find:
+            state = runner.run()
+        # Continues after the checkpoint instead of scanning from the start
+        self.assertEqual(
+            find.call_args_list[0].args[0]['$and'][1],
+            {'_id': {'$gt': checkpoint}})
+        self.assertTrue(state['done'])
+        self.assertEqual(state['migrated'], 25)
+        self.assertEqual(self.runner.pending(), 0)
+
+    def test_documents_written_concurrently_are_skipped(self):
+        collection = self.database_conn.collection
+        bulk_write = replace_each(collection)
+        first = collection.find_one(sort=[('_id', 1)])
+
+        def write_concurrently(requests, **kwargs):
+            # Ingestion rewrites a document between the read and the write
+            collection.replace_one(
+                {'_id': first['_id']},
+                {'position': 'new', VERSION_FIELD: SCHEMA_VERSION})
+            return bulk_write(requests, **kwargs)
+
+        collection.bulk_write.side_effect = write_concurrently
+        state = self.runner.run(max_batches=1)
+        self.assertEqual(state['skipped'], 1)
+        self.assertEqual(state['migrated'], 9)
+        self.assertEqual(
+            collection.find_one({'_id': first['_id']})['position'], 'new')
+
+    def test_done_migration_is_not_run_again(self):
+        self.assertTrue(self.runner.run()['done'])
+        self.database_conn.collection.insert_one({'position': 'late'})
+        with mock.patch.object(self.database_conn.collection, 'find') as find:
+            self.assertTrue(self.runner.run()['done'])
+        find.assert_not_called()
+
+    def test_readers_upgrade_old_documents(self):
+        documents = self.database_conn.find_many({}, projection={'position': 1})
+        self.assertEqual(len(documents), 25)
+        self.assertNotIn(VERSION_FIELD, documents[0])
+        self.assertTrue(all(
+            document[VERSION_FIELD] == SCHEMA_VERSION
+            for document in self.database_conn.iterate({})))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import unittest
+from typing import FrozenSet
+
+import requests
+
+from src._auth.auth_flows import AuthFlow, ScopeRouter
+from src.errors.token_errors import MissingScopeError
+from src.spotify_interaction import SpotifyInteraction, required_scope
+
+
+class FakeFlow(AuthFlow):
+    def __init__(self, scopes: str) -> None:
+        self._scopes = frozenset(scopes.split())
+        self.requests = []
+
+    @property
+    def scopes(self) -> FrozenSet[str]:
+        return self._scopes
+
+    def authenticate(self):
+        pass
+
+    def get_request(self, endpoint: str, params: dict = None):
+        self.requests.append(endpoint)
+        response = requests.Response()
+        response.status_code = 200
+        response.url = endpoint
+        response._content = json.dumps({
+            'items': [], 'next': None, 'cursors': None, 'limit': 20,
+            'href': endpoint}).encode()
+        return response
+
+
+class TestScopeRouting(unittest.TestCase):
+
+    def test_required_scope_covers_declared_endpoints(self):
+        self.assertEqual(
+            required_scope(), 'user-read-recently-played user-top-read')
+        self.assertEqual(required_scope(['track', 'audio_features']), '')
+
+    def test_requests_go_to_the_flow_holding_the_scope(self):
+        public = FakeFlow('')
+        history = FakeFlow('user-read-recently-played')
+        interaction = SpotifyInteraction(public, flows=[history])
+        interaction._get_play_history(0)
+        interaction.get_audio_features('track')
+        self.assertEqual(len(history.requests), 1)
+        self.assertEqual(len(public.requests), 1)
+
+    def test_missing_scope_fails_before_any_request(self):
+        flow = FakeFlow('user-read-recently-played')
+        interaction = SpotifyInteraction(flow)
+        with self.assertRaises(MissingScopeError):
+            interaction.get_top_artists_or_tracks('artists')
+        self.assertEqual(flow.requests, [])
+        self.assertIs(ScopeRouter([flow]).flow_for(None), flow)
+
+
+if __name__ == '__main__':
+    unittest.main()
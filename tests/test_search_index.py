@@ -0,0 +1,54 @@
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from src.search_index import SearchIndex
+
+START = datetime(2021, 7, 1)
+
+
+def play(minutes: int, track: str, album: str, artist: str) -> dict:
+    artists = [{'id': artist.lower(), 'name': artist}]
+    return {
+        'played_at': START + timedelta(minutes=minutes),
+        'track': {
+            'id': track.lower(), 'name': track, 'artists': artists,
+            'album': {'id': album.lower(), 'name': album, 'artists': artists},
+        },
+    }
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.index = SearchIndex(f'{self.directory}/index.sqlite3')
+        self.index.update(
+            [play(0, 'Café del Mar', 'Ibiza', 'Energy 52')]
+            + [play(minutes, 'Cafe Racer', 'Ride', 'Energy Flash')
+               for minutes in range(1, 4)])
+
+    def tearDown(self) -> None:
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_prefix_matches_ignore_accents_and_rank_by_plays(self):
+        results = self.index.search('CAF', kinds=['track'])
+        self.assertEqual(
+            [(result['name'], result['plays']) for result in results],
+            [('Cafe Racer', 3), ('Café del Mar', 1)])
+        self.assertEqual(
+            [result['id'] for result in self.index.search('cafe d')],
+            ['café del mar'])
+
+    def test_updates_are_incremental_and_reindex_renames(self):
+        self.index.search('energy')
+        renamed = play(10, 'Café del Mar', 'Ibiza', 'Energy 52')
+        renamed['track']['name'] = 'Café del Mar (Remastered)'
+        self.index.update([renamed])
+        self.assertEqual(self.index.search('caf del')[0]['plays'], 2)
+        self.assertEqual(
+            self.index.search('remast')[0]['name'], 'Café del Mar (Remastered)')
+        self.assertEqual(
+            [result['plays'] for result in self.index.search('energy')], [3, 2])
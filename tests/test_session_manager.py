@@ -0,0 +1,84 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from requests.exceptions import HTTPError
+
+from src.config import configure_requests
+from src.config.configure_requests import SessionManager, get_session_manager
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        status = 404 if self.path == '/missing' else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSessionManager(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_pool_stats_count_reused_connections(self):
+        manager = SessionManager(host_pool_sizes={}, default_pool_size=3)
+        for _ in range(3):
+            manager.session.get(self.url + '/')
+        stats = manager.pool_stats()[
+            f'http://127.0.0.1:{self.server.server_port}']
+        self.assertEqual(stats['maxsize'], 3)
+        self.assertEqual(stats['opened'], 1)
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['reused'], 2)
+        self.assertEqual(stats['idle'], 1)
+        manager.close()
+
+    def test_error_statuses_raise(self):
+        manager = SessionManager(host_pool_sizes={})
+        with self.assertRaises(HTTPError):
+            manager.session.get(self.url + '/missing')
+        manager.close()
+
+    def test_hosts_get_their_own_pool_size(self):
+        manager = SessionManager(host_pool_sizes={'api.spotify.com': 7})
+        adapter = manager.session.get_adapter('https://api.spotify.com/v1/me')
+        self.assertIs(adapter, manager.adapters['api.spotify.com'])
+        self.assertEqual(adapter._pool_maxsize, 7)
+        self.assertIs(
+            manager.session.get_adapter('https://example.com'),
+            manager.adapters['default'])
+
+
+class TestGetSessionManager(unittest.TestCase):
+
+    def test_shared_manager_rejects_other_settings(self):
+        with mock.patch.object(configure_requests, '_session_manager', None):
+            manager = get_session_manager(retries=1)
+            self.assertIs(get_session_manager(), manager)
+            self.assertIs(get_session_manager(retries=1), manager)
+            self.assertIs(get_session_manager(host_pool_sizes=None), manager)
+            with self.assertRaises(ValueError):
+                get_session_manager(retries=2)
+            with self.assertRaises(ValueError):
+                configure_requests.configure_request(debug_level=1)
+            manager.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import random
+import unittest
+from collections import Counter
+
+import bson
+
+from src.sketches import HeavyHitters, HyperLogLog, PlaySketch, TDigest
+
+
+class TestSketches(unittest.TestCase):
+
+    def test_hyperloglog_merges_overlapping_sets(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for index in range(30000):
+            first.add(f'track{index}')
+            second.add(f'track{index + 15000}')
+        merged = first.merge(second)
+        self.assertAlmostEqual(merged.count(), 45000, delta=45000 * 0.03)
+
+    def test_heavy_hitters_find_top_keys_across_parts(self):
+        rng = random.Random(3)
+        keys = [str(int(rng.paretovariate(1.0))) for _ in range(50000)]
+        parts = [HeavyHitters(capacity=50) for _ in range(3)]
+        for index, key in enumerate(keys):
+            parts[index % 3].add(key)
+        merged = parts[0].merge(parts[1]).merge(parts[2])
+        expected = Counter(keys).most_common(5)
+        top = merged.top(5)
+        self.assertEqual([key for key, _ in top], [key for key, _ in expected])
+        for (_, estimate), (_, count) in zip(top, expected):
+            self.assertGreaterEqual(estimate, count)
+            self.assertLessEqual(estimate, count + len(keys) * 0.002)
+
+    def test_tdigest_quantiles(self):
+        values = list(range(1, 10001))
+        digests = [TDigest() for _ in range(2)]
+        for value in values:
+            digests[value % 2].add(value)
+        merged = digests[0].merge(digests[1])
+        for q in (0.01, 0.5, 0.99):
+            self.assertAlmostEqual(merged.quantile(q), q * 10000, delta=50)
+
+    def test_play_sketch_survives_bson(self):
+        sketch = PlaySketch()
+        for index in range(500):
+            sketch.add(f'track{index % 100}', [f'artist{index % 7}'], 1000 * index)
+        document = bson.decode(bson.encode(sketch.to_document()))
+        restored = PlaySketch.from_document(document)
+        self.assertEqual(restored.plays, 500)
+        self.assertEqual(restored.tracks.count(), sketch.tracks.count())
+        self.assertEqual(restored.top_artists.top(3), sketch.top_artists.top(3))
+        self.assertEqual(restored.durations.quantile(0.5),
+                         sketch.durations.quantile(0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest import mock
+
+import mongomock
+
+from src.db_connection import MongoClientManager, MongoConnection
+from src.history_queries import HistoryQueryRepository
+from src.tiering import ColdStore, TieredHistoryReader, TieringJob
+
+NOW = datetime(2022, 1, 1)
+
+
+class TestTiering(unittest.TestCase):
+
+    def setUp(self) -> None:
+        with mock.patch.object(
+                MongoClientManager, 'get_client',
+                return_value=mongomock.MongoClient()):
+            self.database_conn = MongoConnection('db', 'song_history')
+        self.directory = tempfile.TemporaryDirectory()
+        self.cold_store = ColdStore(self.directory.name)
+        # One play a day for 100 days, 60 of them older than 40 days
+        self.database_conn.collection.insert_many([
+            {'played_at': NOW - timedelta(days=100 - day),
+             'track': {'id': f'track{day}'}}
+            for day in range(100)])
+
+    def tearDown(self) -> None:
+        self.cold_store.close()
+        self.directory.cleanup()
+
+    def job(self) -> TieringJob:
+        return TieringJob(
+            self.database_conn, self.cold_store, max_age=timedelta(days=40),
+            delete_batch_size=7)
+
+    def hot_count(self) -> int:
+        return self.database_conn.collection.count_documents({})
+
+    def cold_count(self) -> int:
+        return len(list(self.cold_store.read('default')))
+
+    def test_archives_then_deletes_old_plays(self):
+        self.assertEqual(self.job().run(NOW), 60)
+        self.assertEqual(self.hot_count(), 40)
+        self.assertEqual(self.cold_count(), 60)
+        self.assertFalse(self.database_conn.collection.count_documents(
+            {'played_at': {'$lt': NOW - timedelta(days=40)}}))
+        self.assertEqual(self.job().run(NOW), 0)
+        self.assertEqual(self.cold_count(), 60)
+
+    def test_interrupted_job_finishes_on_the_next_run(self):
+        job = self.job()
+        with mock.patch.object(
+                TieringJob, '_delete', side_effect=ConnectionError('crash')):
+            with self.assertRaises(ConnectionError):
+                job.run(NOW)
+        # The verified segment is kept, its plays are still hot
+        self.assertEqual(self.hot_count(), 100)
+        self.assertEqual(len(self.cold_store.pending('default')), 1)
+        self.assertEqual(self.job().run(NOW), 60)
+        self.assertEqual(self.hot_count(), 40)
+        self.assertEqual(self.cold_count(), 60)
+        self.assertEqual(self.cold_store.pending('default'), [])
+
+    def test_unverified_segment_is_discarded(self):
+        with mock.patch.object(ColdStore, 'verify', return_value=False):
+            with self.assertRaises(IOError):
+                self.job().run(NOW)
+        self.assertEqual(self.job().run(NOW), 60)
+        self.assertEqual(self.cold_count(), 60)
+
+    def test_reader_pages_across_both_tiers(self):
+        self.job().run(NOW)
+        reader = TieredHistoryReader(
+            HistoryQueryRepository(self.database_conn), self.cold_store)
+        for newest_first in (True, False):
+            ids, cursor = [], None
+            while True:
+                page = reader.find(
+                    limit=15, cursor=cursor, newest_first=newest_first)
+                ids += [play['track']['id'] for play in page.items]
+                if page.next_cursor is None:
+                    break
+                cursor = page.next_cursor
+            expected = [f'track{day}' for day in range(100)]
+            self.assertEqual(
+                ids, expected[::-1] if newest_first else expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from unittest import mock
+
+import mongomock
+
+from src.db_connection import MongoClientManager, MongoConnection
+from src.migrations.time_series import migrate_to_time_series
+
+
+class TestTimeSeriesMigration(unittest.TestCase):
+
+    def setUp(self) -> None:
+        client = mongomock.MongoClient()
+        # mongomock cannot create time series collections
+        with mock.patch.object(
+                MongoClientManager, 'get_client', return_value=client), \
+                mock.patch.object(
+                    MongoConnection, '_create_time_series_collection'):
+            self.source = MongoConnection('db', 'song_history')
+            self.target = MongoConnection(
+                'db', 'song_history_ts', user_id='user', time_series=True)
+        self.source.collection.insert_many(
+            [{'position': position} for position in range(25)])
+
+    def test_rerun_copies_only_new_documents(self):
+        self.assertEqual(
+            migrate_to_time_series(self.source, self.target, batch_size=10), 25)
+        self.source.collection.insert_one({'position': 25})
+        self.assertEqual(
+            migrate_to_time_series(self.source, self.target, batch_size=10), 1)
+        self.assertEqual(self.target.collection.count_documents({}), 26)
+
+    def test_batch_inserted_before_a_crash_is_not_copied_twice(self):
+        # A run that died between insert_many and its checkpoint
+        crashed = list(self.source.collection.find().sort('_id', 1).limit(10))
+        self.target.collection.insert_many(crashed)
+        self.assertEqual(
+            migrate_to_time_series(self.source, self.target, batch_size=10), 15)
+        positions = [document['position']
+                     for document in self.target.collection.find()]
+        self.assertEqual(sorted(positions), list(range(25)))
+
+
+if __name__ == '__main__':
+    unittest.main()
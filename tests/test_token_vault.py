@@ -0,0 +1,70 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from src._auth.token_vault import TokenVault, VaultTokenStore
+from src._auth.tokens import AccessToken
+
+
+def token_content(access_token: str, expires_in: int) -> dict:
+    return {
+        'access_token': access_token,
+        'token_type': 'Bearer',
+        'expires_in': expires_in,
+        'refresh_token': f'refresh-{access_token}',
+        'scope': 'user-read-recently-played',
+    }
+
+
+class TestTokenVault(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+        self.vault = TokenVault(os.path.join(self.directory, 'vault.sqlite3'))
+
+    def tearDown(self) -> None:
+        self.vault.close()
+        shutil.rmtree(self.directory)
+
+    def test_tokens_are_keyed_by_user_and_scope(self):
+        for user_id in ('alice', 'bob'):
+            AccessToken(
+                token_content(user_id, 3600),
+                store=VaultTokenStore(self.vault, user_id, 'b a'))
+        self.assertEqual(
+            self.vault.get('alice', 'a b')['access_token'], 'alice')
+        self.assertEqual(
+            self.vault.get_refresh_token('bob', 'a  b'), 'refresh-bob')
+        self.assertIsNone(self.vault.get('carol', 'a b'))
+
+    def test_refresh_expiring_keeps_refresh_token(self):
+        AccessToken(token_content('old', 10),
+                    store=VaultTokenStore(self.vault, 'alice', 'scope'))
+        AccessToken(token_content('fresh', 3600),
+                    store=VaultTokenStore(self.vault, 'bob', 'scope'))
+
+        def refresh(refresh_token):
+            self.assertEqual(refresh_token, 'refresh-old')
+            return {'access_token': 'new', 'expires_in': 3600}
+
+        stats = self.vault.refresh_expiring(refresh, within_seconds=60)
+        self.assertEqual(stats['refreshed'], 1)
+        token = self.vault.get('alice', 'scope')
+        self.assertEqual(token['access_token'], 'new')
+        self.assertEqual(token['refresh_token'], 'refresh-old')
+        expires_at = datetime.datetime.fromisoformat(token['expires_at'])
+        self.assertGreater(
+            expires_at, datetime.datetime.now(datetime.timezone.utc))
+
+    def test_claim_is_exclusive(self):
+        AccessToken(token_content('old', 10),
+                    store=VaultTokenStore(self.vault, 'alice', 'scope'))
+        self.assertEqual(self.vault.claim('alice', 'scope'), 'refresh-old')
+        self.assertIsNone(self.vault.claim('alice', 'scope'))
+        self.assertEqual(self.vault.expiring(within_seconds=60), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src import tracing
+from src.tracing import (
+    NULL_SPAN, SPAN_KIND_CLIENT, STATUS_ERROR, JsonFileExporter, Tracer,
+    current_span)
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'traces', 'spans.jsonl')
+        self.tracer = Tracer()
+
+    def configure(self, batch_size: int = 64) -> JsonFileExporter:
+        exporter = JsonFileExporter(self.path, batch_size=batch_size)
+        with mock.patch.object(tracing.atexit, 'register'):
+            self.tracer.configure(exporter)
+        return exporter
+
+    def exported(self) -> list:
+        with open(self.path) as file:
+            return [json.loads(line) for line in file]
+
+    def test_disabled_tracer_hands_out_shared_null_span(self):
+        self.assertFalse(self.tracer.enabled)
+        first = self.tracer.start_span('fetch')
+        self.assertIs(first, NULL_SPAN)
+        self.assertIs(self.tracer.start_span('store', db='x'), NULL_SPAN)
+        with first as span:
+            span.set_attribute('items', 3)
+        self.assertIs(current_span(), NULL_SPAN)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_children_parented_through_context(self):
+        exporter = self.configure()
+        with self.tracer.start_span('main') as root:
+            with self.tracer.start_span('fetch') as child:
+                self.assertIs(current_span(), child)
+            self.assertIs(current_span(), root)
+        with self.tracer.start_span('other') as other:
+            pass
+        exporter.flush()
+        self.assertEqual(child.trace_id, root.trace_id)
+        self.assertEqual(child.parent_span_id, root.span_id)
+        self.assertIsNone(root.parent_span_id)
+        self.assertNotEqual(other.trace_id, root.trace_id)
+        self.assertIs(current_span(), NULL_SPAN)
+
+    def test_traced_function_joins_current_trace(self):
+        exporter = self.configure()
+
+        @self.tracer.traced(endpoint='play_history')
+        def fetch():
+            return current_span()
+
+        with self.tracer.start_span('main') as root:
+            span = fetch()
+        exporter.flush()
+        self.assertEqual(span.name, fetch.__qualname__)
+        self.assertEqual(span.parent_span_id, root.span_id)
+
+    def test_exports_otlp_json_lines(self):
+        exporter = self.configure(batch_size=2)
+        with self.assertRaises(ValueError):
+            with self.tracer.start_span(
+                    'GET', SPAN_KIND_CLIENT, retries=2, cached=False,
+                    ratio=0.5, url='https://api.spotify.com'):
+                raise ValueError('boom')
+        with self.tracer.start_span('store'):
+            pass
+        request, = self.exported()
+        resource_spans, = request['resourceSpans']
+        self.assertEqual(resource_spans['resource']['attributes'], [
+            {'key': 'service.name',
+             'value': {'stringValue': 'spotify_user_history'}}])
+        scope_spans, = resource_spans['scopeSpans']
+        self.assertEqual(scope_spans['scope'], {'name': 'src.tracing'})
+        failed, stored = scope_spans['spans']
+        self.assertEqual(failed['kind'], SPAN_KIND_CLIENT)
+        self.assertEqual(
+            failed['status'], {'code': STATUS_ERROR, 'message': 'boom'})
+        self.assertEqual(failed['attributes'], [
+            {'key': 'retries', 'value': {'intValue': '2'}},
+            {'key': 'cached', 'value': {'boolValue': False}},
+            {'key': 'ratio', 'value': {'doubleValue': 0.5}},
+            {'key': 'url', 'value': {'stringValue': 'https://api.spotify.com'}},
+        ])
+        self.assertEqual(failed['events'][0]['name'], 'exception')
+        self.assertLessEqual(
+            int(failed['startTimeUnixNano']), int(failed['endTimeUnixNano']))
+        self.assertEqual(len(failed['traceId']), 32)
+        self.assertEqual(len(failed['spanId']), 16)
+        self.assertNotIn('parentSpanId', stored)
+        exporter.flush()
+        self.assertEqual(len(self.exported()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()